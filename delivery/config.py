@@ -5,7 +5,7 @@ from folium.plugins import Draw
 from streamlit_folium import st_folium
 import polyline
 import pandas as pd
-from shapely.geometry import Point, Polygon
+from zonas import indice_zonas, version_zonas
 import copy
 
 # --- CONFIGURACIÓN ---
@@ -24,20 +24,11 @@ TARIFA_DEFAULT = [
 
 # --- FUNCIONES DE LÓGICA ---
 
-def verificar_zonas(lat, lon, zonas_activas):
+def verificar_zonas(lat, lon, zonas_activas, version=None):
     """Revisa si el destino cae en alguna zona activa"""
-    punto = Point(lat, lon) 
-    recargo_total = 0
-    zonas_afectadas = []
-
-    for zona in zonas_activas:
-        if not zona['activa']: continue
-        poly = Polygon(zona['coords'])
-        if poly.contains(punto):
-            recargo_total += zona['precio']
-            zonas_afectadas.append(zona['nombre'])
-            
-    return recargo_total, zonas_afectadas
+    # Índice compilado (polígonos preparados + STRtree), cacheado por versión de las zonas
+    version = version or version_zonas(zonas_activas)
+    return indice_zonas(version, zonas_activas).verificar(lat, lon)
 
 def calcular_precio_base(distancia_km, tabla_tarifas):
     """Calcula precio basándose en la tabla de tarifas activa"""
@@ -80,6 +71,7 @@ def main():
     # --- 1. INICIALIZAR BASE DE DATOS (EN MEMORIA) ---
     if 'zonas_registradas' not in st.session_state:
         st.session_state['zonas_registradas'] = [] 
+        st.session_state['zonas_version'] = version_zonas([])
         
     if 'perfiles_tarifas' not in st.session_state:
         # Diccionario de perfiles. Clave = Nombre Perfil, Valor = Lista de dicts
@@ -207,6 +199,7 @@ def main():
                     if es_nueva:
                         nueva_zona = {"nombre": f"Zona {len(st.session_state['zonas_registradas'])+1}", "precio": 2.0, "activa": True, "coords": coords_clean}
                         st.session_state['zonas_registradas'].append(nueva_zona)
+                        st.session_state['zonas_version'] = version_zonas(st.session_state['zonas_registradas'])
                         st.rerun()
 
         with col_admin_list:
@@ -219,9 +212,11 @@ def main():
                     is_active = st.checkbox("Activa", value=zona['activa'], key=f"a_{i}")
                     if st.button("Guardar", key=f"s_{i}"):
                         st.session_state['zonas_registradas'][i].update({'nombre': new_name, 'precio': new_price, 'activa': is_active})
+                        st.session_state['zonas_version'] = version_zonas(st.session_state['zonas_registradas'])
                         st.rerun()
                     if st.button("Eliminar", key=f"d_{i}"):
                         st.session_state['zonas_registradas'].pop(i)
+                        st.session_state['zonas_version'] = version_zonas(st.session_state['zonas_registradas'])
                         st.rerun()
 
     # ==========================================
@@ -270,7 +265,7 @@ def main():
                             
                             # CÁLCULOS
                             p_base, nom_tarifa = calcular_precio_base(ruta['distancia_km'], tabla_actual)
-                            recargo_zonas, nombres_zonas = verificar_zonas(destino[1], destino[0], st.session_state['zonas_registradas'])
+                            recargo_zonas, nombres_zonas = verificar_zonas(destino[1], destino[0], st.session_state['zonas_registradas'], st.session_state.get('zonas_version'))
                             
                             st.session_state['cotizacion'] = {
                                 'ruta': ruta, 'puntos': puntos, 'p_base': p_base, 'p_zona': recargo_zonas,
@@ -5,11 +5,15 @@ from folium.plugins import Draw
 from streamlit_folium import st_folium
 import polyline
 import pandas as pd
-from shapely.geometry import Point, Polygon
+from zonas import indice_zonas, version_zonas
 import copy
 import sqlite3
 import json
 import uuid
+import threading
+import time
+import functools
+from datetime import datetime, timezone
 
 # --- CONFIGURACIÓN ---
 DEFAULT_LAT = 10.251519
@@ -29,73 +33,106 @@ TARIFA_DEFAULT = [
 # ==========================================
 #      CAPA DE BASE DE DATOS (SQLite)
 # ==========================================
+# Una sola conexión por proceso (st.cache_resource) en modo WAL: las lecturas de la vista
+# de cliente no esperan a las escrituras del panel. Streamlit atiende cada sesión en su
+# propio hilo, así que el acceso a la conexión se serializa con un lock.
+# Las cotizaciones guardan la ruta como polyline codificada (no la lista de puntos) y
+# vencen a las QUOTE_VALIDITY_HOURS; las vencidas se borran cada QUOTE_PURGE_SECONDS.
 
-def init_db():
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
+QUOTE_VALIDITY_HOURS = 24
+QUOTE_PURGE_SECONDS = 600
+_db_lock = threading.Lock()
+_ultima_purga = 0.0
+
+@st.cache_resource
+def get_connection():
+    conn = sqlite3.connect(DB_FILE, check_same_thread=False, isolation_level=None)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    init_db(conn)
+    return conn
+
+def init_db(conn):
     # Tabla para cotizaciones históricas
-    c.execute('''CREATE TABLE IF NOT EXISTS quotes 
+    conn.execute('''CREATE TABLE IF NOT EXISTS quotes 
                  (id TEXT PRIMARY KEY, 
                   data TEXT, 
-                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP)''')
+                  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                  expires_at TIMESTAMP)''')
+    # Bases creadas antes de que existiera el vencimiento
+    columnas = [fila[1] for fila in conn.execute("PRAGMA table_info(quotes)")]
+    if 'expires_at' not in columnas:
+        conn.execute("ALTER TABLE quotes ADD COLUMN expires_at TIMESTAMP")
+        conn.execute("UPDATE quotes SET expires_at = datetime(created_at, ?) WHERE expires_at IS NULL",
+                     (f"+{QUOTE_VALIDITY_HOURS} hours",))
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_quotes_expires_at ON quotes (expires_at)")
     
     # Tabla para configuración (Zonas y Tarifas)
-    c.execute('''CREATE TABLE IF NOT EXISTS config 
+    conn.execute('''CREATE TABLE IF NOT EXISTS config 
                  (key TEXT PRIMARY KEY, value TEXT)''')
-    conn.commit()
-    conn.close()
 
 def save_config(key, data):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, json.dumps(data)))
-    conn.commit()
-    conn.close()
+    with _db_lock:
+        get_connection().execute("INSERT OR REPLACE INTO config (key, value) VALUES (?, ?)", (key, json.dumps(data)))
 
 def load_config(key, default_value):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT value FROM config WHERE key=?", (key,))
-    result = c.fetchone()
-    conn.close()
+    with _db_lock:
+        result = get_connection().execute("SELECT value FROM config WHERE key=?", (key,)).fetchone()
     if result:
         return json.loads(result[0])
     return default_value
 
+def guardar_zonas(zonas):
+    save_config('zonas', zonas)
+    st.session_state['zonas_version'] = version_zonas(zonas)
+
+def purgar_cotizaciones_vencidas(forzar=False):
+    """Borra las cotizaciones vencidas, como mucho una vez cada QUOTE_PURGE_SECONDS."""
+    global _ultima_purga
+    if not forzar and time.time() - _ultima_purga < QUOTE_PURGE_SECONDS:
+        return 0
+    _ultima_purga = time.time()
+    with _db_lock:
+        return get_connection().execute("DELETE FROM quotes WHERE expires_at <= CURRENT_TIMESTAMP").rowcount
+
 def save_quote_to_db(quote_data):
     quote_id = str(uuid.uuid4())[:8] # ID corto de 8 caracteres
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("INSERT INTO quotes (id, data) VALUES (?, ?)", (quote_id, json.dumps(quote_data)))
-    conn.commit()
-    conn.close()
+    with _db_lock:
+        get_connection().execute(
+            "INSERT INTO quotes (id, data, expires_at) VALUES (?, ?, datetime('now', ?))",
+            (quote_id, json.dumps(quote_data), f"+{QUOTE_VALIDITY_HOURS} hours")
+        )
+    purgar_cotizaciones_vencidas()
     return quote_id
 
+@st.cache_data(ttl=300, show_spinner=False)
 def get_quote_from_db(quote_id):
-    conn = sqlite3.connect(DB_FILE)
-    c = conn.cursor()
-    c.execute("SELECT data FROM quotes WHERE id=?", (quote_id,))
-    result = c.fetchone()
-    conn.close()
+    with _db_lock:
+        result = get_connection().execute(
+            "SELECT data, expires_at FROM quotes WHERE id=? AND expires_at > CURRENT_TIMESTAMP", (quote_id,)
+        ).fetchone()
     if result:
-        return json.loads(result[0])
+        return {**json.loads(result[0]), 'expires_at': result[1]}
     return None
 
+@functools.lru_cache(maxsize=256)
+def _decodificar_polyline(codificada):
+    return polyline.decode(codificada)
+
+def ruta_coords(ruta):
+    """Puntos [lat, lon] de una ruta, decodificando la polyline solo cuando hace falta."""
+    if 'ruta_coords' in ruta: # Cotizaciones guardadas antes de codificar la ruta
+        return ruta['ruta_coords']
+    return _decodificar_polyline(ruta['polyline'])
+
 # ==========================================
 #      LÓGICA DE NEGOCIO
 # ==========================================
 
-def verificar_zonas(lat, lon, zonas_activas):
-    punto = Point(lat, lon) 
-    recargo_total = 0
-    zonas_afectadas = []
-    for zona in zonas_activas:
-        if not zona['activa']: continue
-        poly = Polygon(zona['coords'])
-        if poly.contains(punto):
-            recargo_total += zona['precio']
-            zonas_afectadas.append(zona['nombre'])
-    return recargo_total, zonas_afectadas
+def verificar_zonas(lat, lon, zonas_activas, version=None):
+    # Índice compilado (polígonos preparados + STRtree), cacheado por versión de las zonas
+    version = version or version_zonas(zonas_activas)
+    return indice_zonas(version, zonas_activas).verificar(lat, lon)
 
 def calcular_precio_base(distancia_km, tabla_tarifas):
     for tier in tabla_tarifas:
@@ -122,18 +159,61 @@ def obtener_ruta_osrm(p1, p2):
         return {
             "distancia_km": round(route["distance"] / 1000, 2),
             "duracion_min": round(route["duration"] / 60, 0),
-            "ruta_coords": polyline.decode(route["geometry"])
+            "polyline": route["geometry"] # Codificada; ver ruta_coords()
         }
     except:
         return None
 
+# ==========================================
+#      MAPAS BASE (CACHÉ)
+# ==========================================
+# La capa de zonas del panel se arma una vez por versión de las zonas (st.cache_data) como un
+# solo GeoJSON, en vez de un folium.Polygon por zona en cada rerun. La ruta y los marcadores
+# van aparte, en feature_group_to_add: el mapa base genera el mismo script en cada rerun y
+# st_folium no lo vuelve a montar en el navegador, solo actualiza esa capa.
+
+@st.cache_data(max_entries=16, show_spinner=False)
+def zonas_geojson(version, _zonas, solo_activas=False):
+    """FeatureCollection de las zonas ([lat, lon] -> [lon, lat]); 'version' es la clave de caché."""
+    features = []
+    for z in _zonas:
+        if solo_activas and not z['activa']: continue
+        features.append({
+            "type": "Feature",
+            "properties": {"nombre": z['nombre'], "activa": z['activa']},
+            "geometry": {"type": "Polygon", "coordinates": [[[lon, lat] for lat, lon in z['coords']]]}
+        })
+    return {"type": "FeatureCollection", "features": features}
+
+def mapa_base(modo, version, zonas):
+    """Mapa del modo 'Zonas' o 'Cotizador': teselas, capa de zonas y herramienta de dibujo."""
+    m = folium.Map(location=[DEFAULT_LAT, DEFAULT_LON], zoom_start=13)
+    if modo == "Zonas":
+        datos = zonas_geojson(version, zonas)
+        if datos['features']:
+            folium.GeoJson(
+                datos, name="Zonas",
+                style_function=lambda f: {"color": "red" if f['properties']['activa'] else "gray", "fill": True, "fillOpacity": 0.4},
+                popup=folium.GeoJsonPopup(fields=["nombre"], labels=False)
+            ).add_to(m)
+        Draw(export=False, draw_options={'polyline':False,'polygon':True,'marker':False,'circle':False,'rectangle':False}, edit_options={'edit':False,'remove':True}).add_to(m)
+    else:
+        datos = zonas_geojson(version, zonas, solo_activas=True)
+        if datos['features']:
+            folium.GeoJson(
+                datos, name="Zonas",
+                style_function=lambda f: {"color": "red", "weight": 1, "fill": True, "fillOpacity": 0.1}
+            ).add_to(m)
+        Draw(export=False, draw_options={'polyline':False,'polygon':False,'marker':True,'circle':False,'rectangle':False}, edit_options={'edit':True,'remove':True}).add_to(m)
+    return m
+
 # ==========================================
 #      INTERFAZ DE USUARIO
 # ==========================================
 
 def main():
     st.set_page_config(page_title="Sistema Delivery", layout="wide", initial_sidebar_state="collapsed")
-    init_db()
+    get_connection()
 
     # 1. VERIFICAR SI ESTAMOS EN MODO VISOR (CLIENTE)
     # Streamlit query params: ?id=xxxx
@@ -148,6 +228,9 @@ def main():
 def render_client_view(quote_id):
     """Vista simplificada para el cliente final"""
     data = get_quote_from_db(quote_id)
+    # La lectura está en caché: se revisa el vencimiento por si venció mientras tanto
+    if data and data['expires_at'] <= datetime.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S"):
+        data = None
     
     if not data:
         st.error("Cotización no encontrada o expirada.")
@@ -167,7 +250,7 @@ def render_client_view(quote_id):
         m = folium.Map(location=[puntos[0][1], puntos[0][0]], zoom_start=13)
         
         # Ruta y Marcadores
-        folium.PolyLine(data['ruta']['ruta_coords'], color="blue", weight=5).add_to(m)
+        folium.PolyLine(ruta_coords(data['ruta']), color="blue", weight=5).add_to(m)
         folium.Marker([puntos[0][1], puntos[0][0]], popup="Origen", icon=folium.Icon(color="green")).add_to(m)
         folium.Marker([puntos[1][1], puntos[1][0]], popup="Destino", icon=folium.Icon(color="red")).add_to(m)
         
@@ -188,7 +271,7 @@ def render_client_view(quote_id):
             for z in data['detalles']['zonas']:
                 st.caption(f"- {z}")
                 
-        st.caption("Esta cotización es válida por 24 horas.")
+        st.caption(f"Esta cotización es válida por {QUOTE_VALIDITY_HOURS} horas (hasta {data['expires_at']} UTC).")
 
 def render_admin_panel():
     """Panel completo de administración"""
@@ -196,6 +279,9 @@ def render_admin_panel():
     # Cargar Configuración desde DB
     if 'zonas_registradas' not in st.session_state:
         st.session_state['zonas_registradas'] = load_config('zonas', [])
+
+    if 'zonas_version' not in st.session_state:
+        st.session_state['zonas_version'] = version_zonas(st.session_state['zonas_registradas'])
         
     if 'perfiles_tarifas' not in st.session_state:
         st.session_state['perfiles_tarifas'] = load_config('tarifas', {"Estándar": copy.deepcopy(TARIFA_DEFAULT)})
@@ -262,12 +348,7 @@ def render_admin_panel():
         col_map, col_list = st.columns([2, 1])
         
         with col_map:
-            m = folium.Map(location=[DEFAULT_LAT, DEFAULT_LON], zoom_start=13)
-            for z in st.session_state['zonas_registradas']:
-                color = "red" if z['activa'] else "gray"
-                folium.Polygon(locations=z['coords'], color=color, fill=True, fill_opacity=0.4, popup=z['nombre']).add_to(m)
-            
-            Draw(export=False, draw_options={'polyline':False,'polygon':True,'marker':False,'circle':False,'rectangle':False}, edit_options={'edit':False,'remove':True}).add_to(m)
+            m = mapa_base("Zonas", st.session_state['zonas_version'], st.session_state['zonas_registradas'])
             output = st_folium(m, width="100%", height=500, returned_objects=["all_drawings"])
             
             if output and output.get("all_drawings"):
@@ -281,7 +362,7 @@ def render_admin_panel():
                     if is_new:
                         new_zone = {"nombre": f"Zona {len(st.session_state['zonas_registradas'])+1}", "precio": 2.0, "activa": True, "coords": coords}
                         st.session_state['zonas_registradas'].append(new_zone)
-                        save_config('zonas', st.session_state['zonas_registradas'])
+                        guardar_zonas(st.session_state['zonas_registradas'])
                         st.rerun()
         
         with col_list:
@@ -293,11 +374,11 @@ def render_admin_panel():
                     a = st.checkbox("Activa", value=z['activa'], key=f"a{i}")
                     if st.button("Actualizar", key=f"u{i}"):
                         zonas[i].update({'nombre': n, 'precio': p, 'activa': a})
-                        save_config('zonas', zonas)
+                        guardar_zonas(zonas)
                         st.rerun()
                     if st.button("Borrar", key=f"d{i}"):
                         zonas.pop(i)
-                        save_config('zonas', zonas)
+                        guardar_zonas(zonas)
                         st.rerun()
 
     # --- MODO COTIZADOR ---
@@ -306,20 +387,19 @@ def render_admin_panel():
         col_map, col_res = st.columns([3, 1])
         
         with col_map:
-            m = folium.Map(location=[DEFAULT_LAT, DEFAULT_LON], zoom_start=13)
-            # Zonas visuales
-            for z in st.session_state['zonas_registradas']:
-                if z['activa']: folium.Polygon(locations=z['coords'], color="red", weight=1, fill=True, fill_opacity=0.1).add_to(m)
+            # Zonas visuales (capa cacheada)
+            m = mapa_base("Cotizador", st.session_state['zonas_version'], st.session_state['zonas_registradas'])
             
             # Ruta
             session = st.session_state['cotizacion']
+            capa_ruta = folium.FeatureGroup(name="Ruta")
             if session['ruta']:
-                folium.PolyLine(session['ruta']['ruta_coords'], color="blue", weight=5).add_to(m)
-                folium.Marker([session['puntos'][0][1], session['puntos'][0][0]], icon=folium.Icon(color="green")).add_to(m)
-                folium.Marker([session['puntos'][1][1], session['puntos'][1][0]], icon=folium.Icon(color="red")).add_to(m)
+                folium.PolyLine(ruta_coords(session['ruta']), color="blue", weight=5).add_to(capa_ruta)
+                folium.Marker([session['puntos'][0][1], session['puntos'][0][0]], icon=folium.Icon(color="green")).add_to(capa_ruta)
+                folium.Marker([session['puntos'][1][1], session['puntos'][1][0]], icon=folium.Icon(color="red")).add_to(capa_ruta)
                 
-            Draw(export=False, draw_options={'polyline':False,'polygon':False,'marker':True,'circle':False,'rectangle':False}, edit_options={'edit':True,'remove':True}).add_to(m)
-            output = st_folium(m, width="100%", height=600, returned_objects=["all_drawings"])
+            # Solo la ruta cambia entre reruns: va como capa dinámica sobre el mapa base
+            output = st_folium(m, width="100%", height=600, feature_group_to_add=capa_ruta, returned_objects=["all_drawings"])
             
             if output and output.get("all_drawings"):
                 pts = [d["geometry"]["coordinates"] for d in output["all_drawings"] if d["geometry"]["type"] == "Point"]
@@ -328,7 +408,7 @@ def render_admin_panel():
                     if route:
                         prof = st.session_state['perfil_activo']
                         p_base, nom = calcular_precio_base(route['distancia_km'], st.session_state['perfiles_tarifas'][prof])
-                        p_zona, z_names = verificar_zonas(pts[1][1], pts[1][0], st.session_state['zonas_registradas'])
+                        p_zona, z_names = verificar_zonas(pts[1][1], pts[1][0], st.session_state['zonas_registradas'], st.session_state['zonas_version'])
                         
                         # GUARDAR EN DB
                         quote_data = {
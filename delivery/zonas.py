@@ -0,0 +1,44 @@
+import hashlib
+import json
+
+import streamlit as st
+from shapely.geometry import Point, Polygon
+from shapely.prepared import prep
+from shapely.strtree import STRtree
+
+# --- ÍNDICE DE ZONAS (RECARGOS) ---
+# Las zonas activas se compilan una sola vez por versión del conjunto de zonas: cada polígono
+# se prepara (prep) y todos van a un STRtree. Para cotizar, el árbol filtra por bounding box
+# y solo los candidatos se prueban con 'contains'. El resultado (recargo total y nombres de
+# zona, en el orden de la lista) es el mismo que probar polígono por polígono.
+
+def version_zonas(zonas):
+    """Huella del conjunto de zonas: cambia con cualquier alta, baja o edición."""
+    return hashlib.sha1(json.dumps(zonas, sort_keys=True).encode()).hexdigest()
+
+class IndiceZonas:
+    def __init__(self, zonas):
+        activas = [z for z in zonas if z['activa']]
+        # Copia de lo necesario: la lista de la sesión se edita in situ
+        self.recargos = [(z['precio'], z['nombre']) for z in activas]
+        poligonos = [Polygon(z['coords']) for z in activas]
+        self.preparados = [prep(p) for p in poligonos]
+        self.arbol = STRtree(poligonos) if poligonos else None
+
+    def verificar(self, lat, lon):
+        punto = Point(lat, lon)
+        recargo_total = 0
+        zonas_afectadas = []
+        if self.arbol is None:
+            return recargo_total, zonas_afectadas
+        for i in sorted(int(i) for i in self.arbol.query(punto)):
+            if self.preparados[i].contains(punto):
+                precio, nombre = self.recargos[i]
+                recargo_total += precio
+                zonas_afectadas.append(nombre)
+        return recargo_total, zonas_afectadas
+
+@st.cache_resource(max_entries=16, show_spinner=False)
+def indice_zonas(version, _zonas):
+    """IndiceZonas compartido entre sesiones y reruns; '_zonas' no se hashea, manda 'version'."""
+    return IndiceZonas(_zonas)
@@ -7,8 +7,10 @@ from typing import Optional, Any
 from passlib.context import CryptContext # <-- AÑADIR IMPORT
 
 # --- INICIO DE LA CORRECCIÓN ---
-# Importamos 'get_db' y 'get_db_connection' desde 'database'
-from database import get_db, get_db_connection
+# Importamos 'get_db' y el pool de conexiones desde 'database'
+from database import get_db, db_pool
+from async_db import get_async_db
+from outbound import verify_id_token
 
 # Movemos la definición de pwd_context aquí. Este es su lugar lógico.
 pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
@@ -38,12 +40,12 @@ class User:
 
 
 # --- DEPENDENCIAS DE VALIDACIÓN INDIVIDUALES ---
-def get_current_user(credentials: Optional[HTTPBearer] = Depends(http_bearer_scheme)) -> Optional[User]:
+async def get_current_user(credentials: Optional[HTTPBearer] = Depends(http_bearer_scheme)) -> Optional[User]:
     if not credentials or not credentials.credentials:
         return None
     token = credentials.credentials
     try:
-        decoded_token = auth.verify_id_token(token)
+        decoded_token = await verify_id_token(token)
         uid = decoded_token['uid']
         email = decoded_token.get('email', 'N/A')
         role = decoded_token.get('role', 'viewer')
@@ -51,21 +53,18 @@ def get_current_user(credentials: Optional[HTTPBearer] = Depends(http_bearer_sch
     except Exception:
         return None
 
-async def get_api_key_principal(api_key: Optional[str] = Depends(api_key_header_scheme), db=Depends(get_db)) -> Optional[str]:
+async def get_api_key_principal(api_key: Optional[str] = Depends(api_key_header_scheme), db=Depends(get_async_db)) -> Optional[str]:
     if not api_key:
         return None
     try:
         prefix = api_key.split('_')[0] + "_" + api_key.split('_')[1]
     except IndexError:
         return None
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT hashed_key, client_name FROM api_keys WHERE prefix = %s AND is_active = TRUE", (prefix,))
-        result = cur.fetchone()
-        if not result or not pwd_context.verify(api_key, result['hashed_key']):
-            return None
-        cur.execute("UPDATE api_keys SET last_used_at = NOW() WHERE prefix = %s", (prefix,))
-        db.commit()
-        return result['client_name']
+    result = await db.fetchrow("SELECT hashed_key, client_name FROM api_keys WHERE prefix = $1 AND is_active = TRUE", prefix)
+    if not result or not pwd_context.verify(api_key, result['hashed_key']):
+        return None
+    await db.execute("UPDATE api_keys SET last_used_at = NOW() WHERE prefix = $1", prefix)
+    return result['client_name']
 
 # --- DEPENDENCIA DE AUTENTICACIÓN DUAL ---
 async def get_current_principal(
@@ -96,9 +95,7 @@ class RoleChecker:
     def __init__(self, required_permission: str):
         self.required_permission = required_permission
     def __call__(self, user: User = Depends(require_user)):
-        conn = None
-        try:
-            conn = get_db_connection()
+        with db_pool.connection() as conn:
             with conn.cursor() as cur:
                 cur.execute("SELECT valor FROM app_config WHERE clave = 'user_roles_permissions'")
                 config_row = cur.fetchone()
@@ -108,7 +105,4 @@ class RoleChecker:
                 user_permissions = permissions_config.get(user.role, [])
                 if self.required_permission not in user_permissions and "superadmin" not in user_permissions:
                     raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="No tienes permiso para esta acción.")
-        finally:
-            if conn:
-                conn.close()
         return user
\ No newline at end of file
@@ -1,17 +1,21 @@
 import psycopg2
+import psycopg2.pool
 from psycopg2.extras import RealDictCursor
 from psycopg2 import sql
 import os
 import logging
 from dotenv import load_dotenv
-from math import radians, sin, cos, sqrt, atan2
 import json
-import requests
 from urllib.parse import urlparse, parse_qs
 import uuid
 import redis
 import time
 import sys
+import threading
+from contextlib import contextmanager
+from migrations import run_migrations, preparar_postgis
+from partitions import mantener_particiones
+from geo import haversine_km, FACTOR_CALLE
 
 # Configurar un logger para este módulo
 logging.basicConfig(level=logging.INFO)
@@ -54,6 +58,13 @@ DB_USER = os.getenv("DB_USER", "postgres")
 DB_PASSWORD = os.getenv("DB_PASSWORD", "postgres")
 DB_NAME = os.getenv("DB_NAME", "delivery_db")
 ADMIN_DB_NAME = os.getenv("ADMIN_DB_NAME", "postgres")
+DB_CONNECT_RETRIES = int(os.getenv("DB_CONNECT_RETRIES", 20))
+
+# --- CONFIGURACIÓN DEL POOL DE CONEXIONES ---
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 20))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", 10))  # Segundos máximos esperando una conexión libre
+DB_POOL_HEALTHCHECK_IDLE = float(os.getenv("DB_POOL_HEALTHCHECK_IDLE", 30))  # Segundos ociosa antes de verificarla con SELECT 1
 
 GOOGLE_MAPS_API_KEY = os.getenv("GOOGLE_MAPS_API_KEY", "")
 OSRM_BASE_URL = os.getenv("OSRM_URL", "http://router.project-osrm.org/route/v1/driving")
@@ -102,147 +113,32 @@ def extraer_coordenadas_de_url(url: str) -> str | None:
         logger.error(f"Error extrayendo coordenadas: {url}", exc_info=True)
         return None
 
-def obtener_distancia_osrm(origen_coords: str, destino_coords: str) -> dict | None:
-    """Obtiene distancia y duración usando OSRM (OpenStreetMap)."""
-    try:
-        lat1, lon1 = origen_coords.split(',')
-        lat2, lon2 = destino_coords.split(',')
-        
-        url = f"{OSRM_BASE_URL}/{lon1},{lat1};{lon2},{lat2}?overview=false"
-        response = requests.get(url, timeout=5)
-        
-        if response.status_code != 200:
-            logger.error(f"Error OSRM API: {response.status_code}")
-            return None
-            
-        data = response.json()
-        if data.get("code") != "Ok" or not data.get("routes"):
-            return None
-
-        route = data["routes"][0]
-        return {
-            "km": route["distance"] / 1000,
-            "distancia_texto": f"{route['distance']/1000:.1f} km",
-            "duracion_texto": f"{route['duration']/60:.0f} min"
-        }
-    except Exception as e:
-        logger.error(f"Error conectando con OSRM: {e}")
-        return None
-
-# En backend/database.py
-
-# En backend/database.py
-
-def calcular_costo_delivery_ruta(origen_coords: str, destino_coords: str, tipo_vehiculo: str, config_completa: dict = None) -> dict:
+def estimar_ruta_lineal(origen_coords: str, destino_coords: str) -> dict | None:
     """
-    Función definitiva para calcular costo, con manejo de fallos de OSRM.
+    Fallback cuando OSRM no responde: distancia en línea recta con un factor
+    de corrección para simular la ruta en calle (aprox. 1.4).
     """
-    info_ruta = obtener_distancia_osrm(origen_coords, destino_coords)
-    
-    # --- CORRECCIÓN: Manejo de fallo en OSRM ---
-    if not info_ruta:
-        # Si OSRM falla (ej: ruta imposible), intentamos un cálculo en línea recta como fallback
-        logger.warning(f"OSRM falló para {origen_coords} -> {destino_coords}. Usando cálculo Haversine como fallback.")
-        try:
-            lat1, lon1 = map(float, origen_coords.split(','))
-            lat2, lon2 = map(float, destino_coords.split(','))
-            dist_lineal = haversine(lat1, lon1, lat2, lon2)
-            # Aplicamos un factor de corrección para simular la ruta en calle (aprox. 1.4)
-            distancia_km = dist_lineal * 1.4
-            info_ruta = {
-                "km": distancia_km,
-                "distancia_texto": f"~{distancia_km:.1f} km (est.)",
-                "duracion_texto": "N/A" # No podemos estimar duración sin OSRM
-            }
-        except (ValueError, IndexError):
-            # Si ni siquiera podemos parsear las coordenadas, devolvemos error.
-            return {"error": "Coordenadas inválidas."}
-    
-    distancia_km = info_ruta['km']
-    
-    if config_completa is None:
-        conn = get_db_connection()
-        try:
-            with conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("SELECT valor FROM app_config WHERE clave = 'pricing_tiers'")
-                config_row = cur.fetchone()
-                if not config_row: return {"error": "Configuración de tarifas no encontrada en la DB."}
-                config_completa = config_row['valor']
-        finally:
-            conn.close()
-
-    if tipo_vehiculo not in config_completa:
-        return {"error": f"Tipo de vehículo '{tipo_vehiculo}' no está definido en la configuración."}
-        
-    config_vehiculo = config_completa[tipo_vehiculo]
-    tiers = config_vehiculo.get('tiers', [])
-    costo = 0.0
-    tier_aplicado = "No definido"
-    
-    sorted_tiers = sorted(tiers, key=lambda x: x.get('min_km', float('inf')))
-    
-    for tier in sorted_tiers:
-        if 'max_km' in tier:
-            if distancia_km <= tier['max_km']:
-                tier_aplicado = tier.get('nombre')
-                costo = tier.get('precio_fijo')
-                break
-        elif 'precio_base' in tier:
-            tier_aplicado = tier.get('nombre')
-            distancia_adicional = distancia_km - tier.get('min_km', 0)
-            costo = tier.get("precio_base", 0) + (distancia_adicional * tier.get("precio_por_km_adicional", 0))
-            break
-
-    # Asegurarnos de que las claves siempre existan
+    try:
+        lat1, lon1 = map(float, origen_coords.split(','))
+        lat2, lon2 = map(float, destino_coords.split(','))
+    except (ValueError, IndexError):
+        return None
+    distancia_km = haversine_km(lat1, lon1, lat2, lon2) * FACTOR_CALLE
     return {
-        "origen": origen_coords, "destino": destino_coords,
-        "distancia_km": round(distancia_km, 2),
-        "distancia_texto": info_ruta.get('distancia_texto', 'N/A'),
-        "duracion_estimada": info_ruta.get('duracion_estimada', 'N/A'), # <-- CORRECCIÓN
-        "tier_aplicado": tier_aplicado,
-        "costo": round(costo, 2),
-        "moneda": config_vehiculo.get("moneda", "USD"),
-        "tipo_vehiculo": tipo_vehiculo
+        "km": distancia_km,
+        "distancia_texto": f"~{distancia_km:.1f} km (est.)",
+        "duracion_texto": "N/A" # No podemos estimar duración sin OSRM
     }
 
-def get_address_autocomplete(input_text: str, session_token: str) -> dict:
-    if not GOOGLE_MAPS_API_KEY: return {"error": "Google API Key no configurada"}
-    api_url = "https://maps.googleapis.com/maps/api/place/autocomplete/json"
-    params = {"input": input_text, "key": GOOGLE_MAPS_API_KEY, "language": "es", "components": "country:VE", "sessiontoken": session_token}
-    try:
-        response = requests.get(api_url, params=params)
-        data = response.json()
-        if data['status'] == 'OK': return {"suggestions": data['predictions']}
-        return {"error": data.get('error_message', 'Error API')}
-    except Exception as e: return {"error": str(e)}
-
-def get_place_details(place_id: str, session_token: str) -> dict:
-    if not GOOGLE_MAPS_API_KEY: return {"error": "Google API Key no configurada"}
-    api_url = "https://maps.googleapis.com/maps/api/place/details/json"
-    params = {"place_id": place_id, "fields": "geometry,formatted_address", "key": GOOGLE_MAPS_API_KEY, "language": "es", "sessiontoken": session_token}
-    try:
-        response = requests.get(api_url, params=params)
-        data = response.json()
-        if data['status'] == 'OK': return {"details": data['result']}
-        return {"error": data.get('error_message', 'Error API')}
-    except Exception as e: return {"error": str(e)}
-
-# --- FUNCIONES DE NOTIFICACIÓN Y BD ---
-
-def send_fcm_notification(token: str, title: str, body: str, data: dict = None):
-    if not FIREBASE_INITIALIZED or not token: return False
-    try:
-        message = messaging.Message(notification=messaging.Notification(title=title, body=body), data=data or {}, token=token)
-        messaging.send(message)
-        return True
-    except Exception as e:
-        logger.error(f"FCM Error: {e}")
-        return False
+# --- FUNCIONES DE BD ---
 
 def get_db_connection(dbname=None):
-    """Conexión robusta para Docker con reintentos."""
+    """
+    Conexión directa (sin pool) para tareas de arranque y administración, con reintentos acotados.
+    Las peticiones de la API deben usar 'db_pool' a través de 'get_db()'.
+    """
     retry_interval = 3
-    while True:
+    for intento in range(1, DB_CONNECT_RETRIES + 1):
         try:
             conn = psycopg2.connect(
                 host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD,
@@ -250,11 +146,143 @@ def get_db_connection(dbname=None):
             )
             return conn
         except psycopg2.Error:
-            logger.warning(f"Esperando DB ({DB_HOST})... Reintentando en {retry_interval}s.")
-            time.sleep(retry_interval)
+            logger.warning(f"Esperando DB ({DB_HOST})... intento {intento}/{DB_CONNECT_RETRIES}. Reintentando en {retry_interval}s.")
         except Exception as e:
             logger.error(f"Error inesperado DB: {e}")
-            time.sleep(retry_interval)
+        time.sleep(retry_interval)
+    raise psycopg2.OperationalError(f"No se pudo conectar a la base de datos en {DB_HOST}:{DB_PORT} tras {DB_CONNECT_RETRIES} intentos.")
+
+# --- POOL DE CONEXIONES ---
+
+class PoolTimeoutError(Exception):
+    """Se lanza cuando no hay una conexión libre en el pool dentro del tiempo de espera."""
+    pass
+
+class DatabasePool:
+    """
+    Pool de conexiones acotado sobre psycopg2.
+    - Tamaño máximo fijo (DB_POOL_MAX_SIZE): las peticiones en exceso esperan turno.
+    - Timeout de espera al pedir una conexión (DB_POOL_TIMEOUT) en lugar de reintentar para siempre.
+    - Health check al entregar una conexión que lleva tiempo ociosa.
+    - Estadísticas (en uso, ociosas, tiempos de espera) para monitoreo.
+    """
+    def __init__(self, minconn: int, maxconn: int, timeout: float, healthcheck_idle: float, **conn_kwargs):
+        self.minconn = minconn
+        self.maxconn = maxconn
+        self.timeout = timeout
+        self.healthcheck_idle = healthcheck_idle
+        self.conn_kwargs = conn_kwargs
+        self._pool = None
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(maxconn)
+        self._last_used = {}  # id(conn) -> momento en que volvió al pool (solo las ociosas)
+        self._en_uso = 0
+        self._stats = {
+            "checkouts": 0, "timeouts": 0, "healthcheck_failures": 0,
+            "wait_time_total_ms": 0.0, "wait_time_max_ms": 0.0,
+        }
+
+    def _ensure_pool(self):
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = psycopg2.pool.ThreadedConnectionPool(self.minconn, self.maxconn, **self.conn_kwargs)
+                    logger.info(f"Pool de conexiones creado (min={self.minconn}, max={self.maxconn}).")
+        return self._pool
+
+    def _is_healthy(self, conn) -> bool:
+        if conn.closed:
+            return False
+        last_used = self._last_used.pop(id(conn), 0)
+        if time.monotonic() - last_used < self.healthcheck_idle:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT 1")
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def getconn(self):
+        pool = self._ensure_pool()
+        inicio = time.monotonic()
+        if not self._slots.acquire(timeout=self.timeout):
+            with self._lock: self._stats["timeouts"] += 1
+            raise PoolTimeoutError(f"No hay conexiones libres en el pool tras {self.timeout}s (max={self.maxconn}).")
+        try:
+            # Tras un corte pueden estar caídas todas las ociosas: se descartan hasta dar con una
+            # sana. Agotadas las ociosas, el pool abre conexiones nuevas; si también fallan, error.
+            for _ in range(self.maxconn + 1):
+                conn = pool.getconn()
+                if self._is_healthy(conn):
+                    break
+                with self._lock: self._stats["healthcheck_failures"] += 1
+                logger.warning("Conexión del pool no saludable. Reemplazándola por una nueva.")
+                pool.putconn(conn, close=True)
+            else:
+                raise psycopg2.OperationalError("No se pudo obtener una conexión sana del pool.")
+        except Exception:
+            self._slots.release()
+            raise
+        espera_ms = (time.monotonic() - inicio) * 1000
+        with self._lock:
+            self._en_uso += 1
+            self._stats["checkouts"] += 1
+            self._stats["wait_time_total_ms"] += espera_ms
+            self._stats["wait_time_max_ms"] = max(self._stats["wait_time_max_ms"], espera_ms)
+        return conn
+
+    def putconn(self, conn):
+        try:
+            descartar = bool(conn.closed)
+            if not descartar:
+                try:
+                    # Nunca devolvemos al pool una conexión con una transacción a medias.
+                    if conn.get_transaction_status() != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                        conn.rollback()
+                    if conn.autocommit:
+                        conn.autocommit = False
+                except psycopg2.Error:
+                    descartar = True
+            if not descartar:
+                self._last_used[id(conn)] = time.monotonic()
+            self._pool.putconn(conn, close=descartar)
+        finally:
+            with self._lock: self._en_uso -= 1
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn = self.getconn()
+        try:
+            yield conn
+        finally:
+            self.putconn(conn)
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            en_uso = self._en_uso
+        stats.update({
+            "max_size": self.maxconn,
+            "in_use": en_uso,
+            # Ociosas ya usadas alguna vez (las min iniciales cuentan desde su primer uso)
+            "idle": len(self._last_used),
+            "wait_time_avg_ms": round(stats["wait_time_total_ms"] / stats["checkouts"], 3) if stats["checkouts"] else 0.0,
+        })
+        return stats
+
+    def closeall(self):
+        if self._pool is not None and not self._pool.closed:
+            self._pool.closeall()
+            logger.info("Pool de conexiones cerrado.")
+
+db_pool = DatabasePool(
+    DB_POOL_MIN_SIZE, DB_POOL_MAX_SIZE, DB_POOL_TIMEOUT, DB_POOL_HEALTHCHECK_IDLE,
+    host=DB_HOST, port=DB_PORT, user=DB_USER, password=DB_PASSWORD,
+    database=DB_NAME, options="-c TimeZone=America/Caracas"
+)
 
 def db_exists():
     conn_admin = None
@@ -272,13 +300,8 @@ def get_db():
     """
     Dependencia de FastAPI que gestiona el ciclo de vida de la conexión a la base de datos.
     """
-    conn = None
-    try:
-        conn = get_db_connection()
+    with db_pool.connection() as conn:
         yield conn
-    finally:
-        if conn:
-            conn.close()
 
 def create_db_if_not_exists():
     if not db_exists():
@@ -291,146 +314,27 @@ def create_db_if_not_exists():
         finally: conn_admin.close()
 
 def create_tables_if_not_exist():
-    """Define y crea todas las tablas necesarias."""
-    commands = (
-    "CREATE TABLE IF NOT EXISTS usuarios (id_usuario VARCHAR(255) PRIMARY KEY, nombre_display VARCHAR(255), ultima_latitud DOUBLE PRECISION, ultima_longitud DOUBLE PRECISION, ultima_actualizacion_loc TIMESTAMP WITH TIME ZONE, estado_actual VARCHAR(50) DEFAULT 'Disponible', porcentaje_comision DOUBLE PRECISION DEFAULT 0.0, ultima_bateria_porcentaje INTEGER, fcm_token TEXT);",
-    "CREATE TABLE IF NOT EXISTS comercios (id_comercio VARCHAR(255) PRIMARY KEY, nombre VARCHAR(255) NOT NULL, direccion TEXT, latitud DOUBLE PRECISION, longitud DOUBLE PRECISION, numero_contacto VARCHAR(50));",
-    """CREATE TABLE IF NOT EXISTS pedidos (
-        id SERIAL PRIMARY KEY,
-        pedido TEXT NOT NULL,
-        direccion_entrega TEXT NOT NULL,
-        latitud_entrega DOUBLE PRECISION NOT NULL,
-        longitud_entrega DOUBLE PRECISION NOT NULL,
-        latitud_retiro DOUBLE PRECISION NOT NULL,
-        longitud_retiro DOUBLE PRECISION NOT NULL,
-        estado VARCHAR(50) DEFAULT 'pendiente',
-        estado_previo_novedad VARCHAR(50),
-        fecha_creacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        fecha_actualizacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-        detalles TEXT,
-        telefono_contacto VARCHAR(50),
-        telefono_comercio VARCHAR(50),
-        link_maps TEXT,
-        id_comercio VARCHAR(255) NOT NULL,
-        costo_servicio DOUBLE PRECISION,
-        repartidor_id VARCHAR(255),
-        tiene_ticket_abierto BOOLEAN DEFAULT FALSE,
-        tipo_vehiculo VARCHAR(20) NOT NULL,
-        creado_por_usuario_id VARCHAR(255),
-        FOREIGN KEY (repartidor_id) REFERENCES usuarios(id_usuario) ON DELETE SET NULL,
-        FOREIGN KEY (id_comercio) REFERENCES comercios(id_comercio) ON DELETE CASCADE
-    );""",
-    """
-    CREATE TABLE IF NOT EXISTS admin_users (
-        uid VARCHAR(255) PRIMARY KEY,
-        email VARCHAR(255) NOT NULL UNIQUE,
-        display_name VARCHAR(255),
-        role VARCHAR(50) DEFAULT 'viewer',
-        is_disabled BOOLEAN DEFAULT FALSE,
-        created_at TIMESTAMPTZ DEFAULT NOW(),
-        updated_at TIMESTAMPTZ DEFAULT NOW()
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS restricted_zones (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(100) NOT NULL,
-        is_active BOOLEAN DEFAULT TRUE,
-        -- Guardaremos las coordenadas del polígono como un array de puntos en JSONB
-        -- Ejemplo: [[-66.90, 10.48], [-66.88, 10.48], [-66.88, 10.46], [-66.90, 10.46]]
-        polygon_coords JSONB NOT NULL,
-        -- Horarios en formato 24h (ej: '08:00', '22:30')
-        restricted_from TIME, -- Puede ser NULL si está prohibido 24/7
-        restricted_to TIME,   -- Puede ser NULL si está prohibido 24/7
-        created_at TIMESTAMPTZ DEFAULT NOW(),
-        updated_at TIMESTAMPTZ DEFAULT NOW()
-    );
-    """,
-    "CREATE TABLE IF NOT EXISTS ubicaciones_log (id_log SERIAL PRIMARY KEY, id_usuario VARCHAR(255) NOT NULL, latitud DOUBLE PRECISION NOT NULL, longitud DOUBLE PRECISION NOT NULL, timestamp TIMESTAMP WITH TIME ZONE NOT NULL, FOREIGN KEY (id_usuario) REFERENCES usuarios(id_usuario) ON DELETE CASCADE);",
-    "CREATE TABLE IF NOT EXISTS tickets (id_ticket SERIAL PRIMARY KEY, id_pedido INTEGER NOT NULL, id_usuario_creador VARCHAR(255) NOT NULL, estado_ticket VARCHAR(50) DEFAULT 'abierto', fecha_creacion_ticket TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, asunto_ticket TEXT, FOREIGN KEY (id_pedido) REFERENCES pedidos(id) ON DELETE CASCADE, FOREIGN KEY (id_usuario_creador) REFERENCES usuarios(id_usuario) ON DELETE CASCADE);",
-    "CREATE TABLE IF NOT EXISTS mensajes_ticket (id_mensaje SERIAL PRIMARY KEY, id_ticket INTEGER NOT NULL, id_remitente VARCHAR(255) NOT NULL, tipo_remitente VARCHAR(50) NOT NULL, contenido_mensaje TEXT, nombre_archivo_adjunto VARCHAR(255), timestamp_mensaje TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (id_ticket) REFERENCES tickets(id_ticket) ON DELETE CASCADE);",
-    "CREATE TABLE IF NOT EXISTS pedidos_logs (log_id SERIAL PRIMARY KEY, id_pedido INTEGER NOT NULL, repartidor_id VARCHAR(255), estado_registrado VARCHAR(50) NOT NULL, latitud DOUBLE PRECISION, longitud DOUBLE PRECISION, timestamp_log TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (id_pedido) REFERENCES pedidos(id) ON DELETE CASCADE);",
-    "CREATE TABLE IF NOT EXISTS integraciones (pedido_id INTEGER PRIMARY KEY, id_externo VARCHAR(255) NOT NULL, fecha_creacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (pedido_id) REFERENCES pedidos(id) ON DELETE CASCADE);",
-    "CREATE TABLE IF NOT EXISTS system_logs (id SERIAL PRIMARY KEY, nivel VARCHAR(20) NOT NULL, accion VARCHAR(100) NOT NULL, usuario_responsable VARCHAR(255), detalles JSONB, timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
-    "CREATE TABLE IF NOT EXISTS app_config (clave VARCHAR(100) PRIMARY KEY, valor JSONB NOT NULL, updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
-    "CREATE TABLE IF NOT EXISTS pedidos_programados (id SERIAL PRIMARY KEY, payload_pedido JSONB NOT NULL, fecha_liberacion TIMESTAMP WITH TIME ZONE NOT NULL, estado VARCHAR(50) DEFAULT 'pendiente', fecha_creacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
-    """
-    CREATE TABLE IF NOT EXISTS integration_configs (
-        id SERIAL PRIMARY KEY,
-        name VARCHAR(100) NOT NULL UNIQUE,
-        is_active BOOLEAN DEFAULT TRUE,
-        id_externo_prefix VARCHAR(50) NOT NULL,
-        webhooks JSONB,
-        created_at TIMESTAMPTZ DEFAULT NOW(),
-        updated_at TIMESTAMPTZ DEFAULT NOW()
-    );
-    """,
-    """
-    CREATE TABLE IF NOT EXISTS api_keys (
-        id SERIAL PRIMARY KEY,
-        hashed_key VARCHAR(255) NOT NULL UNIQUE,
-        prefix VARCHAR(8) NOT NULL,
-        client_name VARCHAR(100) NOT NULL,
-        is_active BOOLEAN DEFAULT TRUE,
-        created_at TIMESTAMPTZ DEFAULT NOW(),
-        last_used_at TIMESTAMPTZ
-    );
-    """,
-
-    # --- Bloque de Migración para asegurar la consistencia del esquema ---
-    """
-    DO $$
-    BEGIN
-        -- Asegurar que la columna 'fecha_actualizacion' exista en 'pedidos'
-        IF NOT EXISTS (SELECT 1 FROM information_schema.columns WHERE table_name='pedidos' AND column_name='fecha_actualizacion') THEN
-            ALTER TABLE pedidos ADD COLUMN fecha_actualizacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;
-        END IF;
-
-        -- Eliminar la restricción UNIQUE de 'id_externo_prefix' en integration_configs si existe
-        IF EXISTS (SELECT 1 FROM information_schema.table_constraints WHERE constraint_name='integration_configs_id_externo_prefix_key') THEN
-            ALTER TABLE integration_configs DROP CONSTRAINT integration_configs_id_externo_prefix_key;
-        END IF;
-
-        -- Eliminar la restricción UNIQUE de 'prefix' en api_keys si existe
-        IF EXISTS (SELECT 1 FROM information_schema.table_constraints WHERE constraint_name='api_keys_prefix_key') THEN
-            ALTER TABLE api_keys DROP CONSTRAINT api_keys_prefix_key;
-        END IF;
-    END $$;
-    """,
-
-    # --- Índices para optimizar búsquedas ---
-    "CREATE INDEX IF NOT EXISTS idx_integration_configs_prefix ON integration_configs(id_externo_prefix);",
-    "CREATE INDEX IF NOT EXISTS idx_integraciones_id_externo ON integraciones(id_externo);",
-    "CREATE INDEX IF NOT EXISTS idx_api_keys_prefix ON api_keys(prefix);"
-)
+    """Crea/actualiza el esquema aplicando las migraciones pendientes (ver migrations.py)."""
     conn = get_db_connection()
-    conn.autocommit = True
     try:
-        with conn.cursor() as cur:
-            for c in commands: cur.execute(c)
+        run_migrations(conn)
+        preparar_postgis(conn)
+        mantener_particiones(conn)
         logger.info("Tablas verificadas/creadas exitosamente.")
     except psycopg2.Error as e:
         logger.error(f"Error al crear/verificar tablas: {e}")
     finally:
         conn.close()
 
+def ejecutar_mantenimiento_particiones():
+    """Tarea periódica del planificador: particiones futuras y retención (ver partitions.py)."""
+    with db_pool.connection() as conn:
+        mantener_particiones(conn)
+
 def init_database():
     """Función principal para inicializar la base de datos y las tablas."""
     create_db_if_not_exists()
     create_tables_if_not_exist()
 
-def haversine(lat1, lon1, lat2, lon2):
-    """Calcula la distancia en línea recta (Haversine) entre dos puntos en kilómetros."""
-    R = 6371 # Radio de la Tierra en km
-    if None in [lat1, lon1, lat2, lon2]: return float('inf') 
-    try:
-        lat1_r, lon1_r, lat2_r, lon2_r = map(radians, [float(lat1), float(lon1), float(lat2), float(lon2)])
-        dlon = lon2_r - lon1_r
-        dlat = lat2_r - lat1_r
-        a = sin(dlat / 2)**2 + cos(lat1_r) * cos(lat2_r) * sin(dlon / 2)**2
-        return R * 2 * atan2(sqrt(a), sqrt(1 - a))
-    except ValueError:
-        return float('inf')
-
 if __name__ == "__main__":
     init_database()
\ No newline at end of file
@@ -0,0 +1,218 @@
+import asyncio
+import logging
+import os
+import time
+
+import numpy as np
+
+from async_db import async_db
+from driver_geo import DRIVER_AVAILABLE_STATES, DRIVER_GEO_STALE_SECONDS, DRIVER_MIN_BATTERY
+from geo import haversine_muchos_a_muchos
+
+logger = logging.getLogger(__name__)
+
+try:
+    from scipy.optimize import linear_sum_assignment
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
+# --- DESPACHO AUTOMÁTICO POR LOTES ---
+# Cada DISPATCH_TICK_SECONDS se toman los pedidos pendientes que ningún repartidor aceptó
+# desde el radar (/pedidos/cercanos) y los repartidores libres, se arma una matriz de costos
+# y se resuelve la asignación de todos a la vez. Cada par se aplica por el mismo camino que
+# la asignación manual (estado 'asignado', push FCM, WebSocket y webhooks).
+
+DISPATCH_ENABLED = os.getenv("DISPATCH_ENABLED", "false").lower() == "true"
+DISPATCH_TICK_SECONDS = int(os.getenv("DISPATCH_TICK_SECONDS", 15))
+DISPATCH_SOLVER = os.getenv("DISPATCH_SOLVER", "auto")  # auto | hungarian | greedy
+# Espera antes de despachar: el radar llega a su radio máximo a los 30s
+DISPATCH_MIN_ORDER_AGE_SECONDS = int(os.getenv("DISPATCH_MIN_ORDER_AGE_SECONDS", 30))
+DISPATCH_MAX_KM = float(os.getenv("DISPATCH_MAX_KM", 5.0))  # Más lejos no se asigna
+DISPATCH_MAX_ORDERS = int(os.getenv("DISPATCH_MAX_ORDERS", 500))
+DISPATCH_MAX_DRIVERS = int(os.getenv("DISPATCH_MAX_DRIVERS", 500))
+DISPATCH_APPLY_CONCURRENCY = int(os.getenv("DISPATCH_APPLY_CONCURRENCY", 5))
+# Pesos del costo, en km equivalentes
+DISPATCH_AGE_WEIGHT_KM_PER_MIN = float(os.getenv("DISPATCH_AGE_WEIGHT_KM_PER_MIN", 0.5))  # Prioriza los pedidos que más esperan
+DISPATCH_BATTERY_WEIGHT_KM = float(os.getenv("DISPATCH_BATTERY_WEIGHT_KM", 2.0))  # Penaliza repartidores con poca batería
+
+_INFACTIBLE = 1e9
+
+_PEDIDOS_QUERY = """
+    SELECT id, latitud_retiro, longitud_retiro, tipo_vehiculo, EXTRACT(EPOCH FROM (NOW() - fecha_creacion)) AS edad_segundos
+    FROM pedidos
+    WHERE estado = 'pendiente' AND repartidor_id IS NULL
+    AND latitud_retiro IS NOT NULL AND longitud_retiro IS NOT NULL
+    AND fecha_creacion <= NOW() - make_interval(secs => $1)
+    ORDER BY fecha_creacion ASC
+    LIMIT $2
+"""
+
+# Libres = disponibles, con ping reciente, batería suficiente, sin pedido en curso ni ticket abierto
+_REPARTIDORES_QUERY = """
+    SELECT u.id_usuario, u.ultima_latitud, u.ultima_longitud, u.ultima_bateria_porcentaje, u.tipo_vehiculo
+    FROM usuarios u
+    WHERE lower(u.estado_actual) = ANY($1::text[])
+    AND u.ultima_actualizacion_loc >= NOW() - make_interval(secs => $2)
+    AND u.ultima_latitud IS NOT NULL AND u.ultima_longitud IS NOT NULL
+    AND (u.ultima_bateria_porcentaje IS NULL OR u.ultima_bateria_porcentaje >= $3)
+    AND NOT EXISTS (
+        SELECT 1 FROM pedidos p
+        WHERE p.repartidor_id = u.id_usuario
+        AND (p.estado IN ('asignado', 'aceptado', 'retirando', 'llevando') OR p.tiene_ticket_abierto = TRUE)
+    )
+    ORDER BY u.ultima_actualizacion_loc DESC
+    LIMIT $4
+"""
+
+
+def matriz_de_costos(pedidos: list, repartidores: list) -> np.ndarray:
+    """
+    Costo (km equivalentes) de asignar cada pedido (filas) a cada repartidor (columnas):
+    distancia al retiro - espera del pedido + penalización por batería baja.
+    Los pares fuera de DISPATCH_MAX_KM o con vehículo incompatible valen _INFACTIBLE.
+    """
+    distancias = haversine_muchos_a_muchos(
+        [p["latitud_retiro"] for p in pedidos], [p["longitud_retiro"] for p in pedidos],
+        [r["ultima_latitud"] for r in repartidores], [r["ultima_longitud"] for r in repartidores],
+    )
+    espera_min = np.array([float(p["edad_segundos"]) for p in pedidos]) / 60
+    # Batería desconocida: sin penalización (no se trata como 0 %)
+    bateria = np.array([
+        100 if r["ultima_bateria_porcentaje"] is None else r["ultima_bateria_porcentaje"] for r in repartidores
+    ], dtype=np.float64)
+    costos = (
+        distancias
+        - DISPATCH_AGE_WEIGHT_KM_PER_MIN * espera_min[:, None]
+        + DISPATCH_BATTERY_WEIGHT_KM * (1 - bateria / 100)[None, :]
+    )
+
+    # Un repartidor sin tipo de vehículo registrado puede llevar cualquier pedido
+    tipos_pedido = np.array([p["tipo_vehiculo"] or "" for p in pedidos], dtype=object)
+    tipos_repartidor = np.array([r["tipo_vehiculo"] or "" for r in repartidores], dtype=object)
+    incompatible = (tipos_repartidor[None, :] != "") & (tipos_pedido[:, None] != tipos_repartidor[None, :])
+    costos[(distancias > DISPATCH_MAX_KM) | incompatible] = _INFACTIBLE
+    return costos
+
+
+def resolver_greedy(costos: np.ndarray) -> list:
+    """Recorre los pares factibles del más barato al más caro. O(N·M log(N·M))."""
+    filas, columnas = np.nonzero(costos < _INFACTIBLE)
+    orden = np.argsort(costos[filas, columnas], kind="stable")
+    fila_usada = np.zeros(costos.shape[0], dtype=bool)
+    columna_usada = np.zeros(costos.shape[1], dtype=bool)
+    pares = []
+    for i, j in zip(filas[orden], columnas[orden]):
+        if not fila_usada[i] and not columna_usada[j]:
+            fila_usada[i] = columna_usada[j] = True
+            pares.append((int(i), int(j)))
+    return pares
+
+
+def resolver_hungaro(costos: np.ndarray) -> list:
+    """Asignación de costo total mínimo (scipy). Descarta los pares infactibles que el solver fuerce."""
+    filas, columnas = linear_sum_assignment(costos)
+    return [(int(i), int(j)) for i, j in zip(filas, columnas) if costos[i, j] < _INFACTIBLE]
+
+
+def solver_activo() -> str:
+    if DISPATCH_SOLVER == "greedy" or not SCIPY_AVAILABLE:
+        return "greedy"
+    return "hungarian"
+
+
+def resolver(costos: np.ndarray) -> list:
+    if DISPATCH_SOLVER == "hungarian" and not SCIPY_AVAILABLE:
+        logger.warning("DISPATCH_SOLVER=hungarian pero scipy no está instalado. Usando greedy.")
+    return resolver_hungaro(costos) if solver_activo() == "hungarian" else resolver_greedy(costos)
+
+
+class DispatchEngine:
+    def __init__(self, db):
+        self.db = db
+        self._stats = {
+            "ticks": 0, "assigned_total": 0, "conflicts": 0, "errors": 0,
+            "last_orders": 0, "last_drivers": 0, "last_assigned": 0, "last_solve_ms": 0.0, "last_tick_ms": 0.0,
+        }
+
+    async def tick(self, asignar):
+        """
+        Un ciclo de despacho. 'asignar(pedido_id, repartidor_id)' es la corrutina que aplica
+        una asignación (la misma lógica que POST /pedidos/{id}/asignar); devuelve False si el
+        pedido o el repartidor dejaron de estar libres desde la consulta.
+        """
+        inicio = time.monotonic()
+        self._stats["ticks"] += 1
+        async with self.db.connection() as conn:
+            pedidos = await conn.fetch(_PEDIDOS_QUERY, DISPATCH_MIN_ORDER_AGE_SECONDS, DISPATCH_MAX_ORDERS)
+            repartidores = await conn.fetch(
+                _REPARTIDORES_QUERY, list(DRIVER_AVAILABLE_STATES), DRIVER_GEO_STALE_SECONDS, DRIVER_MIN_BATTERY, DISPATCH_MAX_DRIVERS
+            ) if pedidos else []
+        self._stats["last_orders"], self._stats["last_drivers"] = len(pedidos), len(repartidores)
+        pares = []
+        if pedidos and repartidores:
+            inicio_solver = time.monotonic()
+            pares = resolver(matriz_de_costos(pedidos, repartidores))
+            self._stats["last_solve_ms"] = round((time.monotonic() - inicio_solver) * 1000, 3)
+
+        limite = asyncio.Semaphore(DISPATCH_APPLY_CONCURRENCY)
+
+        async def aplicar(i, j) -> bool:
+            async with limite:
+                try:
+                    if await asignar(pedidos[i]["id"], repartidores[j]["id_usuario"]):
+                        return True
+                    # Lo normal es que el pedido haya sido aceptado desde el radar mientras tanto
+                    self._stats["conflicts"] += 1
+                    logger.info(f"Despacho: el pedido {pedidos[i]['id']} o {repartidores[j]['id_usuario']} ya no está libre, se omite.")
+                    return False
+                except Exception as e:
+                    self._stats["conflicts" if getattr(e, "status_code", None) else "errors"] += 1
+                    logger.info(f"Despacho: no se asignó el pedido {pedidos[i]['id']} a {repartidores[j]['id_usuario']}: {e!r}")
+                    return False
+
+        asignados = sum(await asyncio.gather(*(aplicar(i, j) for i, j in pares)))
+        self._stats["last_assigned"] = asignados
+        self._stats["assigned_total"] += asignados
+        duracion = time.monotonic() - inicio
+        self._stats["last_tick_ms"] = round(duracion * 1000, 3)
+        if pares:
+            logger.info(f"Despacho: {asignados}/{len(pares)} asignaciones ({len(pedidos)} pedidos, {len(repartidores)} repartidores, {duracion * 1000:.0f} ms).")
+        if duracion > DISPATCH_TICK_SECONDS:
+            logger.warning(f"El ciclo de despacho tardó {duracion:.1f}s, más que DISPATCH_TICK_SECONDS={DISPATCH_TICK_SECONDS}.")
+
+    def stats(self) -> dict:
+        return {**self._stats, "enabled": DISPATCH_ENABLED, "solver": solver_activo(), "tick_seconds": DISPATCH_TICK_SECONDS}
+
+
+dispatch_engine = DispatchEngine(async_db)
+
+
+if __name__ == "__main__":
+    # Benchmark de los solvers con N pedidos x M repartidores alrededor de Caracas
+    # (uso: python dispatch.py [pedidos] [repartidores])
+    import random
+    import sys
+
+    n, m = (int(a) for a in (sys.argv[1:] + ["300", "300"][len(sys.argv) - 1:])[:2])
+    random.seed(5)
+    pedidos = [{
+        "latitud_retiro": random.uniform(10.40, 10.55), "longitud_retiro": random.uniform(-67.00, -66.75),
+        "tipo_vehiculo": random.choice(["moto", "moto", "moto", "carro"]), "edad_segundos": random.uniform(30, 900),
+    } for _ in range(n)]
+    repartidores = [{
+        "ultima_latitud": random.uniform(10.40, 10.55), "ultima_longitud": random.uniform(-67.00, -66.75),
+        "ultima_bateria_porcentaje": random.randint(15, 100), "tipo_vehiculo": random.choice([None, "moto", "carro"]),
+    } for _ in range(m)]
+
+    inicio = time.perf_counter()
+    costos = matriz_de_costos(pedidos, repartidores)
+    t_matriz = time.perf_counter() - inicio
+    print(f"{n} pedidos x {m} repartidores, matriz de costos: {t_matriz * 1000:.1f} ms")
+    solvers = [("greedy", resolver_greedy)] + ([("hungarian", resolver_hungaro)] if SCIPY_AVAILABLE else [])
+    for nombre, solver in solvers:
+        inicio = time.perf_counter()
+        pares = solver(costos)
+        duracion = time.perf_counter() - inicio
+        total = sum(costos[i, j] for i, j in pares)
+        print(f"{nombre:>9}: {duracion * 1000:8.1f} ms, {len(pares)} asignaciones, costo total {total:.1f}")
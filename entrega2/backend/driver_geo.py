@@ -0,0 +1,156 @@
+import logging
+import os
+import time
+
+from database import get_redis_client
+from geo import haversine_uno_a_muchos
+
+logger = logging.getLogger(__name__)
+
+# --- ÍNDICE GEO DE REPARTIDORES DISPONIBLES (REDIS) ---
+# /ubicaciones mantiene, además del hash 'driver:{id}', un GEO set con los repartidores
+# disponibles y un sorted set con la hora de su último ping. Buscar los k más cercanos a
+# un punto es un GEOSEARCH en Redis en lugar de recorrer la tabla 'usuarios'.
+# Los repartidores que dejan de enviar pings salen del índice por antigüedad.
+
+DRIVERS_GEO_KEY = "drivers:disponibles:geo"
+DRIVERS_SEEN_KEY = "drivers:disponibles:visto"  # score = epoch del último ping
+DRIVER_GEO_STALE_SECONDS = int(os.getenv("DRIVER_GEO_STALE_SECONDS", 300))
+DRIVER_AVAILABLE_STATES = {e.strip().lower() for e in os.getenv("DRIVER_AVAILABLE_STATES", "disponible").split(",") if e.strip()}
+DRIVER_MIN_BATTERY = 15  # Con menos batería el repartidor no recibe pedidos
+# Candidatos extra que se piden a GEOSEARCH para compensar los que se descartan después
+DRIVER_SEARCH_OVERFETCH = 3
+
+_stats = {"searches": 0, "fallback_searches": 0, "purged": 0, "errors": 0}
+
+
+def esta_disponible(estado) -> bool:
+    return (estado or "").strip().lower() in DRIVER_AVAILABLE_STATES
+
+
+def registrar_ubicacion(r, id_usuario: str, lat: float, lng: float, estado, bateria, ts: str):
+    """Hash del repartidor + alta o baja en el GEO set, en un único viaje a Redis."""
+    pipe = r.pipeline(transaction=False)
+    datos = {"lat": lat, "lng": lng, "estado": estado, "ts": ts}
+    # Batería desconocida: el campo no se guarda (no es 0 %, el repartidor sigue elegible)
+    if bateria is None:
+        pipe.hdel(f"driver:{id_usuario}", "bat")
+    else:
+        datos["bat"] = bateria
+    pipe.hset(f"driver:{id_usuario}", mapping=datos)
+    pipe.expire(f"driver:{id_usuario}", 3600)
+    if esta_disponible(estado):
+        pipe.geoadd(DRIVERS_GEO_KEY, (lng, lat, id_usuario))
+        pipe.zadd(DRIVERS_SEEN_KEY, {id_usuario: time.time()})
+    else:
+        pipe.zrem(DRIVERS_GEO_KEY, id_usuario)
+        pipe.zrem(DRIVERS_SEEN_KEY, id_usuario)
+    pipe.execute()
+
+
+def leer_hashes(ids: list) -> list:
+    """Hash 'driver:{id}' de cada repartidor en un único pipeline ({} si no hay). None por id si no hay Redis."""
+    r = get_redis_client()
+    if not r or not ids:
+        return [None] * len(ids)
+    try:
+        pipe = r.pipeline(transaction=False)
+        for id_usuario in ids:
+            pipe.hgetall(f"driver:{id_usuario}")
+        return pipe.execute()
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.warning(f"No se pudieron leer las posiciones de Redis: {e!r}")
+        return [None] * len(ids)
+
+
+def purgar_inactivos() -> int:
+    """Saca del índice a los repartidores sin pings en DRIVER_GEO_STALE_SECONDS (tarea periódica)."""
+    r = get_redis_client()
+    if not r:
+        return 0
+    try:
+        inactivos = r.zrangebyscore(DRIVERS_SEEN_KEY, "-inf", time.time() - DRIVER_GEO_STALE_SECONDS)
+        if inactivos:
+            pipe = r.pipeline(transaction=False)
+            pipe.zrem(DRIVERS_GEO_KEY, *inactivos)
+            pipe.zrem(DRIVERS_SEEN_KEY, *inactivos)
+            pipe.execute()
+            _stats["purged"] += len(inactivos)
+        return len(inactivos)
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.warning(f"No se pudo purgar el índice GEO de repartidores: {e!r}")
+        return 0
+
+
+def buscar_cercanos(r, lat: float, lng: float, k: int, radio_km: float) -> list:
+    """
+    Repartidores disponibles, con ping reciente y batería suficiente (o desconocida), del más
+    cercano al más lejano (hasta k * DRIVER_SEARCH_OVERFETCH). Cada uno: id_usuario,
+    distancia_km, latitud, longitud, bateria_porcentaje (None si no se reportó), estado,
+    ultima_actualizacion.
+    """
+    _stats["searches"] += 1
+    encontrados = r.geosearch(
+        DRIVERS_GEO_KEY, longitude=lng, latitude=lat, radius=radio_km, unit="km",
+        sort="ASC", count=k * DRIVER_SEARCH_OVERFETCH, withdist=True, withcoord=True,
+    )
+    if not encontrados:
+        return []
+    ids = [e[0] for e in encontrados]
+    pipe = r.pipeline(transaction=False)
+    pipe.zmscore(DRIVERS_SEEN_KEY, ids)
+    for id_usuario in ids:
+        pipe.hgetall(f"driver:{id_usuario}")
+    vistos, *hashes = pipe.execute()
+
+    limite = time.time() - DRIVER_GEO_STALE_SECONDS
+    candidatos = []
+    for (id_usuario, distancia, (lng_d, lat_d)), visto, datos in zip(encontrados, vistos, hashes):
+        # El índice puede ir por detrás del hash (purga periódica): se revalida aquí
+        if visto is None or visto < limite or not datos or not esta_disponible(datos.get("estado")):
+            continue
+        bateria = int(float(datos["bat"])) if datos.get("bat") not in (None, "") else None
+        if bateria is not None and bateria < DRIVER_MIN_BATTERY:
+            continue
+        candidatos.append({
+            "id_usuario": id_usuario, "distancia_km": round(float(distancia), 3),
+            "latitud": float(lat_d), "longitud": float(lng_d),
+            "bateria_porcentaje": bateria, "estado": datos.get("estado"), "ultima_actualizacion": datos.get("ts"),
+        })
+    return candidatos
+
+
+async def buscar_cercanos_sql(db, lat: float, lng: float, k: int, radio_km: float) -> list:
+    """Alternativa sin Redis: última posición conocida en 'usuarios', mismos filtros y formato."""
+    _stats["fallback_searches"] += 1
+    filas = await db.fetch("""
+        SELECT id_usuario, ultima_latitud, ultima_longitud, estado_actual, ultima_bateria_porcentaje, ultima_actualizacion_loc
+        FROM usuarios
+        WHERE lower(estado_actual) = ANY($1::text[])
+        AND ultima_actualizacion_loc >= NOW() - make_interval(secs => $2)
+        AND ultima_latitud IS NOT NULL AND ultima_longitud IS NOT NULL
+        AND (ultima_bateria_porcentaje IS NULL OR ultima_bateria_porcentaje >= $3)
+    """, list(DRIVER_AVAILABLE_STATES), DRIVER_GEO_STALE_SECONDS, DRIVER_MIN_BATTERY)
+    if not filas:
+        return []
+    distancias = haversine_uno_a_muchos(lat, lng, [f["ultima_latitud"] for f in filas], [f["ultima_longitud"] for f in filas])
+    orden = [i for i in distancias.argsort() if distancias[i] <= radio_km][:k * DRIVER_SEARCH_OVERFETCH]
+    return [{
+        "id_usuario": filas[i]["id_usuario"], "distancia_km": round(float(distancias[i]), 3),
+        "latitud": filas[i]["ultima_latitud"], "longitud": filas[i]["ultima_longitud"],
+        "bateria_porcentaje": filas[i]["ultima_bateria_porcentaje"], "estado": filas[i]["estado_actual"],
+        "ultima_actualizacion": filas[i]["ultima_actualizacion_loc"].isoformat(),
+    } for i in orden]
+
+
+def driver_geo_stats() -> dict:
+    stats = {**_stats, "stale_seconds": DRIVER_GEO_STALE_SECONDS, "indexed_drivers": None}
+    r = get_redis_client()
+    if r:
+        try:
+            stats["indexed_drivers"] = r.zcard(DRIVERS_GEO_KEY)
+        except Exception:
+            pass
+    return stats
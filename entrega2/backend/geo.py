@@ -0,0 +1,101 @@
+import math
+
+import numpy as np
+
+# --- DISTANCIAS GEOGRÁFICAS (HAVERSINE) ---
+# Única implementación de haversine del backend. Todas las funciones reciben (lat, lon)
+# en grados y devuelven kilómetros. Las versiones vectorizadas aceptan listas o arreglos
+# NumPy; una coordenada ausente (None/NaN) da distancia infinita, igual que la escalar.
+
+RADIO_TIERRA_KM = 6371.0
+FACTOR_CALLE = 1.4  # Corrección de línea recta a distancia aproximada por calle
+
+
+def haversine_km(lat1, lon1, lat2, lon2) -> float:
+    """Distancia entre dos puntos. Para un solo par es más rápida que las versiones NumPy."""
+    if None in (lat1, lon1, lat2, lon2):
+        return float('inf')
+    try:
+        lat1, lon1, lat2, lon2 = map(math.radians, (float(lat1), float(lon1), float(lat2), float(lon2)))
+    except (TypeError, ValueError):
+        return float('inf')
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+    return RADIO_TIERRA_KM * 2 * math.asin(math.sqrt(min(a, 1.0)))
+
+
+def _a_radianes(valores) -> np.ndarray:
+    return np.radians(np.asarray(valores, dtype=np.float64))
+
+
+def _haversine(lat1, lon1, lat2, lon2) -> np.ndarray:
+    """Núcleo común (radianes, con broadcasting)."""
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    distancias = RADIO_TIERRA_KM * 2 * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
+    return np.where(np.isnan(distancias), np.inf, distancias)
+
+
+def haversine_uno_a_muchos(lat: float, lon: float, lats, lons) -> np.ndarray:
+    """Distancias desde un punto a N puntos: arreglo de forma (N,)."""
+    return _haversine(
+        math.radians(lat), math.radians(lon), _a_radianes(lats), _a_radianes(lons)
+    )
+
+
+def haversine_muchos_a_muchos(lats1, lons1, lats2, lons2) -> np.ndarray:
+    """Matriz de distancias de N orígenes a M destinos: arreglo de forma (N, M)."""
+    return _haversine(
+        _a_radianes(lats1)[:, None], _a_radianes(lons1)[:, None],
+        _a_radianes(lats2)[None, :], _a_radianes(lons2)[None, :],
+    )
+
+
+if __name__ == "__main__":
+    # Equivalencia con las dos implementaciones escalares anteriores (main.py y database.py)
+    # y comparación de tiempos para el caso del radar (un repartidor contra muchos pedidos).
+    import random
+    import time
+    from math import radians, sin, cos, asin, atan2, sqrt
+
+    def haversine_main(lon1, lat1, lon2, lat2):
+        lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
+        a = sin((lat2 - lat1) / 2) ** 2 + cos(lat1) * cos(lat2) * sin((lon2 - lon1) / 2) ** 2
+        return 2 * asin(sqrt(a)) * 6371
+
+    def haversine_database(lat1, lon1, lat2, lon2):
+        if None in [lat1, lon1, lat2, lon2]: return float('inf')
+        lat1_r, lon1_r, lat2_r, lon2_r = map(radians, [float(lat1), float(lon1), float(lat2), float(lon2)])
+        a = sin((lat2_r - lat1_r) / 2) ** 2 + cos(lat1_r) * cos(lat2_r) * sin((lon2_r - lon1_r) / 2) ** 2
+        return 6371 * 2 * atan2(sqrt(a), sqrt(1 - a))
+
+    random.seed(11)
+    puntos = [(random.uniform(-80, 80), random.uniform(-180, 180)) for _ in range(2000)]
+    puntos += [(10.49, -66.88), (10.49, -66.88), (0.0, 0.0), (0.0, 180.0), (89.9, 10.0), (-89.9, -170.0)]
+    lats = [p[0] for p in puntos]
+    lons = [p[1] for p in puntos]
+    origen = (10.4806, -66.9036)
+
+    esperado_main = np.array([haversine_main(origen[1], origen[0], lon, lat) for lat, lon in puntos])
+    esperado_db = np.array([haversine_database(origen[0], origen[1], lat, lon) for lat, lon in puntos])
+    uno_a_muchos = haversine_uno_a_muchos(origen[0], origen[1], lats, lons)
+    escalar = np.array([haversine_km(origen[0], origen[1], lat, lon) for lat, lon in puntos])
+    assert np.allclose(uno_a_muchos, esperado_main, rtol=1e-12, atol=1e-9), "uno_a_muchos != main.haversine"
+    assert np.allclose(uno_a_muchos, esperado_db, rtol=1e-12, atol=1e-9), "uno_a_muchos != database.haversine"
+    assert np.allclose(escalar, esperado_db, rtol=1e-12, atol=1e-9), "haversine_km != database.haversine"
+    print("uno_a_muchos y haversine_km == main.haversine y database.haversine: OK")
+
+    matriz = haversine_muchos_a_muchos(lats[:300], lons[:300], lats[-200:], lons[-200:])
+    esperado = np.array([[haversine_database(a, b, c, d) for c, d in zip(lats[-200:], lons[-200:])] for a, b in zip(lats[:300], lons[:300])])
+    assert np.allclose(matriz, esperado, rtol=1e-12, atol=1e-9), "muchos_a_muchos != database.haversine"
+    assert haversine_uno_a_muchos(0, 0, [None, 1.0], [1.0, None]).tolist() == [float('inf')] * 2
+    assert haversine_km(None, 0, 0, 0) == float('inf')
+    print("muchos_a_muchos == database.haversine, coordenada ausente -> inf: OK")
+
+    inicio = time.perf_counter()
+    for _ in range(20):
+        [haversine_main(origen[1], origen[0], lon, lat) for lat, lon in puntos]
+    t_escalar = (time.perf_counter() - inicio) / 20
+    inicio = time.perf_counter()
+    for _ in range(20):
+        haversine_uno_a_muchos(origen[0], origen[1], lats, lons)
+    t_vector = (time.perf_counter() - inicio) / 20
+    print(f"{len(puntos)} distancias: escalar {t_escalar * 1000:.2f} ms, vectorizado {t_vector * 1000:.3f} ms ({t_escalar / t_vector:.0f}x)")
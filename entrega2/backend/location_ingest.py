@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import os
+import time
+
+import asyncpg
+
+from async_db import async_db
+
+logger = logging.getLogger(__name__)
+
+# --- INGESTA DE UBICACIONES CON ESCRITURA DIFERIDA (WRITE-BEHIND) ---
+# Los pings GPS se acumulan en memoria y se escriben en bloque cada pocos cientos de ms:
+# un único upsert multi-fila en 'usuarios' (última posición por repartidor) y un COPY
+# en 'ubicaciones_log', dentro de una sola transacción.
+# Las muestras se validan al encolar (un dato inválido se rechaza en su propia petición). Si
+# aun así Postgres rechaza el lote por datos (DataError / restricción), se escribe fila por
+# fila y se descartan solo las inválidas: un error de datos nunca vuelve a la cola.
+# Ante un error de conexión solo vuelven a la cola las muestras aún no escritas, y solo las
+# de modo 'buffered': en modo 'sync' la petición recibe el error y es el cliente quien
+# reintenta (reencolarlas además duplicaría filas en 'ubicaciones_log').
+
+LOCATION_FLUSH_INTERVAL_MS = int(os.getenv("LOCATION_FLUSH_INTERVAL_MS", 250))
+LOCATION_FLUSH_MAX_BATCH = int(os.getenv("LOCATION_FLUSH_MAX_BATCH", 1000))  # Fuerza un flush anticipado al llegar a este tamaño
+LOCATION_QUEUE_MAX = int(os.getenv("LOCATION_QUEUE_MAX", 20000))  # Con la cola llena, los pings esperan al siguiente flush
+# 'buffered': se responde al instante y el ping se persiste en el siguiente flush (se puede perder si el proceso muere).
+# 'sync': la respuesta espera a que el lote que contiene el ping haya hecho commit.
+LOCATION_INGEST_DURABILITY = os.getenv("LOCATION_INGEST_DURABILITY", "buffered")
+# 'off' activa synchronous_commit=off en la transacción del lote (menos fsync, riesgo de perder el último lote ante una caída de Postgres)
+LOCATION_INGEST_SYNC_COMMIT = os.getenv("LOCATION_INGEST_SYNC_COMMIT", "on")
+
+# Límites de las columnas (ver migrations.py): usuarios.id_usuario VARCHAR(255), estado_actual VARCHAR(50)
+_MAX_ID_USUARIO = 255
+_MAX_ESTADO = 50
+_ERRORES_DE_DATOS = (asyncpg.DataError, asyncpg.IntegrityConstraintViolationError)
+
+_UPSERT_USUARIOS = """
+    INSERT INTO usuarios (id_usuario, ultima_latitud, ultima_longitud, ultima_actualizacion_loc, estado_actual, ultima_bateria_porcentaje)
+    SELECT * FROM unnest($1::varchar[], $2::float8[], $3::float8[], $4::timestamptz[], $5::varchar[], $6::int[])
+    ON CONFLICT (id_usuario) DO UPDATE SET
+        ultima_latitud = EXCLUDED.ultima_latitud,
+        ultima_longitud = EXCLUDED.ultima_longitud,
+        ultima_actualizacion_loc = EXCLUDED.ultima_actualizacion_loc,
+        estado_actual = EXCLUDED.estado_actual,
+        ultima_bateria_porcentaje = EXCLUDED.ultima_bateria_porcentaje
+"""
+
+
+class LocationIngestBuffer:
+    def __init__(self, db):
+        self.db = db
+        self._muestras = []  # (id_usuario, latitud, longitud, timestamp, estado, bateria)
+        self._esperando = []  # future de cada muestra en modo 'sync' (None en 'buffered'), en paralelo a _muestras
+        self._hay_datos = asyncio.Event()
+        self._flush_terminado = asyncio.Event()
+        self._tarea = None
+        self._detener = False
+        self._stats = {
+            "received": 0, "flushed_rows": 0, "flushed_batches": 0, "flush_errors": 0, "rejected": 0, "dropped_rows": 0,
+            "backpressure_waits": 0, "last_flush_ms": 0.0, "max_flush_ms": 0.0, "max_queue_depth": 0,
+        }
+
+    def start(self):
+        if self._tarea is None:
+            self._tarea = asyncio.create_task(self._bucle_flush())
+            logger.info(f"Ingesta de ubicaciones iniciada (flush cada {LOCATION_FLUSH_INTERVAL_MS} ms, modo '{LOCATION_INGEST_DURABILITY}').")
+
+    async def stop(self):
+        """Detiene el bucle y escribe lo que quede en memoria."""
+        if self._tarea is not None:
+            # No cancelamos la tarea: un lote a medio escribir se perdería
+            self._detener = True
+            self._hay_datos.set()
+            await self._tarea
+            self._tarea = None
+        await self.flush()
+
+    async def submit(self, id_usuario: str, latitud: float, longitud: float, timestamp, estado: str, bateria: int):
+        """Encola un ping. ValueError si el id de usuario no cabe en la columna (no se encola)."""
+        if not id_usuario or len(id_usuario) > _MAX_ID_USUARIO:
+            self._stats["rejected"] += 1
+            raise ValueError(f"id_usuario inválido (vacío o de más de {_MAX_ID_USUARIO} caracteres)")
+        if estado is not None:
+            estado = estado[:_MAX_ESTADO]
+
+        while len(self._muestras) >= LOCATION_QUEUE_MAX:
+            # Contrapresión: no dejamos crecer la cola sin límite si la BD va lenta
+            self._stats["backpressure_waits"] += 1
+            self._hay_datos.set()
+            self._flush_terminado.clear()
+            await self._flush_terminado.wait()
+
+        futuro = asyncio.get_running_loop().create_future() if LOCATION_INGEST_DURABILITY == "sync" else None
+        self._muestras.append((id_usuario, latitud, longitud, timestamp, estado, bateria))
+        self._esperando.append(futuro)
+        self._stats["received"] += 1
+        self._stats["max_queue_depth"] = max(self._stats["max_queue_depth"], len(self._muestras))
+        if len(self._muestras) >= LOCATION_FLUSH_MAX_BATCH or futuro is not None:
+            self._hay_datos.set()
+
+        if futuro is not None:
+            await futuro
+
+    async def _bucle_flush(self):
+        intervalo = LOCATION_FLUSH_INTERVAL_MS / 1000
+        while not self._detener:
+            try:
+                await asyncio.wait_for(self._hay_datos.wait(), timeout=intervalo)
+            except asyncio.TimeoutError:
+                pass
+            self._hay_datos.clear()
+            if self._muestras:
+                try:
+                    await self.flush()
+                except Exception as e:
+                    # Las muestras vuelven a la cola; se reintenta en el siguiente ciclo
+                    logger.error(f"Error escribiendo lote de ubicaciones: {e!r}")
+                    await asyncio.sleep(intervalo)
+
+    async def flush(self):
+        if not self._muestras:
+            return
+        muestras, self._muestras = self._muestras, []
+        esperando, self._esperando = self._esperando, []
+        inicio = time.monotonic()
+        errores = {}
+        # 'hechas': cuántas muestras (desde el principio) quedaron resueltas, escritas o descartadas
+        hechas, fallo = len(muestras), None
+        try:
+            try:
+                await self._escribir_lote(muestras)
+            except _ERRORES_DE_DATOS as e:
+                logger.warning(f"Lote de ubicaciones rechazado por datos ({e!r}); se escribe fila por fila.")
+                hechas, fallo = await self._escribir_por_fila(muestras, errores)
+            except Exception as e:
+                hechas, fallo = 0, e
+            if fallo is not None:
+                self._reencolar(muestras[hechas:], esperando[hechas:], fallo)
+        finally:
+            self._flush_terminado.set()
+
+        duracion_ms = (time.monotonic() - inicio) * 1000
+        self._stats["flushed_rows"] += hechas - len(errores)
+        self._stats["dropped_rows"] += len(errores)
+        if hechas:
+            self._stats["flushed_batches"] += 1
+            self._stats["last_flush_ms"] = round(duracion_ms, 3)
+            self._stats["max_flush_ms"] = max(self._stats["max_flush_ms"], round(duracion_ms, 3))
+        for i, futuro in enumerate(esperando[:hechas]):
+            if futuro is None or futuro.done():
+                continue
+            if i in errores:
+                futuro.set_exception(ValueError(f"Ubicación rechazada por la base de datos: {errores[i]!r}"))
+            else:
+                futuro.set_result(None)
+        if fallo is not None:
+            raise fallo
+
+    def _reencolar(self, muestras: list, esperando: list, error: Exception):
+        """
+        Error de conexión o de la BD (no de datos) con 'muestras' sin escribir. Las de modo
+        'sync' fallan en su petición y no vuelven; las demás van delante de las nuevas, y si
+        la cola supera LOCATION_QUEUE_MAX se descartan las más antiguas (cuentan en dropped_rows).
+        """
+        self._stats["flush_errors"] += 1
+        reencoladas = []
+        for muestra, futuro in zip(muestras, esperando):
+            if futuro is None:
+                reencoladas.append(muestra)
+            elif not futuro.done():
+                futuro.set_exception(error)
+        cola = reencoladas + self._muestras
+        futuros = [None] * len(reencoladas) + self._esperando
+        exceso = len(cola) - LOCATION_QUEUE_MAX
+        if exceso > 0:
+            for futuro in futuros[:exceso]:
+                if futuro is not None and not futuro.done():
+                    futuro.set_exception(error)
+            self._stats["dropped_rows"] += exceso
+            logger.error(f"Cola de ubicaciones llena tras un error de escritura: se descartan las {exceso} muestras más antiguas.")
+            cola, futuros = cola[exceso:], futuros[exceso:]
+        self._muestras, self._esperando = cola, futuros
+
+    async def _escribir_lote(self, muestras: list):
+        # Para 'usuarios' solo importa la última posición de cada repartidor en el lote
+        ultimas = {}
+        for muestra in muestras:
+            previa = ultimas.get(muestra[0])
+            if previa is None or muestra[3] >= previa[3]:
+                ultimas[muestra[0]] = muestra
+        columnas = list(zip(*ultimas.values()))
+
+        async with self.db.connection() as conn:
+            async with conn.transaction():
+                if LOCATION_INGEST_SYNC_COMMIT == "off":
+                    await conn.execute("SET LOCAL synchronous_commit = off")
+                await conn.execute(_UPSERT_USUARIOS, *[list(c) for c in columnas])
+                await conn.copy_records_to_table(
+                    "ubicaciones_log",
+                    records=[m[:4] for m in muestras],
+                    columns=["id_usuario", "latitud", "longitud", "timestamp"],
+                )
+
+    async def _escribir_por_fila(self, muestras: list, errores: dict) -> tuple:
+        """
+        Una transacción por muestra; anota en 'errores' {índice: error} las descartadas por datos.
+        Devuelve (hechas, fallo): si otro error corta el recorrido, las muestras desde 'hechas'
+        no se escribieron (las anteriores ya hicieron commit) y 'fallo' es ese error.
+        """
+        hechas = 0
+        try:
+            async with self.db.connection() as conn:
+                for muestra in muestras:
+                    try:
+                        async with conn.transaction():
+                            await conn.execute(_UPSERT_USUARIOS, *[[v] for v in muestra])
+                            await conn.execute(
+                                "INSERT INTO ubicaciones_log (id_usuario, latitud, longitud, timestamp) VALUES ($1, $2, $3, $4)",
+                                *muestra[:4]
+                            )
+                    except _ERRORES_DE_DATOS as e:
+                        errores[hechas] = e
+                        logger.error(f"Ubicación descartada de {muestra[0]!r}: {e!r}")
+                    hechas += 1
+        except Exception as e:
+            return hechas, e
+        return hechas, None
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "queue_depth": len(self._muestras),
+            "durability": LOCATION_INGEST_DURABILITY,
+            "flush_interval_ms": LOCATION_FLUSH_INTERVAL_MS,
+        }
+
+
+location_ingest = LocationIngestBuffer(async_db)
@@ -13,7 +13,6 @@ import logging
 import pytz
 import uuid
 import shutil
-import httpx
 from decimal import Decimal
 import io
 import csv
@@ -21,6 +20,23 @@ from firebase_admin import auth, messaging
 # Importar modelos, base de datos y utilidades de autenticación
 from models import *
 from database import *
+from async_db import async_db, get_async_db, replica_db, get_read_db, read_router
+from outbound import (
+    calcular_costo_delivery_ruta, get_address_autocomplete, get_place_details,
+    send_fcm_message, webhooks, close_outbound, outbound_stats
+)
+from partitions import partitions_stats
+from query_builder import WhereBuilder, inicio_del_dia, fin_del_dia, hoy, paginar
+from location_ingest import location_ingest
+from driver_geo import registrar_ubicacion, purgar_inactivos, buscar_cercanos, buscar_cercanos_sql, leer_hashes, driver_geo_stats, DRIVER_MIN_BATTERY
+from zone_index import zonas_restringidas, ZONAS_ACTIVAS_QUERY, ZONES_INDEX_RESYNC_SECONDS
+from route_matrix import route_matrix_stats, rutas_para_pares
+from route_cache import route_cache
+from road_router import road_router, cargar_grafo_vial
+from pricing import pricing_engine, PRICING_CONFIG_KEY
+from quotes import emitir_cotizaciones, canjear_cotizacion, quotes_stats, QUOTE_TTL_SECONDS
+from dispatch import dispatch_engine, DISPATCH_ENABLED, DISPATCH_TICK_SECONDS
+from spatial_index import pedidos_pendientes_index, PEDIDOS_INDEX_RESYNC_SECONDS, RADAR_POSTGIS_QUERY
 from auth_utils import get_current_user, RoleChecker, User, get_current_principal
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from apscheduler.triggers.interval import IntervalTrigger
@@ -28,7 +44,6 @@ from contextlib import asynccontextmanager
 import asyncio
 from passlib.context import CryptContext
 import secrets
-from math import radians, cos, sin, asin, sqrt
 
 # --- CONFIGURACIÓN INICIAL ---
 CARACAS_TZ = pytz.timezone('America/Caracas')
@@ -46,107 +61,97 @@ async def process_scheduled_orders():
     2. Crea comercios personalizados "al vuelo" si no existen.
     3. Registra logs detallados en la tabla system_logs para éxito o error.
     4. Emite un evento por WebSocket para notificar al frontend del procesamiento.
+    Cada pedido se procesa en su propio savepoint: un fallo no deshace los demás del lote.
     """
     logger.info("CRON JOB: Verificando pedidos programados...")
-    db = None
     try:
-        db = get_db_connection()
-        with db.cursor(cursor_factory=RealDictCursor) as cur:
-            # Usamos SKIP LOCKED para evitar que múltiples procesos tomen el mismo pedido
-            cur.execute(
-                "SELECT * FROM pedidos_programados WHERE fecha_liberacion <= NOW() AND estado = 'pendiente' FOR UPDATE SKIP LOCKED"
-            )
-            orders_to_process = cur.fetchall()
-
-            if not orders_to_process:
-                return # Salimos silenciosamente si no hay nada que hacer.
-
-            cur.execute("SELECT valor FROM app_config WHERE clave = 'pricing_tiers'")
-            config_row = cur.fetchone()
-            if not config_row:
-                logger.error("CRON JOB: ¡CONFIGURACIÓN DE TARIFAS NO ENCONTRADA! No se pueden procesar pedidos.")
-                return
-
-            logger.info(f"CRON JOB: Se encontraron {len(orders_to_process)} pedidos para procesar.")
-            for scheduled_order in orders_to_process:
-                order_id_log = scheduled_order['id']
-                try:
-                    payload = scheduled_order['payload_pedido']
-                    pedido_data = PedidoCreate(**payload)
-
-                    if 'custom_' in pedido_data.id_comercio:
-                        logger.info(f"CRON JOB: Detectado comercio personalizado '{pedido_data.id_comercio}'. Creando registro...")
-                        cur.execute(
-                            "INSERT INTO comercios (id_comercio, nombre, numero_contacto) VALUES (%s, %s, %s) ON CONFLICT (id_comercio) DO NOTHING",
-                            (pedido_data.id_comercio, pedido_data.nombre_comercio, pedido_data.telefono_comercio)
-                        )
-
-                    costo = 0.0
-                    tipo_vehiculo_str = pedido_data.tipo_vehiculo.value if hasattr(pedido_data.tipo_vehiculo, 'value') else str(pedido_data.tipo_vehiculo)
-                    
-                    if all([pedido_data.latitud_retiro, pedido_data.longitud_retiro, pedido_data.latitud_entrega, pedido_data.longitud_entrega]):
-                        costo_res = calcular_costo_delivery_ruta(
-                            f"{pedido_data.latitud_retiro},{pedido_data.longitud_retiro}",
-                            f"{pedido_data.latitud_entrega},{pedido_data.longitud_entrega}",
-                            tipo_vehiculo_str,
-                            config_completa=config_row['valor']
-                        )
-                        costo = costo_res.get('costo', 0.0)
-                    else:
-                        logger.warning(f"CRON JOB: No se pudo calcular costo para pedido programado #{order_id_log} por falta de coordenadas.")
-
-                    q = "INSERT INTO pedidos (pedido, direccion_entrega, latitud_entrega, longitud_entrega, latitud_retiro, longitud_retiro, estado, detalles, telefono_contacto, telefono_comercio, link_maps, id_comercio, costo_servicio, tipo_vehiculo, creado_por_usuario_id) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING *"
-                    cur.execute(q, (
-                        pedido_data.pedido, pedido_data.direccion_entrega, pedido_data.latitud_entrega,
-                        pedido_data.longitud_entrega, pedido_data.latitud_retiro, pedido_data.longitud_retiro,
-                        'pendiente', pedido_data.detalles, pedido_data.telefono_contacto,
-                        pedido_data.telefono_comercio, pedido_data.link_maps, pedido_data.id_comercio,
-                        costo, tipo_vehiculo_str, pedido_data.creado_por_usuario_id
-                    ))
-                    nuevo_pedido = cur.fetchone()
-                    
-                    nuevo_pedido['nombre_comercio'] = pedido_data.nombre_comercio
-
-                    log_system_action(db, "INFO", "scheduled_order_released", {
-                        "scheduled_order_id": order_id_log,
-                        "new_order_id": nuevo_pedido['id'],
-                        "status": "success"
-                    })
-                    
-                    cur.execute("UPDATE pedidos_programados SET estado = 'procesado' WHERE id = %s", (order_id_log,))
-                    
-                    await manager.broadcast({"type": "SCHEDULED_ORDER_PROCESSED", "data": {"id": order_id_log, "status": "procesado"}})
-                    await manager.broadcast({"type": "NEW_ORDER", "data": nuevo_pedido})
-                    
-                    logger.info(f"CRON JOB: Pedido programado #{order_id_log} procesado. Creado pedido real #{nuevo_pedido['id']} con costo ${costo}.")
-
-                except Exception as e:
-                    db.rollback()
-                    error_message = str(e)
-                    logger.error(f"CRON JOB: Error procesando pedido programado #{order_id_log}: {error_message}")
-                    
-                    log_system_action(db, "ERROR", "scheduled_order_failed", {
-                        "scheduled_order_id": order_id_log,
-                        "error": error_message
-                    })
-                    
-                    with db.cursor() as error_cur:
-                        error_cur.execute("UPDATE pedidos_programados SET estado = 'error' WHERE id = %s", (order_id_log,))
-                    db.commit()
-                    
-                    await manager.broadcast({"type": "SCHEDULED_ORDER_PROCESSED", "data": {"id": order_id_log, "status": "error"}})
-                    continue
+        async with async_db.connection() as conn:
+            async with conn.transaction():
+                # Usamos SKIP LOCKED para evitar que múltiples procesos tomen el mismo pedido
+                orders_to_process = await conn.fetch(
+                    "SELECT * FROM pedidos_programados WHERE fecha_liberacion <= NOW() AND estado = 'pendiente' FOR UPDATE SKIP LOCKED"
+                )
+
+                if not orders_to_process:
+                    return # Salimos silenciosamente si no hay nada que hacer.
+
+                tarifas = await pricing_engine.obtener(conn)
+                if not tarifas:
+                    logger.error("CRON JOB: ¡CONFIGURACIÓN DE TARIFAS NO ENCONTRADA! No se pueden procesar pedidos.")
+                    return
+
+                logger.info(f"CRON JOB: Se encontraron {len(orders_to_process)} pedidos para procesar.")
+                for scheduled_order in orders_to_process:
+                    order_id_log = scheduled_order['id']
+                    try:
+                        async with conn.transaction():
+                            payload = scheduled_order['payload_pedido']
+                            pedido_data = PedidoCreate(**payload)
+
+                            if 'custom_' in pedido_data.id_comercio:
+                                logger.info(f"CRON JOB: Detectado comercio personalizado '{pedido_data.id_comercio}'. Creando registro...")
+                                await conn.execute(
+                                    "INSERT INTO comercios (id_comercio, nombre, numero_contacto) VALUES ($1, $2, $3) ON CONFLICT (id_comercio) DO NOTHING",
+                                    pedido_data.id_comercio, pedido_data.nombre_comercio, pedido_data.telefono_comercio
+                                )
+
+                            costo = 0.0
+                            tipo_vehiculo_str = pedido_data.tipo_vehiculo.value if hasattr(pedido_data.tipo_vehiculo, 'value') else str(pedido_data.tipo_vehiculo)
+
+                            if all([pedido_data.latitud_retiro, pedido_data.longitud_retiro, pedido_data.latitud_entrega, pedido_data.longitud_entrega]):
+                                costo_res = await calcular_costo_delivery_ruta(
+                                    f"{pedido_data.latitud_retiro},{pedido_data.longitud_retiro}",
+                                    f"{pedido_data.latitud_entrega},{pedido_data.longitud_entrega}",
+                                    tipo_vehiculo_str,
+                                    tarifas
+                                )
+                                costo = costo_res.get('costo', 0.0)
+                            else:
+                                logger.warning(f"CRON JOB: No se pudo calcular costo para pedido programado #{order_id_log} por falta de coordenadas.")
+
+                            q = "INSERT INTO pedidos (pedido, direccion_entrega, latitud_entrega, longitud_entrega, latitud_retiro, longitud_retiro, estado, detalles, telefono_contacto, telefono_comercio, link_maps, id_comercio, costo_servicio, tipo_vehiculo, creado_por_usuario_id) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14,$15) RETURNING *"
+                            nuevo_pedido = dict(await conn.fetchrow(q,
+                                pedido_data.pedido, pedido_data.direccion_entrega, pedido_data.latitud_entrega,
+                                pedido_data.longitud_entrega, pedido_data.latitud_retiro, pedido_data.longitud_retiro,
+                                'pendiente', pedido_data.detalles, pedido_data.telefono_contacto,
+                                pedido_data.telefono_comercio, pedido_data.link_maps, pedido_data.id_comercio,
+                                costo, tipo_vehiculo_str, pedido_data.creado_por_usuario_id
+                            ))
+
+                            nuevo_pedido['nombre_comercio'] = pedido_data.nombre_comercio
+
+                            await log_system_action_async(conn, "INFO", "scheduled_order_released", {
+                                "scheduled_order_id": order_id_log,
+                                "new_order_id": nuevo_pedido['id'],
+                                "status": "success"
+                            })
+
+                            await conn.execute("UPDATE pedidos_programados SET estado = 'procesado' WHERE id = $1", order_id_log)
+
+                        pedidos_pendientes_index.sync(nuevo_pedido)
+                        await manager.broadcast({"type": "SCHEDULED_ORDER_PROCESSED", "data": {"id": order_id_log, "status": "procesado"}})
+                        await manager.broadcast({"type": "NEW_ORDER", "data": nuevo_pedido})
+
+                        logger.info(f"CRON JOB: Pedido programado #{order_id_log} procesado. Creado pedido real #{nuevo_pedido['id']} con costo ${costo}.")
+
+                    except Exception as e:
+                        error_message = str(e)
+                        logger.error(f"CRON JOB: Error procesando pedido programado #{order_id_log}: {error_message}")
+
+                        await log_system_action_async(conn, "ERROR", "scheduled_order_failed", {
+                            "scheduled_order_id": order_id_log,
+                            "error": error_message
+                        })
+                        await conn.execute("UPDATE pedidos_programados SET estado = 'error' WHERE id = $1", order_id_log)
+
+                        await manager.broadcast({"type": "SCHEDULED_ORDER_PROCESSED", "data": {"id": order_id_log, "status": "error"}})
+                        continue
 
-            db.commit()
-    
     except Exception as e:
         logger.error(f"CRON JOB: Fallo general en la tarea de procesamiento: {e}")
-        if db: db.rollback()
-    finally:
-        if db: db.close()
 
 
-async def trigger_integration_webhooks(event_type: str, data: dict, db_conn):
+async def trigger_integration_webhooks(event_type: str, data: dict):
     """
     Versión final y robusta:
     - Busca integraciones basadas en el prefijo del ID_COMERCIO.
@@ -155,136 +160,118 @@ async def trigger_integration_webhooks(event_type: str, data: dict, db_conn):
     - Busca el pedido activo del repartidor para eventos de ubicación.
     """
     pedido_id = None
-    
-    try:
+
+    async with async_db.connection() as conn:
         # 1. Determinar el pedido_id basado en el tipo de evento
         if event_type == "DRIVER_LOCATION_UPDATE":
             repartidor_id = data.get('id_usuario')
             if not repartidor_id: return
-            with db_conn.cursor(cursor_factory=RealDictCursor) as cur:
-                cur.execute("SELECT id FROM pedidos WHERE repartidor_id = %s AND estado NOT IN ('entregado', 'cancelado') ORDER BY fecha_creacion DESC LIMIT 1", (repartidor_id,))
-                active_order = cur.fetchone()
-                if active_order:
-                    pedido_id = active_order['id']
+            active_order = await conn.fetchrow("SELECT id FROM pedidos WHERE repartidor_id = $1 AND estado NOT IN ('entregado', 'cancelado') ORDER BY fecha_creacion DESC LIMIT 1", repartidor_id)
+            if active_order:
+                pedido_id = active_order['id']
         else: # Para eventos como ORDER_STATUS_UPDATE, ORDER_ASSIGNED
             pedido_id = data.get('id')
 
         if not pedido_id:
             return
 
-        with db_conn.cursor(cursor_factory=RealDictCursor) as cur:
-            # 2. Obtener datos clave del pedido
-            cur.execute("SELECT p.id_comercio, i.id_externo FROM pedidos p LEFT JOIN integraciones i ON p.id = i.pedido_id WHERE p.id = %s", (pedido_id,))
-            pedido_info = cur.fetchone()
-            if not pedido_info or not pedido_info.get('id_comercio'):
-                return
+        # 2. Obtener datos clave del pedido
+        pedido_info = await conn.fetchrow("SELECT p.id_comercio, i.id_externo FROM pedidos p LEFT JOIN integraciones i ON p.id = i.pedido_id WHERE p.id = $1", pedido_id)
+        if not pedido_info or not pedido_info['id_comercio']:
+            return
 
-            id_comercio = pedido_info['id_comercio']
-            id_externo = pedido_info.get('id_externo')
+        id_comercio = pedido_info['id_comercio']
+        id_externo = pedido_info['id_externo']
+
+        # 3. Buscar una configuración de integración que coincida con el PREFIJO DEL COMERCIO
+        config = await conn.fetchrow("SELECT * FROM integration_configs WHERE is_active = TRUE AND $1 LIKE id_externo_prefix || '%'", id_comercio)
+        if not config: return
+
+        webhook_config = (config['webhooks'] or {}).get(event_type)
+        if not webhook_config: return
+
+        # 4. Construir el payload
+        payload_template = json.dumps(webhook_config['payload_template'])
+
+        repartidor_id = data.get('repartidor_id') or (data.get('id_usuario') if event_type == "DRIVER_LOCATION_UPDATE" else None)
+        if not repartidor_id:
+            repartidor_row = await conn.fetchrow("SELECT repartidor_id FROM pedidos WHERE id = $1", pedido_id)
+            if repartidor_row:
+                repartidor_id = repartidor_row['repartidor_id']
+
+        replacements = {
+            "{{id_externo}}": id_externo,
+            "{{pedido_id}}": pedido_id,
+            "{{id_comercio}}": id_comercio,
+            "{{estado}}": data.get('estado'),
+            "{{timestamp}}": datetime.now(CARACAS_TZ).isoformat(),
+            "{{repartidor_id}}": repartidor_id,
+            "{{latitud}}": data.get('latitud'),
+            "{{longitud}}": data.get('longitud'),
+            "{{bateria_porcentaje}}": data.get('bateria_porcentaje')
+        }
 
-            # 3. Buscar una configuración de integración que coincida con el PREFIJO DEL COMERCIO
-            cur.execute("SELECT * FROM integration_configs WHERE is_active = TRUE AND %s LIKE id_externo_prefix || '%%'", (id_comercio,))
-            config = cur.fetchone()
-            if not config: return
+        for key, value in replacements.items():
+            replacement_value = json.dumps(value) if value is not None else 'null'
+            payload_template = payload_template.replace(f'"{key}"', replacement_value)
 
-            webhook_config = config.get('webhooks', {}).get(event_type)
-            if not webhook_config: return
+        final_payload = json.loads(payload_template)
+        target_url = webhook_config['url']
 
-            # 4. Construir el payload
-            payload_template = json.dumps(webhook_config['payload_template'])
-            
-            repartidor_id = data.get('repartidor_id') or (data.get('id_usuario') if event_type == "DRIVER_LOCATION_UPDATE" else None)
-            if not repartidor_id:
-                cur.execute("SELECT repartidor_id FROM pedidos WHERE id = %s", (pedido_id,))
-                repartidor_row = cur.fetchone()
-                if repartidor_row:
-                    repartidor_id = repartidor_row['repartidor_id']
-
-            replacements = {
-                "{{id_externo}}": id_externo,
-                "{{pedido_id}}": pedido_id,
-                "{{id_comercio}}": id_comercio,
-                "{{estado}}": data.get('estado'),
-                "{{timestamp}}": datetime.now(CARACAS_TZ).isoformat(),
-                "{{repartidor_id}}": repartidor_id,
-                "{{latitud}}": data.get('latitud'),
-                "{{longitud}}": data.get('longitud'),
-                "{{bateria_porcentaje}}": data.get('bateria_porcentaje')
-            }
-            
-            for key, value in replacements.items():
-                replacement_value = json.dumps(value) if value is not None else 'null'
-                payload_template = payload_template.replace(f'"{key}"', replacement_value)
-
-            final_payload = json.loads(payload_template)
-            target_url = webhook_config['url']
-
-            # 5. Enviar el webhook en segundo plano
-            async with httpx.AsyncClient() as client:
-                try:
-                    await client.post(target_url, json=final_payload, timeout=10.0)
-                    log_system_action(db_conn, "INFO", "webhook_sent", {"integration": config['name'], "event": event_type, "url": target_url, "payload": final_payload})
-                except Exception as e:
-                    log_system_action(db_conn, "ERROR", "webhook_failed", {"integration": config['name'], "event": event_type, "error": str(e)})
-    finally:
-        db_conn.close()
-
-def is_point_in_polygon(point_lat: float, point_lng: float, polygon_coords: List[List[float]]) -> bool:
-    """
-    Determina si un punto (lat, lng) está dentro de un polígono.
-    El polígono se define como una lista de puntos [[lng, lat], ...].
-    Algoritmo: Ray Casting.
-    """
-    num_vertices = len(polygon_coords)
-    if num_vertices < 3:
-        return False
-    
-    inside = False
-    
-    # El primer punto del polígono
-    p1_lng, p1_lat = polygon_coords[0]
-    
-    for i in range(1, num_vertices + 1):
-        # El siguiente punto del polígono (el último se conecta con el primero)
-        p2_lng, p2_lat = polygon_coords[i % num_vertices]
-        
-        # Comprobar si el punto está entre las latitudes de la arista del polígono
-        if min(p1_lat, p2_lat) < point_lat <= max(p1_lat, p2_lat):
-            # Comprobar si el punto está a la izquierda de la arista
-            if point_lng <= max(p1_lng, p2_lng):
-                # Calcular la intersección en el eje X
-                if p1_lat != p2_lat:
-                    x_intersection = (point_lat - p1_lat) * (p2_lng - p1_lng) / (p2_lat - p1_lat) + p1_lng
-                
-                # Si el punto está a la izquierda de la intersección, cruzamos una arista
-                if p1_lng == p2_lng or point_lng <= x_intersection:
-                    inside = not inside
-                    
-        # Mover al siguiente punto
-        p1_lng, p1_lat = p2_lng, p2_lat
-        
-    return inside
+        # 5. Enviar el webhook en segundo plano
+        try:
+            await webhooks.post(target_url, json=final_payload)
+            await log_system_action_async(conn, "INFO", "webhook_sent", {"integration": config['name'], "event": event_type, "url": target_url, "payload": final_payload})
+        except Exception as e:
+            await log_system_action_async(conn, "ERROR", "webhook_failed", {"integration": config['name'], "event": event_type, "error": str(e) or repr(e)})
 
-def haversine(lon1, lat1, lon2, lat2):
-    lon1, lat1, lon2, lat2 = map(radians, [lon1, lat1, lon2, lat2])
-    dlon = lon2 - lon1 
-    dlat = lat2 - lat1 
-    a = sin(dlat/2)**2 + cos(lat1) * cos(lat2) * sin(dlon/2)**2
-    c = 2 * asin(sqrt(a)) 
-    r = 6371 # Radio de la Tierra en km
-    return c * r
+async def resincronizar_zonas():
+    """Recarga el índice de zonas si 'restricted_zones' cambió (p. ej. desde otra instancia)."""
+    try:
+        async with async_db.connection() as conn:
+            await zonas_restringidas.resincronizar(conn)
+    except Exception as e:
+        logger.error(f"Error resincronizando el índice de zonas restringidas: {e!r}")
 
 # --- USAMOS LIFESPAN PARA INICIAR Y DETENER EL SCHEDULER ---
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Código que se ejecuta al iniciar la aplicación
+    await async_db.connect()
+    if replica_db is not None:
+        try:
+            await replica_db.connect()
+        except Exception as e:
+            # Sin réplica la API sigue funcionando: las lecturas van al primario
+            logger.error(f"No se pudo conectar a la réplica de lectura: {e!r}")
+    manager.loop = asyncio.get_running_loop()
+    location_ingest.start()
+    await cargar_grafo_vial()
+    await pedidos_pendientes_index.detectar_postgis()
+    async with async_db.connection() as conn:
+        await zonas_restringidas.resincronizar(conn)
+    await pedidos_pendientes_index.recargar()
     scheduler.add_job(process_scheduled_orders, IntervalTrigger(minutes=1), id="process_orders_job", replace_existing=True)
+    # Función síncrona: APScheduler la ejecuta en un hilo, fuera del event loop
+    scheduler.add_job(ejecutar_mantenimiento_particiones, IntervalTrigger(hours=1), id="partitions_job", replace_existing=True)
+    scheduler.add_job(purgar_inactivos, IntervalTrigger(minutes=1), id="drivers_geo_purge_job", replace_existing=True)
+    scheduler.add_job(pedidos_pendientes_index.recargar, IntervalTrigger(seconds=PEDIDOS_INDEX_RESYNC_SECONDS), id="pedidos_index_job", replace_existing=True)
+    # Zonas creadas, editadas o borradas desde otra instancia
+    scheduler.add_job(resincronizar_zonas, IntervalTrigger(seconds=ZONES_INDEX_RESYNC_SECONDS), id="zones_index_job", replace_existing=True, max_instances=1, coalesce=True)
+    if DISPATCH_ENABLED:
+        scheduler.add_job(ejecutar_despacho, IntervalTrigger(seconds=DISPATCH_TICK_SECONDS), id="dispatch_job", replace_existing=True, max_instances=1, coalesce=True)
     scheduler.start()
     logger.info("Planificador de tareas iniciado. Verificará pedidos cada minuto.")
     yield
     # Código que se ejecuta al detener la aplicación
     scheduler.shutdown()
     logger.info("Planificador de tareas detenido.")
+    await close_outbound()
+    await location_ingest.stop()
+    if replica_db is not None:
+        await replica_db.close()
+    await async_db.close()
+    db_pool.closeall()
 
 
 REPORT_DEFINITIONS = {
@@ -305,12 +292,13 @@ REPORT_DEFINITIONS = {
         'duracion_pedido_min': ('Duración Pedido (min)', "EXTRACT(EPOCH FROM (p.fecha_actualizacion - p.fecha_creacion)) / 60"),
         'comision_repartidor': ('Comisión Repartidor ($)', '(p.costo_servicio * u.porcentaje_comision / 100)'),
     },
+    # '{}' se reemplaza por el parámetro posicional ($n) correspondiente
     'filters': {
-        'fecha_inicio': "DATE(p.fecha_creacion) >= %s",
-        'fecha_fin': "DATE(p.fecha_creacion) <= %s",
-        'repartidor_id': "p.repartidor_id = %s",
-        'id_comercio': "p.id_comercio = %s",
-        'estado': "p.estado = ANY(%s)",
+        'fecha_inicio': "p.fecha_creacion >= {}",
+        'fecha_fin': "p.fecha_creacion < {}",
+        'repartidor_id': "p.repartidor_id = {}",
+        'id_comercio': "p.id_comercio = {}",
+        'estado': "p.estado = ANY({})",
     }
 }
 # --- ACTUALIZA LA CREACIÓN DE TU APP ---
@@ -334,7 +322,9 @@ class PedidoProgramadoResponse(BaseModel):
 
 # --- WEBSOCKET CONNECTION MANAGER ---
 class ConnectionManager:
-    def __init__(self): self.active_connections: List[WebSocket] = []
+    def __init__(self):
+        self.active_connections: List[WebSocket] = []
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
     async def connect(self, ws: WebSocket): await ws.accept(); self.active_connections.append(ws)
     def disconnect(self, ws: WebSocket):
         if ws in self.active_connections: self.active_connections.remove(ws)
@@ -343,71 +333,89 @@ class ConnectionManager:
         for conn in list(self.active_connections):
             try: await conn.send_text(json_msg)
             except Exception: pass
+    def broadcast_nowait(self, msg: dict):
+        """Programa un broadcast sin esperarlo. Funciona desde el event loop o desde el threadpool de FastAPI."""
+        try:
+            asyncio.get_running_loop().create_task(self.broadcast(msg))
+        except RuntimeError:
+            if self.loop:
+                asyncio.run_coroutine_threadsafe(self.broadcast(msg), self.loop)
 manager = ConnectionManager()
 
 
+def _system_log_payload(nivel: str, accion: str, detalles: dict, usuario: str) -> dict:
+    # Creamos un objeto que se parezca a lo que la base de datos guardaría
+    return {
+        "timestamp": datetime.now(CARACAS_TZ).isoformat(),
+        "nivel": nivel,
+        "accion": accion,
+        "usuario_responsable": usuario,
+        "detalles": detalles,
+    }
+
 def log_system_action(db_conn, nivel: str, accion: str, detalles: dict, usuario: str = "sistema"):
     """
     Registra una acción en la base de datos Y emite un evento por WebSocket.
+    Versión para conexiones psycopg2 (endpoints síncronos de administración).
     """
     try:
-        # 1. Insertar en la base de datos (como antes)
         with db_conn.cursor() as cur:
             cur.execute(
                 "INSERT INTO system_logs (nivel, accion, usuario_responsable, detalles) VALUES (%s, %s, %s, %s)",
                 (nivel, accion, usuario, json.dumps(detalles, default=str))
             )
+        manager.broadcast_nowait({"type": "NEW_SYSTEM_LOG", "data": _system_log_payload(nivel, accion, detalles, usuario)})
+    except Exception as e:
+        logger.error(f"Fallo al escribir o transmitir log de sistema: {e}")
 
-        # --- INICIO DE LA CORRECCIÓN ---
-        # 2. Preparar el payload para el WebSocket
-        # Creamos un objeto que se parezca a lo que la base de datos guardaría
-        log_payload = {
-            "timestamp": datetime.now(CARACAS_TZ).isoformat(),
-            "nivel": nivel,
-            "accion": accion,
-            "usuario_responsable": usuario,
-            "detalles": detalles,
-        }
-
-        # 3. Enviar el evento por WebSocket de forma asíncrona
-        # Usamos asyncio.create_task para no bloquear la función síncrona
-        asyncio.create_task(
-            manager.broadcast({"type": "NEW_SYSTEM_LOG", "data": log_payload})
+async def log_system_action_async(conn, nivel: str, accion: str, detalles: dict, usuario: str = "sistema"):
+    """
+    Igual que 'log_system_action' pero sobre una conexión asyncpg.
+    Si se llama dentro de una transacción, el log se confirma junto con ella.
+    """
+    try:
+        await conn.execute(
+            "INSERT INTO system_logs (nivel, accion, usuario_responsable, detalles) VALUES ($1, $2, $3, $4)",
+            nivel, accion, usuario, detalles
         )
-        # --- FIN DE LA CORRECCIÓN ---
-
+        manager.broadcast_nowait({"type": "NEW_SYSTEM_LOG", "data": _system_log_payload(nivel, accion, detalles, usuario)})
     except Exception as e:
         logger.error(f"Fallo al escribir o transmitir log de sistema: {e}")
 
-def log_pedido_status_change(cur, pedido_id, nuevo_estado, repartidor_id=None, manual_change=False):
+async def log_pedido_status_change(conn, pedido_id, nuevo_estado, repartidor_id=None, manual_change=False):
     lat, lon = None, None
     if repartidor_id:
-        cur.execute("SELECT ultima_latitud, ultima_longitud FROM usuarios WHERE id_usuario = %s", (repartidor_id,))
-        r = cur.fetchone()
+        r = await conn.fetchrow("SELECT ultima_latitud, ultima_longitud FROM usuarios WHERE id_usuario = $1", repartidor_id)
         if r: lat, lon = r['ultima_latitud'], r['ultima_longitud']
     est = f"manual_{nuevo_estado}" if manual_change else nuevo_estado
-    cur.execute("INSERT INTO pedidos_logs (id_pedido, repartidor_id, estado_registrado, latitud, longitud) VALUES (%s, %s, %s, %s, %s)", (pedido_id, repartidor_id, est, lat, lon))
+    await conn.execute("INSERT INTO pedidos_logs (id_pedido, repartidor_id, estado_registrado, latitud, longitud) VALUES ($1, $2, $3, $4, $5)", pedido_id, repartidor_id, est, lat, lon)
 
 # --- MIDDLEWARE DE AUDITORÍA ---
+# POST que solo leen datos: no cuentan como escritura para el enrutamiento a la réplica
+READ_ONLY_POST_PATHS = ("/reports/generate", "/zones/check", "/pricing/quote", "/pricing/quotes")
+
 class AuditLogMiddleware(BaseHTTPMiddleware):
     async def dispatch(self, request: Request, call_next):
         req_body_bytes = await request.body()
         response = await call_next(request)
+        if request.method in ("POST", "PUT", "PATCH", "DELETE") and response.status_code < 400 and request.url.path not in READ_ONLY_POST_PATHS:
+            read_router.mark_write(request)
         res_body_bytes = b''
         async for chunk in response.body_iterator: res_body_bytes += chunk
         path = request.url.path
         if path.startswith(("/dashboard", "/drivers", "/ws")) or path == "/":
             return Response(content=res_body_bytes, status_code=response.status_code, headers=dict(response.headers))
         log_details = {"client_ip": request.client.host, "method": request.method, "path": path, "request_body": req_body_bytes.decode(errors='ignore'), "status_code": response.status_code}
-        db_conn = get_db_connection()
         try:
-            log_system_action(db_conn, "INFO", "api_request", log_details, usuario=request.client.host)
-            db_conn.commit()
-        finally: db_conn.close()
+            async with async_db.connection() as conn:
+                await log_system_action_async(conn, "INFO", "api_request", log_details, usuario=request.client.host)
+        except asyncio.TimeoutError:
+            # La auditoría no debe tumbar la respuesta si el pool está saturado.
+            logger.warning(f"Auditoría omitida para {path}: pool de conexiones saturado.")
         return Response(content=res_body_bytes, status_code=response.status_code, headers=dict(response.headers))
 
 app.add_middleware(AuditLogMiddleware)
-app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_credentials=True, allow_methods=["*"], allow_headers=["*"], expose_headers=["X-Next-Cursor"])
 
 @app.websocket("/ws/dashboard")
 async def websocket_endpoint(websocket: WebSocket):
@@ -423,7 +431,7 @@ async def root(): return {"message": "Delivery Platform V4.0.1 Running"}
 
 # --- ENDPOINTS DE ADMINISTRACIÓN DE USUARIOS ---
 @app.post("/admin/users/sync", tags=["Admin"], dependencies=[Depends(RoleChecker("access:all"))])
-async def sync_firebase_users_with_db(db=Depends(get_db)):
+def sync_firebase_users_with_db(db=Depends(get_db)):
     """
     Sincroniza la lista de usuarios de Firebase con la tabla local 'admin_users'.
     """
@@ -450,7 +458,7 @@ async def sync_firebase_users_with_db(db=Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.post("/admin/users", response_model=dict, tags=["Admin"], dependencies=[Depends(RoleChecker("access:all"))])
-async def create_admin_user(user_data: NewUserRequest, db=Depends(get_db)):
+def create_admin_user(user_data: NewUserRequest, db=Depends(get_db)):
     """
     Crea un nuevo usuario en Firebase y lo registra en la tabla 'admin_users'.
     """
@@ -478,7 +486,7 @@ async def create_admin_user(user_data: NewUserRequest, db=Depends(get_db)):
         raise HTTPException(status_code=400, detail=str(e))
 
 @app.get("/admin/users", tags=["Admin"], dependencies=[Depends(get_current_user)])
-async def list_admin_users(db=Depends(get_db)):
+def list_admin_users(db=Depends(get_db)):
     """
     CORREGIDO: Obtiene la lista de usuarios del panel desde la tabla 'admin_users'.
     """
@@ -488,7 +496,7 @@ async def list_admin_users(db=Depends(get_db)):
         return users
 
 @app.put("/admin/users/{uid}", response_model=dict, tags=["Admin"], dependencies=[Depends(get_current_user)])
-async def update_firebase_user(uid: str, update_data: UpdateUserRequest):
+def update_firebase_user(uid: str, update_data: UpdateUserRequest):
     """
     Actualiza datos de un usuario en Firebase (nombre, estado habilitado/deshabilitado).
     """
@@ -502,7 +510,7 @@ async def update_firebase_user(uid: str, update_data: UpdateUserRequest):
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.post("/admin/users/{uid}/password", status_code=200, tags=["Admin"], dependencies=[Depends(get_current_user)])
-async def change_user_password(uid: str, password_data: ChangePasswordRequest):
+def change_user_password(uid: str, password_data: ChangePasswordRequest):
     """
     Cambia la contraseña de un usuario de Firebase.
     """
@@ -516,28 +524,26 @@ async def change_user_password(uid: str, password_data: ChangePasswordRequest):
 async def actualizar_comision_usuario(
     id_usuario: str, 
     data: UpdateCommissionRequest, 
-    db=Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Actualiza el porcentaje de comisión de un repartidor en la base de datos local.
     """
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "UPDATE usuarios SET porcentaje_comision = %s WHERE id_usuario = %s RETURNING *",
-            (data.porcentaje_comision, id_usuario)
+    async with db.transaction():
+        updated_user = await db.fetchrow(
+            "UPDATE usuarios SET porcentaje_comision = $1 WHERE id_usuario = $2 RETURNING *",
+            data.porcentaje_comision, id_usuario
         )
-        if cur.rowcount == 0:
+        if not updated_user:
             # Si el usuario no existe, lo creamos para poder asignarle la comisión
-            cur.execute(
-                "INSERT INTO usuarios (id_usuario, porcentaje_comision) VALUES (%s, %s) RETURNING *",
-                (id_usuario, data.porcentaje_comision)
+            updated_user = await db.fetchrow(
+                "INSERT INTO usuarios (id_usuario, porcentaje_comision) VALUES ($1, $2) RETURNING *",
+                id_usuario, data.porcentaje_comision
             )
-        updated_user = cur.fetchone()
-        db.commit()
-        return Usuario(**updated_user)
+    return Usuario(**updated_user)
 
 @app.delete("/admin/users/{uid}", status_code=200, tags=["Admin"], dependencies=[Depends(get_current_user)])
-async def delete_firebase_user(uid: str):
+def delete_firebase_user(uid: str):
     """
     Elimina permanentemente un usuario de Firebase Authentication.
     """
@@ -548,7 +554,7 @@ async def delete_firebase_user(uid: str):
         raise HTTPException(status_code=404, detail=str(e))
 
 @app.post("/admin/users/{uid}/role", tags=["Admin"], dependencies=[Depends(RoleChecker("access:all"))])
-async def set_user_role(uid: str, role_data: dict = Body(...), db=Depends(get_db)):
+def set_user_role(uid: str, role_data: dict = Body(...), db=Depends(get_db)):
     """
     Actualiza el rol en Firebase Y en la tabla local 'admin_users'.
     """
@@ -569,32 +575,31 @@ async def set_user_role(uid: str, role_data: dict = Body(...), db=Depends(get_db
 async def actualizar_perfil_usuario(
     id_usuario: str,
     data: UsuarioProfileUpdate,
-    db=Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
-    Actualiza el nombre para mostrar de un repartidor en la base de datos local.
+    Actualiza el nombre para mostrar (y el vehículo, si se envía) de un repartidor en la base de datos local.
     """
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(
-            "UPDATE usuarios SET nombre_display = %s WHERE id_usuario = %s RETURNING *",
-            (data.nombre_display, id_usuario)
+    tipo_vehiculo = data.tipo_vehiculo.value if data.tipo_vehiculo else None
+    async with db.transaction():
+        updated_user = await db.fetchrow(
+            "UPDATE usuarios SET nombre_display = $1, tipo_vehiculo = COALESCE($3, tipo_vehiculo) WHERE id_usuario = $2 RETURNING *",
+            data.nombre_display, id_usuario, tipo_vehiculo
         )
-        if cur.rowcount == 0:
+        if not updated_user:
             # Si no existe, lo creamos
-            cur.execute(
-                "INSERT INTO usuarios (id_usuario, nombre_display) VALUES (%s, %s) RETURNING *",
-                (id_usuario, data.nombre_display)
+            updated_user = await db.fetchrow(
+                "INSERT INTO usuarios (id_usuario, nombre_display, tipo_vehiculo) VALUES ($1, $2, $3) RETURNING *",
+                id_usuario, data.nombre_display, tipo_vehiculo
             )
-        updated_user = cur.fetchone()
-        db.commit()
-        return Usuario(**updated_user)
+    return Usuario(**updated_user)
 
 # --- ENDPOINTS DE PEDIDOS (CORE) ---
 
 @app.post("/pedidos", response_model=Pedido, status_code=201, tags=["Pedidos"])
 async def crear_pedido(
     pedido_data: PedidoCreate,
-    db=Depends(get_db),
+    db=Depends(get_async_db),
     principal: Any = Depends(get_current_principal)
 ):
     """
@@ -603,62 +608,13 @@ async def crear_pedido(
     2. Valida si la dirección de entrega está en una zona restringida activa.
     3. Si todo es válido, crea el pedido y lo notifica.
     """
-    # --- INICIO DE LA VALIDACIÓN DE ZONA RESTRINGIDA (CON LOGS) ---
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM restricted_zones WHERE is_active = TRUE")
-        active_zones = cur.fetchall()
-
-    now_time = datetime.now(CARACAS_TZ).time()
-    logger.info(f"--- VALIDACIÓN DE ZONA PARA NUEVO PEDIDO ---")
-    logger.info(f"Punto de Entrega a Validar: Lat={pedido_data.latitud_entrega}, Lng={pedido_data.longitud_entrega}")
-    logger.info(f"Hora Actual: {now_time.strftime('%H:%M:%S')}")
-
-    for zone in active_zones:
-        logger.info(f"Verificando contra la zona '{zone['name']}' (ID: {zone['id']})")
-        
-        # 1. Comprobar si el punto está dentro del polígono
-        is_inside = is_point_in_polygon(pedido_data.latitud_entrega, pedido_data.longitud_entrega, zone['polygon_coords'])
-        
-        if not is_inside:
-            logger.info(f"-> Resultado: FUERA del polígono. Pasando a la siguiente zona.")
-            continue
-        
-        logger.warning(f"-> Resultado: ¡DENTRO del polígono de la zona '{zone['name']}'!")
-        
-        # 2. Comprobar si la restricción de horario aplica
-        is_restricted_24_7 = zone['restricted_from'] is None and zone['restricted_to'] is None
-        if is_restricted_24_7:
-            logger.warning(f"-> La zona '{zone['name']}' está restringida 24/7. RECHAZANDO PEDIDO.")
-            raise HTTPException(
-                status_code=403,
-                detail=f"La dirección de entrega se encuentra en la zona restringida"
-            )
-
-        if zone['restricted_from'] and zone['restricted_to']:
-            start_time = zone['restricted_from']
-            end_time = zone['restricted_to']
-            logger.info(f"-> Verificando rango de horario: {start_time.strftime('%H:%M')} a {end_time.strftime('%H:%M')}")
-            
-            is_in_time_range = False
-            if start_time > end_time: # Rango que cruza la medianoche (ej: 22:00 a 06:00)
-                if now_time >= start_time or now_time <= end_time:
-                    is_in_time_range = True
-            else: # Rango normal (ej: 08:00 a 17:00)
-                if start_time <= now_time <= end_time:
-                    is_in_time_range = True
-            
-            if is_in_time_range:
-                logger.warning(f"-> La hora actual está DENTRO del rango restringido. RECHAZANDO PEDIDO.")
-                raise HTTPException(
-                    status_code=403,
-                    detail=f"La dirección de entrega se encuentra en la zona restringida '{zone['name']}' en este horario."
-                )
-            else:
-                 logger.info(f"-> La hora actual está FUERA del rango restringido. PERMITIENDO PEDIDO.")
-        else:
-            logger.info(f"-> La zona '{zone['name']}' no tiene un rango de horario definido (y no es 24/7). PERMITIENDO PEDIDO.")
-
-    logger.info(f"--- FIN DE LA VALIDACIÓN. El pedido es válido. ---")
+    # --- VALIDACIÓN DE ZONA RESTRINGIDA (índice en memoria, ver zone_index.py) ---
+    zona = zonas_restringidas.zona_restringida(pedido_data.latitud_entrega, pedido_data.longitud_entrega, datetime.now(CARACAS_TZ).time())
+    if zona is not None:
+        logger.warning(f"Pedido rechazado: entrega ({pedido_data.latitud_entrega}, {pedido_data.longitud_entrega}) dentro de la zona restringida '{zona.name}' (ID: {zona.id}).")
+        if zona.es_24_7:
+            raise HTTPException(status_code=403, detail="La dirección de entrega se encuentra en la zona restringida")
+        raise HTTPException(status_code=403, detail=f"La dirección de entrega se encuentra en la zona restringida '{zona.name}' en este horario.")
     # --- FIN DE LA VALIDACIÓN ---
     
     # Determinar el creador del pedido basado en el 'principal' de seguridad
@@ -673,66 +629,74 @@ async def crear_pedido(
     try:
         tipo_vehiculo_str = pedido_data.tipo_vehiculo.value if hasattr(pedido_data.tipo_vehiculo, 'value') else str(pedido_data.tipo_vehiculo)
         
-        with db.cursor(cursor_factory=RealDictCursor) as cur:
-            cur.execute("SELECT valor FROM app_config WHERE clave = 'pricing_tiers'")
-            config_row = cur.fetchone()
-            if not config_row: raise HTTPException(503, "Configuración de tarifas no encontrada.")
-            
-            # Asumo que tienes una función 'calcular_costo_delivery_ruta'
-            costo_res = calcular_costo_delivery_ruta(
+        tarifas = await pricing_engine.obtener(db)
+        if not tarifas: raise HTTPException(503, "Configuración de tarifas no encontrada.")
+        
+        # Con una cotización vigente para los mismos datos se respeta su precio (sin OSRM)
+        cotizacion = await asyncio.to_thread(
+            canjear_cotizacion, pedido_data.quote_id,
+            (pedido_data.latitud_retiro, pedido_data.longitud_retiro, pedido_data.latitud_entrega, pedido_data.longitud_entrega),
+            tipo_vehiculo_str, tarifas.version.isoformat() if tarifas.version else None,
+        ) if pedido_data.quote_id else None
+        if cotizacion:
+            costo = cotizacion['costo']
+        else:
+            costo_res = await calcular_costo_delivery_ruta(
                 f"{pedido_data.latitud_retiro},{pedido_data.longitud_retiro}",
                 f"{pedido_data.latitud_entrega},{pedido_data.longitud_entrega}",
                 tipo_vehiculo_str,
-                config_completa=config_row['valor']
+                tarifas
             )
             costo = costo_res.get('costo', 0.0)
 
-            cur.execute("INSERT INTO comercios (id_comercio, nombre) VALUES (%s, %s) ON CONFLICT (id_comercio) DO NOTHING", (pedido_data.id_comercio, pedido_data.nombre_comercio))
+        async with db.transaction():
+            await db.execute("INSERT INTO comercios (id_comercio, nombre) VALUES ($1, $2) ON CONFLICT (id_comercio) DO NOTHING", pedido_data.id_comercio, pedido_data.nombre_comercio)
 
-            query = "INSERT INTO pedidos (pedido, direccion_entrega, latitud_entrega, longitud_entrega, latitud_retiro, longitud_retiro, estado, detalles, telefono_contacto, telefono_comercio, link_maps, id_comercio, costo_servicio, tipo_vehiculo, creado_por_usuario_id) VALUES (%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s,%s) RETURNING *"
-            cur.execute(query, (
+            query = "INSERT INTO pedidos (pedido, direccion_entrega, latitud_entrega, longitud_entrega, latitud_retiro, longitud_retiro, estado, detalles, telefono_contacto, telefono_comercio, link_maps, id_comercio, costo_servicio, tipo_vehiculo, creado_por_usuario_id) VALUES ($1,$2,$3,$4,$5,$6,$7,$8,$9,$10,$11,$12,$13,$14,$15) RETURNING *"
+            nuevo_pedido = dict(await db.fetchrow(query,
                 pedido_data.pedido, pedido_data.direccion_entrega, pedido_data.latitud_entrega,
                 pedido_data.longitud_entrega, pedido_data.latitud_retiro, pedido_data.longitud_retiro,
                 'pendiente', pedido_data.detalles, pedido_data.telefono_contacto,
                 pedido_data.telefono_comercio, pedido_data.link_maps, pedido_data.id_comercio,
                 costo, tipo_vehiculo_str, creado_por
             ))
-            nuevo_pedido = cur.fetchone()
 
             if pedido_data.id_externo:
-                cur.execute("INSERT INTO integraciones (pedido_id, id_externo) VALUES (%s, %s)", (nuevo_pedido['id'], pedido_data.id_externo))
+                await db.execute("INSERT INTO integraciones (pedido_id, id_externo) VALUES ($1, $2)", nuevo_pedido['id'], pedido_data.id_externo)
                 nuevo_pedido['id_externo'] = pedido_data.id_externo
             
-            log_system_action(db, "INFO", "create_order", {"id": nuevo_pedido['id'], "cost": costo}, usuario=creado_por)
-            db.commit()
+            await log_system_action_async(db, "INFO", "create_order", {"id": nuevo_pedido['id'], "cost": costo}, usuario=creado_por)
 
         nuevo_pedido['nombre_comercio'] = pedido_data.nombre_comercio
+        pedidos_pendientes_index.sync(nuevo_pedido)
         await manager.broadcast({"type": "NEW_ORDER", "data": nuevo_pedido})
         
         return Pedido(**nuevo_pedido)
         
     except Exception as e:
-        db.rollback()
         if isinstance(e, HTTPException):
             raise e
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/pedidos", response_model=List[Pedido], tags=["Pedidos"], dependencies=[Depends(get_current_user)])
-async def listar_pedidos(limit: int=100, estado: Optional[str]=None, fecha_inicio: Optional[str]=None, fecha_fin: Optional[str]=None, db=Depends(get_db)):
-    q = "SELECT p.*, c.nombre as nombre_comercio, i.id_externo FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio LEFT JOIN integraciones i ON p.id = i.pedido_id WHERE 1=1"
-    params = []
-    if estado: q += " AND p.estado = ANY(%s)"; params.append(estado.split(','))
-    if fecha_inicio: q += " AND DATE(p.fecha_creacion) >= %s"; params.append(fecha_inicio)
-    if fecha_fin: q += " AND DATE(p.fecha_creacion) <= %s"; params.append(fecha_fin)
-    q += " ORDER BY p.fecha_creacion DESC LIMIT %s"; params.append(limit)
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(q, tuple(params))
-        return [Pedido(**p) for p in cur.fetchall()]
+async def listar_pedidos(response: Response, limit: int = Query(100, ge=1, le=1000), estado: Optional[str]=None, fecha_inicio: Optional[str]=None, fecha_fin: Optional[str]=None, cursor: Optional[str] = None, db=Depends(get_read_db)):
+    """
+    Lista pedidos del más reciente al más antiguo. Si hay más resultados, la cabecera
+    'X-Next-Cursor' trae el cursor para pedir la página siguiente (?cursor=...).
+    """
+    wb = WhereBuilder()
+    if estado: wb.add("p.estado = ANY({})", estado.split(','))
+    wb.date_range("p.fecha_creacion", fecha_inicio, fecha_fin)
+    wb.keyset(("p.fecha_creacion", "p.id"), cursor)
+    q = f"SELECT p.*, c.nombre as nombre_comercio, i.id_externo FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio LEFT JOIN integraciones i ON p.id = i.pedido_id {wb.where()} ORDER BY p.fecha_creacion DESC, p.id DESC LIMIT {wb.param(limit + 1)}"
+    filas, siguiente = paginar(await db.fetch(q, *wb.params), limit, ("fecha_creacion", "id"))
+    if siguiente: response.headers["X-Next-Cursor"] = siguiente
+    return [Pedido(**p) for p in filas]
 
 
 
 @app.put("/pedidos/{pedido_id}", response_model=Pedido, tags=["Pedidos"], dependencies=[Depends(get_current_user)])
-async def editar_pedido_completo(pedido_id: int, datos: dict = Body(...), db=Depends(get_db), current_user: User = Depends(get_current_user)):
+async def editar_pedido_completo(pedido_id: int, datos: dict = Body(...), db=Depends(get_async_db), current_user: User = Depends(get_current_user)):
     
     # --- LÍNEA A MODIFICAR ---
     # Se añaden los cuatro campos de coordenadas a la lista de campos permitidos.
@@ -744,16 +708,16 @@ async def editar_pedido_completo(pedido_id: int, datos: dict = Body(...), db=Dep
         'latitud_entrega', 'longitud_entrega'      # <--- AÑADIDO
     ]
     # --- FIN DE LA MODIFICACIÓN ---
+    # asyncpg no convierte texto a número: el panel envía los campos numéricos como strings.
+    numeric_fields = {'costo_servicio', 'latitud_retiro', 'longitud_retiro', 'latitud_entrega', 'longitud_entrega'}
 
     updates = []
     values = []
     
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT repartidor_id FROM pedidos WHERE id = %s", (pedido_id,))
-        pedido_actual = cur.fetchone()
-        if not pedido_actual: raise HTTPException(404, "Pedido no encontrado")
-        
-        repartidor_anterior = pedido_actual['repartidor_id']
+    pedido_actual = await db.fetchrow("SELECT repartidor_id FROM pedidos WHERE id = $1", pedido_id)
+    if not pedido_actual: raise HTTPException(404, "Pedido no encontrado")
+    
+    repartidor_anterior = pedido_actual['repartidor_id']
 
     # Lógica de cambio de estado al cambiar repartidor
     if 'repartidor_id' in datos and datos['repartidor_id'] != repartidor_anterior:
@@ -765,40 +729,41 @@ async def editar_pedido_completo(pedido_id: int, datos: dict = Body(...), db=Dep
 
     for key, val in datos.items():
         if key in allowed_fields:
-            updates.append(f"{key} = %s")
-            values.append(val if val != '' else None)
+            val = val if val != '' else None
+            if key in numeric_fields and val is not None:
+                try: val = float(val)
+                except (TypeError, ValueError): raise HTTPException(400, f"El campo '{key}' debe ser numérico.")
+            values.append(val)
+            updates.append(f"{key} = ${len(values)}")
             
     if not updates: raise HTTPException(400, "No hay campos válidos")
     values.append(pedido_id)
     
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(f"UPDATE pedidos SET {', '.join(updates)} WHERE id = %s RETURNING *", tuple(values))
-        updated = cur.fetchone()
-        log_system_action(db, "WARNING", "edit_order_details", {"id": pedido_id, "changes": datos}, usuario=current_user.email)
-        db.commit()
-        
-        cur.execute("SELECT nombre FROM comercios WHERE id_comercio = %s", (updated['id_comercio'],))
-        updated['nombre_comercio'] = cur.fetchone()['nombre']
-        
-        await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": pedido_id, "data": updated})
-        return Pedido(**updated)
+    async with db.transaction():
+        updated = dict(await db.fetchrow(f"UPDATE pedidos SET {', '.join(updates)} WHERE id = ${len(values)} RETURNING *", *values))
+        await log_system_action_async(db, "WARNING", "edit_order_details", {"id": pedido_id, "changes": datos}, usuario=current_user.email)
+    
+    pedidos_pendientes_index.sync(updated)
+    updated['nombre_comercio'] = await db.fetchval("SELECT nombre FROM comercios WHERE id_comercio = $1", updated['id_comercio'])
+    
+    await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": pedido_id, "data": updated})
+    return Pedido(**updated)
 
 @app.patch("/pedidos/{pedido_id}/estado", response_model=Pedido, tags=["Pedidos"], dependencies=[Depends(get_current_user)])
 async def actualizar_estado_pedido(
     pedido_id: int, 
     data: PedidoEstadoUpdate,
     background_tasks: BackgroundTasks, # <-- MODIFICACIÓN
-    db=Depends(get_db), 
+    db=Depends(get_async_db), 
     current_user: User = Depends(get_current_user)
 ):
     """
     Actualiza el estado de un pedido (ej: a llevando, entregado, etc.) y dispara un webhook.
     """
     try:
-        with db.cursor(cursor_factory=RealDictCursor) as cur:
+        async with db.transaction():
             # 1. Bloquear el pedido y obtener su estado actual
-            cur.execute("SELECT estado, repartidor_id FROM pedidos WHERE id = %s FOR UPDATE", (pedido_id,))
-            pedido_actual = cur.fetchone()
+            pedido_actual = await db.fetchrow("SELECT estado, repartidor_id FROM pedidos WHERE id = $1 FOR UPDATE", pedido_id)
             if not pedido_actual:
                 raise HTTPException(status.HTTP_404_NOT_FOUND, "Pedido no encontrado")
 
@@ -812,35 +777,30 @@ async def actualizar_estado_pedido(
                 repartidor_id_final = data.repartidor_id
 
             # 3. Actualizar la base de datos
-            cur.execute(
-                "UPDATE pedidos SET estado = %s, repartidor_id = %s, fecha_actualizacion = NOW() WHERE id = %s RETURNING *",
-                (data.estado.value, repartidor_id_final, pedido_id)
-            )
-            updated = cur.fetchone()
+            updated = dict(await db.fetchrow(
+                "UPDATE pedidos SET estado = $1, repartidor_id = $2, fecha_actualizacion = NOW() WHERE id = $3 RETURNING *",
+                data.estado.value, repartidor_id_final, pedido_id
+            ))
 
             # 4. Logs
-            log_pedido_status_change(cur, pedido_id, data.estado.value, repartidor_id_final, manual_change=True)
-            log_system_action(db, "INFO", "update_status", {"id": pedido_id, "new_status": data.estado.value}, usuario=current_user.email)
-            
-            db.commit()
+            await log_pedido_status_change(db, pedido_id, data.estado.value, repartidor_id_final, manual_change=True)
+            await log_system_action_async(db, "INFO", "update_status", {"id": pedido_id, "new_status": data.estado.value}, usuario=current_user.email)
 
-            # 5. Preparar respuesta y notificar por WebSocket
-            cur.execute("SELECT nombre FROM comercios WHERE id_comercio = %s", (updated['id_comercio'],))
-            updated['nombre_comercio'] = cur.fetchone()['nombre']
-            
-            await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": pedido_id, "data": updated})
-            
-            # --- INICIO DE LA MODIFICACIÓN CLAVE ---
-            # 6. Disparar el webhook de cambio de estado en segundo plano
-            background_tasks.add_task(trigger_integration_webhooks, "ORDER_STATUS_UPDATE", updated.copy(), get_db_connection())
-            # --- FIN DE LA MODIFICACIÓN CLAVE ---
-            
-            return Pedido(**updated)
+        # 5. Preparar respuesta y notificar por WebSocket
+        pedidos_pendientes_index.sync(updated)
+        updated['nombre_comercio'] = await db.fetchval("SELECT nombre FROM comercios WHERE id_comercio = $1", updated['id_comercio'])
+        
+        await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": pedido_id, "data": updated})
+        
+        # --- INICIO DE LA MODIFICACIÓN CLAVE ---
+        # 6. Disparar el webhook de cambio de estado en segundo plano
+        background_tasks.add_task(trigger_integration_webhooks, "ORDER_STATUS_UPDATE", updated.copy())
+        # --- FIN DE LA MODIFICACIÓN CLAVE ---
+        
+        return Pedido(**updated)
     except HTTPException as http_exc:
-        db.rollback()
         raise http_exc
     except Exception as e:
-        db.rollback()
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, str(e))
 
 @app.get("/pedidos/cercanos", response_model=List[Pedido], tags=["Pedidos"])
@@ -848,7 +808,7 @@ async def listar_pedidos_cercanos(
     lat: float = Query(..., description="Latitud del usuario"),
     lng: float = Query(..., description="Longitud del usuario"),
     user: User = Depends(get_current_user), # Obtenemos el usuario autenticado
-    db=Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Obtiene pedidos cercanos usando lógica de 'Radar Expansivo'.
@@ -857,108 +817,118 @@ async def listar_pedidos_cercanos(
     - 10s a 20s: 1.2km
     - ... hasta un máximo de 3km.
     """
-    pedidos_cercanos_list = []
     id_repartidor = user.email # Asumimos que el ID es el email, ajustar si es user.uid
 
     try:
-        with db.cursor(cursor_factory=RealDictCursor) as cur:
-            # 1. Validaciones de Repartidor (Batería y Tickets)
-            cur.execute("SELECT ultima_bateria_porcentaje FROM usuarios WHERE id_usuario = %s", (id_repartidor,))
-            repartidor_info = cur.fetchone()
-            
-            # Si tiene menos de 15% de batería, no ve pedidos (regla de negocio opcional, comenta si no la quieres)
-            if repartidor_info and repartidor_info.get('ultima_bateria_porcentaje') is not None:
-                 if repartidor_info['ultima_bateria_porcentaje'] < 15:
-                     return [] 
-
-            # Si tiene un pedido con ticket abierto (bloqueado), no ve nuevos pedidos
-            cur.execute("""
-                SELECT 1 FROM pedidos p
-                WHERE p.repartidor_id = %s AND p.tiene_ticket_abierto = TRUE
-                AND p.estado NOT IN (%s, %s) LIMIT 1;
-            """, (id_repartidor, EstadoPedido.ENTREGADO.value, EstadoPedido.CANCELADO.value))
-            if cur.fetchone(): 
-                return []
-
-            # 2. Obtener Pedidos Pendientes
-            # Traemos todos los pendientes para filtrar en memoria (más rápido para pocos miles de pedidos)
-            # Ojo: Si tienes millones, esto debe ser espacial en SQL (PostGIS). Para MVP está bien así.
-            query_pedidos = """
-                SELECT p.*, c.nombre as nombre_comercio, i.id_externo
-                FROM pedidos p
-                JOIN comercios c ON p.id_comercio = c.id_comercio
-                LEFT JOIN integraciones i ON p.id = i.pedido_id
-                WHERE p.estado = %s 
-                AND (p.repartidor_id IS NULL OR p.repartidor_id = %s);
-            """
-            cur.execute(query_pedidos, (EstadoPedido.PENDIENTE.value, id_repartidor))
-            raw_pedidos = cur.fetchall()
-
-            now = datetime.now(CARACAS_TZ)
-            MAX_RADIUS_KM = 3.0
-            EXPANSION_RATE_SECONDS = 10 # Cada 10s crece 1km aprox (ajustable)
-
-            for p_dict in raw_pedidos:
-                # Convertir a modelo Pydantic para facilitar manejo
-                pedido = Pedido(**p_dict)
-                
-                # Si está asignado específicamente a este repartidor, lo ve siempre sin importar distancia
-                if pedido.repartidor_id == id_repartidor:
-                    pedidos_cercanos_list.append(pedido)
-                    continue
-
-                # Calcular edad del pedido en segundos
-                # Aseguramos que fecha_creacion tenga zona horaria
-                fecha_creacion = pedido.fecha_creacion
-                if fecha_creacion.tzinfo is None:
-                    fecha_creacion = pytz.utc.localize(fecha_creacion).astimezone(CARACAS_TZ)
-                
-                age_seconds = (now - fecha_creacion).total_seconds()
-                if age_seconds < 0: age_seconds = 0
-
-                # Lógica de Radar: Radio base 0.2km + 1km por cada intervalo de tiempo
-                # Ejemplo: 
-                # 0s -> 0.2km
-                # 10s -> 1.2km
-                # 20s -> 2.2km
-                # 30s -> 3.0km (Max)
-                dynamic_radius = min(0.2 + (age_seconds / EXPANSION_RATE_SECONDS), MAX_RADIUS_KM)
-                
-                # Calcular distancia real
-                dist = haversine(lng, lat, pedido.longitud_retiro, pedido.latitud_retiro)
-
-                if dist <= dynamic_radius:
-                    pedidos_cercanos_list.append(pedido)
-
-        # Ordenar: Los más antiguos primero (FIFO) para que se atiendan antes
-        return sorted(pedidos_cercanos_list, key=lambda p: p.fecha_creacion)
+        # 1. Validaciones de Repartidor (Batería y Tickets) en una sola consulta
+        elegibilidad = await db.fetchrow("""
+            SELECT
+                (SELECT ultima_bateria_porcentaje FROM usuarios WHERE id_usuario = $1) AS bateria,
+                EXISTS (
+                    SELECT 1 FROM pedidos p
+                    WHERE p.repartidor_id = $1 AND p.tiene_ticket_abierto = TRUE
+                    AND p.estado NOT IN ($2, $3)
+                ) AS bloqueado
+        """, id_repartidor, EstadoPedido.ENTREGADO.value, EstadoPedido.CANCELADO.value)
+
+        # Si tiene menos de 15% de batería, no ve pedidos (regla de negocio opcional, comenta si no la quieres)
+        if elegibilidad['bateria'] is not None and elegibilidad['bateria'] < DRIVER_MIN_BATTERY:
+            return []
+
+        # Si tiene un pedido con ticket abierto (bloqueado), no ve nuevos pedidos
+        if elegibilidad['bloqueado']:
+            return []
+
+        # 2a. Modo PostGIS: el radar completo (radio según la edad del pedido) se resuelve en SQL
+        if pedidos_pendientes_index.postgis:
+            return [Pedido(**p) for p in await db.fetch(RADAR_POSTGIS_QUERY, id_repartidor, lat, lng)]
+
+        # 2b. Candidatos del índice espacial: solo se revisan las celdas alrededor del repartidor
+        candidatos = pedidos_pendientes_index.buscar(lat, lng, datetime.now(CARACAS_TZ))
+
+        # 3. Datos completos de los candidatos más los pedidos asignados a este repartidor
+        # (esos los ve siempre, sin importar la distancia). Se revalida el estado en la BD.
+        # Orden: los más antiguos primero (FIFO) para que se atiendan antes
+        query_pedidos = """
+            SELECT p.*, c.nombre as nombre_comercio, i.id_externo
+            FROM pedidos p
+            JOIN comercios c ON p.id_comercio = c.id_comercio
+            LEFT JOIN integraciones i ON p.id = i.pedido_id
+            WHERE p.estado = $1
+            AND (p.repartidor_id = $2 OR (p.repartidor_id IS NULL AND p.id = ANY($3::int[])))
+            ORDER BY p.fecha_creacion ASC;
+        """
+        return [Pedido(**p) for p in await db.fetch(query_pedidos, EstadoPedido.PENDIENTE.value, id_repartidor, candidatos)]
 
     except Exception as e:
         logger.error(f"Error en /pedidos/cercanos: {e}")
         raise HTTPException(status_code=500, detail="Error interno del servidor")
 
+@app.get("/pedidos/{pedido_id}/drivers-cercanos", response_model=List[RepartidorCercano], tags=["Pedidos"], dependencies=[Depends(get_current_user)])
+async def listar_repartidores_cercanos(
+    pedido_id: int,
+    k: int = Query(5, ge=1, le=50),
+    radio_km: float = Query(5.0, gt=0, le=50),
+    db=Depends(get_read_db)
+):
+    """
+    Los k repartidores disponibles más cercanos al punto de retiro del pedido (índice GEO
+    de Redis, ver driver_geo.py). Sin Redis se usa la última posición guardada en 'usuarios'.
+    """
+    pedido = await db.fetchrow("SELECT latitud_retiro, longitud_retiro FROM pedidos WHERE id = $1", pedido_id)
+    if not pedido:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, "Pedido no encontrado")
+    if pedido['latitud_retiro'] is None or pedido['longitud_retiro'] is None:
+        raise HTTPException(status.HTTP_400_BAD_REQUEST, "El pedido no tiene coordenadas de retiro.")
+
+    candidatos = None
+    r = get_redis_client()
+    if r:
+        try:
+            # redis-py es síncrono: el GEOSEARCH y el pipeline van a un hilo, no al event loop
+            candidatos = await asyncio.to_thread(buscar_cercanos, r, pedido['latitud_retiro'], pedido['longitud_retiro'], k, radio_km)
+        except Exception as e:
+            logger.warning(f"GEOSEARCH falló, usando la tabla usuarios: {e!r}")
+    if candidatos is None:
+        candidatos = await buscar_cercanos_sql(db, pedido['latitud_retiro'], pedido['longitud_retiro'], k, radio_km)
+    if not candidatos:
+        return []
+
+    # Igual que en /pedidos/cercanos: un repartidor con un ticket abierto no recibe pedidos nuevos
+    filas = await db.fetch("""
+        SELECT u.id_usuario, u.nombre_display,
+            EXISTS (
+                SELECT 1 FROM pedidos p
+                WHERE p.repartidor_id = u.id_usuario AND p.tiene_ticket_abierto = TRUE
+                AND p.estado NOT IN ($2, $3)
+            ) AS bloqueado
+        FROM usuarios u WHERE u.id_usuario = ANY($1::varchar[])
+    """, [c['id_usuario'] for c in candidatos], EstadoPedido.ENTREGADO.value, EstadoPedido.CANCELADO.value)
+    usuarios = {f['id_usuario']: f for f in filas}
+    elegibles = [c for c in candidatos if c['id_usuario'] in usuarios and not usuarios[c['id_usuario']]['bloqueado']]
+    return [RepartidorCercano(**c, nombre_display=usuarios[c['id_usuario']]['nombre_display']) for c in elegibles[:k]]
+
 @app.post("/pedidos/{pedido_id}/aceptar", response_model=Pedido, tags=["Pedidos"])
 async def aceptar_pedido(
     pedido_id: int,
     background_tasks: BackgroundTasks,
     user: User = Depends(get_current_user),
-    db=Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Permite a un repartidor aceptar un pedido. Usa un bloqueo de fila ('FOR UPDATE')
     para prevenir que múltiples repartidores acepten el mismo pedido simultáneamente.
     """
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
+    async with db.transaction():
         # --- INICIO DE LA CORRECCIÓN CLAVE ---
         # 1. Bloquear la fila del pedido y OBTENER el nombre del comercio con un JOIN
         query = """
             SELECT p.*, c.nombre as nombre_comercio 
             FROM pedidos p
             JOIN comercios c ON p.id_comercio = c.id_comercio
-            WHERE p.id = %s FOR UPDATE
+            WHERE p.id = $1 FOR UPDATE
         """
-        cur.execute(query, (pedido_id,))
-        pedido = cur.fetchone()
+        pedido = await db.fetchrow(query, pedido_id)
         # --- FIN DE LA CORRECCIÓN CLAVE ---
 
         if not pedido:
@@ -968,42 +938,36 @@ async def aceptar_pedido(
             raise HTTPException(status_code=409, detail="Este pedido ya fue aceptado por otro repartidor.")
 
         # 2. Actualizar el pedido
-        cur.execute(
-            "UPDATE pedidos SET repartidor_id = %s, estado = 'aceptado', fecha_actualizacion = NOW() WHERE id = %s RETURNING *",
-            (user.email, pedido_id)
-        )
-        updated_pedido = cur.fetchone()
-        db.commit()
+        updated_pedido = dict(await db.fetchrow(
+            "UPDATE pedidos SET repartidor_id = $1, estado = 'aceptado', fecha_actualizacion = NOW() WHERE id = $2 RETURNING *",
+            user.email, pedido_id
+        ))
 
     # 3. Añadir el nombre del comercio a la respuesta (ahora lo tenemos del primer SELECT)
     # y notificar a todos y disparar webhooks
     updated_pedido['nombre_comercio'] = pedido['nombre_comercio']
+    pedidos_pendientes_index.sync(updated_pedido)
     
     await manager.broadcast({"type": "ORDER_ASSIGNED", "id": pedido_id, "data": updated_pedido})
-    background_tasks.add_task(trigger_integration_webhooks, "ORDER_STATUS_UPDATE", updated_pedido.copy(), get_db_connection())
+    background_tasks.add_task(trigger_integration_webhooks, "ORDER_STATUS_UPDATE", updated_pedido.copy())
 
     return Pedido(**updated_pedido)
 
 @app.get("/pedidos/{pedido_id}/logs", tags=["Pedidos"], dependencies=[Depends(get_current_user)])
-async def obtener_logs_del_pedido(pedido_id: int, db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM pedidos_logs WHERE id_pedido = %s ORDER BY timestamp_log ASC;", (pedido_id,))
-        return cur.fetchall()
+async def obtener_logs_del_pedido(pedido_id: int, db=Depends(get_async_db)):
+    return [dict(r) for r in await db.fetch("SELECT * FROM pedidos_logs WHERE id_pedido = $1 ORDER BY timestamp_log ASC;", pedido_id)]
 
 @app.post("/pedidos/programados", tags=["Pedidos"], dependencies=[Depends(get_current_user)])
-async def crear_programado(payload: dict = Body(...), fecha_liberacion: str = Body(...), db=Depends(get_db)):
+async def crear_programado(payload: dict = Body(...), fecha_liberacion: str = Body(...), db=Depends(get_async_db)):
     try:
         dt = datetime.fromisoformat(fecha_liberacion)
-        with db.cursor() as cur: cur.execute("INSERT INTO pedidos_programados (payload_pedido, fecha_liberacion) VALUES (%s, %s)", (json.dumps(payload.get('payload', payload)), dt))
-        db.commit()
+        await db.execute("INSERT INTO pedidos_programados (payload_pedido, fecha_liberacion) VALUES ($1, $2)", payload.get('payload', payload), dt)
         return {"status": "created"}
-    except Exception as e: db.rollback(); raise HTTPException(500, str(e))
+    except Exception as e: raise HTTPException(500, str(e))
 
 @app.get("/pedidos/programados", response_model=List[PedidoProgramadoResponse], tags=["Pedidos"], dependencies=[Depends(get_current_user)])
-async def listar_programados(db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM pedidos_programados WHERE estado = 'pendiente' ORDER BY fecha_liberacion ASC")
-        return cur.fetchall()
+async def listar_programados(db=Depends(get_async_db)):
+    return [dict(r) for r in await db.fetch("SELECT * FROM pedidos_programados WHERE estado = 'pendiente' ORDER BY fecha_liberacion ASC")]
 
 class ScheduledOrderUpdate(BaseModel):
     fecha_liberacion: datetime
@@ -1013,161 +977,146 @@ class ScheduledOrderUpdate(BaseModel):
 async def modificar_pedido_programado(
     programado_id: int,
     data: ScheduledOrderUpdate,
-    db=Depends(get_db),
+    db=Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     try:
-        with db.cursor() as cur:
-            cur.execute(
-                "UPDATE pedidos_programados SET fecha_liberacion = %s, payload_pedido = %s WHERE id = %s",
-                (data.fecha_liberacion, json.dumps(data.payload_pedido), programado_id)
-            )
-            if cur.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Pedido programado no encontrado")
-            db.commit()
+        result = await db.execute(
+            "UPDATE pedidos_programados SET fecha_liberacion = $1, payload_pedido = $2 WHERE id = $3",
+            data.fecha_liberacion, data.payload_pedido, programado_id
+        )
+        if result == "UPDATE 0":
+            raise HTTPException(status_code=404, detail="Pedido programado no encontrado")
         return {"status": "success", "id": programado_id}
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/pedidos/programados/{programado_id}", status_code=200, tags=["Pedidos"])
 async def eliminar_pedido_programado(
     programado_id: int,
-    db=Depends(get_db),
+    db=Depends(get_async_db),
     current_user: User = Depends(get_current_user)
 ):
     try:
-        with db.cursor() as cur:
-            cur.execute("DELETE FROM pedidos_programados WHERE id = %s", (programado_id,))
-            if cur.rowcount == 0:
-                raise HTTPException(status_code=404, detail="Pedido programado no encontrado")
-            db.commit()
+        result = await db.execute("DELETE FROM pedidos_programados WHERE id = $1", programado_id)
+        if result == "DELETE 0":
+            raise HTTPException(status_code=404, detail="Pedido programado no encontrado")
         return {"status": "deleted", "id": programado_id}
+    except HTTPException:
+        raise
     except Exception as e:
-        db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/pedidos/{pedido_id}", response_model=Pedido, tags=["Pedidos"], dependencies=[Depends(get_current_user)])
-async def obtener_pedido_por_id(pedido_id: int, db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT p.*, c.nombre as nombre_comercio, i.id_externo FROM pedidos p LEFT JOIN comercios c ON p.id_comercio = c.id_comercio LEFT JOIN integraciones i ON p.id = i.pedido_id WHERE p.id = %s;", (pedido_id,))
-        pedido = cur.fetchone()
-        if not pedido: raise HTTPException(404, f"Pedido {pedido_id} no encontrado.")
-        return Pedido(**pedido)
+async def obtener_pedido_por_id(pedido_id: int, db=Depends(get_async_db)):
+    pedido = await db.fetchrow("SELECT p.*, c.nombre as nombre_comercio, i.id_externo FROM pedidos p LEFT JOIN comercios c ON p.id_comercio = c.id_comercio LEFT JOIN integraciones i ON p.id = i.pedido_id WHERE p.id = $1;", pedido_id)
+    if not pedido: raise HTTPException(404, f"Pedido {pedido_id} no encontrado.")
+    return Pedido(**pedido)
 # --- ENDPOINTS TICKETS ---
 
 @app.post("/pedidos/{pedido_id}/repartidor/{id_repartidor}/tickets", response_model=Ticket, tags=["Tickets"])
-async def crear_ticket_para_pedido(pedido_id: int, id_repartidor: str, data: TicketCreate, db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT estado, repartidor_id FROM pedidos WHERE id = %s FOR UPDATE", (pedido_id,))
-        pedido = cur.fetchone()
+async def crear_ticket_para_pedido(pedido_id: int, id_repartidor: str, data: TicketCreate, db=Depends(get_async_db)):
+    async with db.transaction():
+        pedido = await db.fetchrow("SELECT estado, repartidor_id FROM pedidos WHERE id = $1 FOR UPDATE", pedido_id)
         if not pedido: raise HTTPException(404, "Pedido no encontrado")
         if pedido['repartidor_id'] != id_repartidor: raise HTTPException(403, "No puedes crear ticket para este pedido")
         estado_previo = pedido['estado']
-        cur.execute("UPDATE pedidos SET estado = %s, tiene_ticket_abierto = TRUE, estado_previo_novedad = %s WHERE id = %s", ('con_novedad', estado_previo, pedido_id))
-        cur.execute("INSERT INTO tickets (id_pedido, id_usuario_creador, asunto_ticket) VALUES (%s, %s, %s) RETURNING *", (pedido_id, id_repartidor, data.asunto_ticket))
-        nuevo_ticket = cur.fetchone()
-        log_system_action(db, "WARNING", "ticket_created", {"id": nuevo_ticket['id_ticket'], "pedido": pedido_id}, usuario=id_repartidor)
-        db.commit()
-        await manager.broadcast({"type": "NEW_TICKET", "data": nuevo_ticket})
-        cur.execute("SELECT p.*, c.nombre as nombre_comercio FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio WHERE p.id = %s", (pedido_id,))
-        await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": pedido_id, "data": cur.fetchone()})
-        return Ticket(**nuevo_ticket)
+        await db.execute("UPDATE pedidos SET estado = $1, tiene_ticket_abierto = TRUE, estado_previo_novedad = $2 WHERE id = $3", 'con_novedad', estado_previo, pedido_id)
+        nuevo_ticket = dict(await db.fetchrow("INSERT INTO tickets (id_pedido, id_usuario_creador, asunto_ticket) VALUES ($1, $2, $3) RETURNING *", pedido_id, id_repartidor, data.asunto_ticket))
+        await log_system_action_async(db, "WARNING", "ticket_created", {"id": nuevo_ticket['id_ticket'], "pedido": pedido_id}, usuario=id_repartidor)
+    pedidos_pendientes_index.discard(pedido_id)
+    await manager.broadcast({"type": "NEW_TICKET", "data": nuevo_ticket})
+    pedido_actualizado = await db.fetchrow("SELECT p.*, c.nombre as nombre_comercio FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio WHERE p.id = $1", pedido_id)
+    await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": pedido_id, "data": dict(pedido_actualizado)})
+    return Ticket(**nuevo_ticket)
 
 @app.get("/tickets/active", tags=["Tickets"], dependencies=[Depends(get_current_user)])
-async def get_active_tickets(db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT t.*, p.pedido as nombre_pedido, u.nombre_display as creador_display FROM tickets t JOIN pedidos p ON t.id_pedido = p.id JOIN usuarios u ON t.id_usuario_creador = u.id_usuario WHERE t.estado_ticket IN ('abierto', 'en_progreso') ORDER BY t.fecha_creacion_ticket DESC")
-        return cur.fetchall()
+async def get_active_tickets(response: Response, limit: Optional[int] = Query(None, ge=1, le=1000), cursor: Optional[str] = None, db=Depends(get_async_db)):
+    """Sin 'limit' devuelve todos los tickets activos; con 'limit' pagina con 'X-Next-Cursor'."""
+    wb = WhereBuilder().add("t.estado_ticket IN ('abierto', 'en_progreso')")
+    wb.keyset(("t.fecha_creacion_ticket", "t.id_ticket"), cursor)
+    q = f"SELECT t.*, p.pedido as nombre_pedido, u.nombre_display as creador_display FROM tickets t JOIN pedidos p ON t.id_pedido = p.id JOIN usuarios u ON t.id_usuario_creador = u.id_usuario {wb.where()} ORDER BY t.fecha_creacion_ticket DESC, t.id_ticket DESC"
+    if limit is None:
+        return [dict(r) for r in await db.fetch(q, *wb.params)]
+    filas, siguiente = paginar(await db.fetch(f"{q} LIMIT {wb.param(limit + 1)}", *wb.params), limit, ("fecha_creacion_ticket", "id_ticket"))
+    if siguiente: response.headers["X-Next-Cursor"] = siguiente
+    return [dict(r) for r in filas]
 
 @app.get("/tickets/{ticket_id}/mensajes", response_model=List[MensajeTicket], tags=["Tickets"], dependencies=[Depends(get_current_user)])
-async def listar_mensajes_por_ticket(ticket_id: int, db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM mensajes_ticket WHERE id_ticket = %s ORDER BY timestamp_mensaje ASC", (ticket_id,))
-        return [MensajeTicket(**m) for m in cur.fetchall()]
+async def listar_mensajes_por_ticket(ticket_id: int, db=Depends(get_async_db)):
+    return [MensajeTicket(**m) for m in await db.fetch("SELECT * FROM mensajes_ticket WHERE id_ticket = $1 ORDER BY timestamp_mensaje ASC", ticket_id)]
 
 @app.post("/tickets/{ticket_id}/mensajes", response_model=MensajeTicket, tags=["Tickets"], dependencies=[Depends(get_current_user)])
-async def agregar_mensaje_a_ticket(ticket_id: int, contenido_mensaje: Optional[str] = Form(""), id_remitente: str = Form(...), tipo_remitente: TipoRemitenteTicket = Form(...), archivo_adjunto: Optional[UploadFile] = File(None), db=Depends(get_db)):
+async def agregar_mensaje_a_ticket(ticket_id: int, contenido_mensaje: Optional[str] = Form(""), id_remitente: str = Form(...), tipo_remitente: TipoRemitenteTicket = Form(...), archivo_adjunto: Optional[UploadFile] = File(None), db=Depends(get_async_db)):
     if not contenido_mensaje and not archivo_adjunto: raise HTTPException(400, "Se requiere contenido o archivo.")
     filename = None
     if archivo_adjunto:
         filename = f"{uuid.uuid4()}_{archivo_adjunto.filename}"
         with open(os.path.join(UPLOAD_DIR, filename), "wb") as f: shutil.copyfileobj(archivo_adjunto.file, f)
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("INSERT INTO mensajes_ticket (id_ticket, id_remitente, tipo_remitente, contenido_mensaje, nombre_archivo_adjunto) VALUES (%s, %s, %s, %s, %s) RETURNING *", (ticket_id, id_remitente, tipo_remitente.value, contenido_mensaje, filename))
-        msg = cur.fetchone()
-        db.commit()
-        await manager.broadcast({"type": "NEW_TICKET_MESSAGE", "data": msg})
-        return MensajeTicket(**msg)
+    msg = dict(await db.fetchrow("INSERT INTO mensajes_ticket (id_ticket, id_remitente, tipo_remitente, contenido_mensaje, nombre_archivo_adjunto) VALUES ($1, $2, $3, $4, $5) RETURNING *", ticket_id, id_remitente, tipo_remitente.value, contenido_mensaje, filename))
+    await manager.broadcast({"type": "NEW_TICKET_MESSAGE", "data": msg})
+    return MensajeTicket(**msg)
 
 @app.patch("/tickets/{ticket_id}/estado", response_model=Ticket, tags=["Tickets"], dependencies=[Depends(get_current_user)])
-async def actualizar_estado_ticket(ticket_id: int, data: TicketEstadoUpdate, db=Depends(get_db), current_user: User = Depends(get_current_user)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT id_pedido FROM tickets WHERE id_ticket = %s FOR UPDATE", (ticket_id,))
-        ticket_info = cur.fetchone()
+async def actualizar_estado_ticket(ticket_id: int, data: TicketEstadoUpdate, db=Depends(get_async_db), current_user: User = Depends(get_current_user)):
+    async with db.transaction():
+        ticket_info = await db.fetchrow("SELECT id_pedido FROM tickets WHERE id_ticket = $1 FOR UPDATE", ticket_id)
         if not ticket_info: raise HTTPException(404, "Ticket no encontrado")
-        cur.execute("UPDATE tickets SET estado_ticket = %s WHERE id_ticket = %s RETURNING *", (data.estado_ticket.value, ticket_id))
-        ticket_actualizado = cur.fetchone()
+        ticket_actualizado = dict(await db.fetchrow("UPDATE tickets SET estado_ticket = $1 WHERE id_ticket = $2 RETURNING *", data.estado_ticket.value, ticket_id))
         if data.estado_ticket in [EstadoTicket.RESUELTO, EstadoTicket.CERRADO]:
-            cur.execute("SELECT estado_previo_novedad FROM pedidos WHERE id = %s", (ticket_info['id_pedido'],))
-            estado_a_restaurar = cur.fetchone()['estado_previo_novedad'] or 'aceptado'
-            cur.execute("UPDATE pedidos SET estado = %s, tiene_ticket_abierto = FALSE WHERE id = %s", (estado_a_restaurar, ticket_info['id_pedido']))
-        log_system_action(db, "INFO", "ticket_status_updated", {"id": ticket_id, "new": data.estado_ticket.value}, usuario=current_user.email)
-        db.commit()
-        await manager.broadcast({"type": "TICKET_STATUS_UPDATE", "data": ticket_actualizado})
-        cur.execute("SELECT p.*, c.nombre as nombre_comercio FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio WHERE p.id = %s", (ticket_info['id_pedido'],))
-        await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": ticket_info['id_pedido'], "data": cur.fetchone()})
-        return Ticket(**ticket_actualizado)
+            estado_a_restaurar = await db.fetchval("SELECT estado_previo_novedad FROM pedidos WHERE id = $1", ticket_info['id_pedido']) or 'aceptado'
+            await db.execute("UPDATE pedidos SET estado = $1, tiene_ticket_abierto = FALSE WHERE id = $2", estado_a_restaurar, ticket_info['id_pedido'])
+        await log_system_action_async(db, "INFO", "ticket_status_updated", {"id": ticket_id, "new": data.estado_ticket.value}, usuario=current_user.email)
+    await manager.broadcast({"type": "TICKET_STATUS_UPDATE", "data": ticket_actualizado})
+    pedido_actualizado = await db.fetchrow("SELECT p.*, c.nombre as nombre_comercio FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio WHERE p.id = $1", ticket_info['id_pedido'])
+    pedidos_pendientes_index.sync(dict(pedido_actualizado))
+    await manager.broadcast({"type": "ORDER_STATUS_UPDATE", "id": ticket_info['id_pedido'], "data": dict(pedido_actualizado)})
+    return Ticket(**ticket_actualizado)
 
 # --- DASHBOARD, DRIVERS, USUARIOS ---
 @app.get("/dashboard/summary", tags=["Dashboard"], dependencies=[Depends(get_current_user)])
-async def get_dashboard_summary(db=Depends(get_db)):
+async def get_dashboard_summary(db=Depends(get_async_db)):
     """Métricas en tiempo real para el Dashboard de React."""
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        # Pedidos Creados Hoy
-        cur.execute("SELECT COUNT(*) as total FROM pedidos WHERE DATE(fecha_creacion) = CURRENT_DATE;")
-        pedidos_hoy = cur.fetchone()['total']
-        
-        # Pedidos Completados Hoy (Entregados)
-        cur.execute("SELECT COUNT(*) as total FROM pedidos WHERE estado = 'entregado' AND DATE(fecha_creacion) = CURRENT_DATE;")
-        pedidos_completados_hoy = cur.fetchone()['total']
-        
-        # --- CORRECCIÓN CLAVE AQUÍ ---
-        # Cambiar el intervalo de 30 a 10 minutos para la definición de "activo"
-        cur.execute("SELECT COUNT(DISTINCT id_usuario) as total FROM usuarios WHERE ultima_actualizacion_loc >= NOW() - INTERVAL '10 minutes';")
-        drivers_activos = cur.fetchone()['total']
-        # --- FIN DE LA CORRECCIÓN ---
-        
-        # Tickets Abiertos
-        cur.execute("SELECT COUNT(*) as total FROM tickets WHERE estado_ticket = 'abierto';")
-        tickets_abiertos = cur.fetchone()['total']
-
-        return {
-            "pedidos_hoy": pedidos_hoy,
-            "pedidos_completados_hoy": pedidos_completados_hoy,
-            "drivers_activos": drivers_activos,
-            "tickets_abiertos": tickets_abiertos
-        }
+    # Pedidos Creados Hoy (día de Caracas como rango [00:00, 00:00 del día siguiente))
+    hoy_wb = WhereBuilder().date_range("fecha_creacion", hoy(), hoy())
+    pedidos_hoy = await db.fetchval(f"SELECT COUNT(*) as total FROM pedidos {hoy_wb.where()};", *hoy_wb.params)
+    
+    # Pedidos Completados Hoy (Entregados)
+    pedidos_completados_hoy = await db.fetchval(f"SELECT COUNT(*) as total FROM pedidos {hoy_wb.where()} AND estado = 'entregado';", *hoy_wb.params)
+    
+    # --- CORRECCIÓN CLAVE AQUÍ ---
+    # Cambiar el intervalo de 30 a 10 minutos para la definición de "activo"
+    drivers_activos = await db.fetchval("SELECT COUNT(DISTINCT id_usuario) as total FROM usuarios WHERE ultima_actualizacion_loc >= NOW() - INTERVAL '10 minutes';")
+    # --- FIN DE LA CORRECCIÓN ---
+    
+    # Tickets Abiertos
+    tickets_abiertos = await db.fetchval("SELECT COUNT(*) as total FROM tickets WHERE estado_ticket = 'abierto';")
+
+    return {
+        "pedidos_hoy": pedidos_hoy,
+        "pedidos_completados_hoy": pedidos_completados_hoy,
+        "drivers_activos": drivers_activos,
+        "tickets_abiertos": tickets_abiertos
+    }
 
 @app.get("/drivers/detailed", tags=["Drivers"], dependencies=[Depends(get_current_user)])
-async def get_drivers_detailed(db=Depends(get_db)):
+async def get_drivers_detailed(db=Depends(get_read_db)):
     query = "SELECT u.*, (SELECT json_build_object('id', p.id, 'fecha', p.fecha_creacion, 'comercio', c.nombre, 'monto', p.costo_servicio) FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio WHERE p.repartidor_id = u.id_usuario AND p.estado = 'entregado' ORDER BY p.fecha_creacion DESC LIMIT 1) as ultimo_pedido FROM usuarios u WHERE u.ultima_latitud IS NOT NULL ORDER BY u.ultima_actualizacion_loc DESC NULLS LAST;"
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(query)
-        res = cur.fetchall()
-        for d in res:
-            if d.get('ultimo_pedido') and isinstance(d['ultimo_pedido'], str): d['ultimo_pedido'] = json.loads(d['ultimo_pedido'])
-        return res
+    res = [dict(r) for r in await db.fetch(query)]
+    for d in res:
+        if d.get('ultimo_pedido') and isinstance(d['ultimo_pedido'], str): d['ultimo_pedido'] = json.loads(d['ultimo_pedido'])
+    return res
 
 @app.post("/ubicaciones", tags=["Ubicaciones"])
 async def actualizar_ubicacion_usuario(
     data: UbicacionUsuario,
     background_tasks: BackgroundTasks, # <-- MODIFICACIÓN: Inyectar BackgroundTasks
-    db=Depends(get_db)
 ):
     """
-    Actualiza la ubicación de un usuario, la guarda en la BD, notifica por WebSocket
-    y dispara un webhook de integración si aplica.
+    Actualiza la ubicación de un usuario, la encola para guardarla en la BD en bloque
+    (ver location_ingest.py), notifica por WebSocket y dispara un webhook de integración si aplica.
     """
     ts = data.timestamp.astimezone(CARACAS_TZ)
     
@@ -1178,48 +1127,82 @@ async def actualizar_ubicacion_usuario(
     r = get_redis_client()
     if r:
         try:
-            r.hset(f"driver:{data.id_usuario}", mapping={"lat": data.latitud, "lng": data.longitud, "estado": data.estado, "bat": data.bateria_porcentaje or 0, "ts": str(ts)})
-            r.expire(f"driver:{data.id_usuario}", 3600)
+            await asyncio.to_thread(
+                registrar_ubicacion, r, data.id_usuario, data.latitud, data.longitud, data.estado, data.bateria_porcentaje, str(ts)
+            )
         except Exception as e:
             logger.warning(f"No se pudo escribir la ubicación en Redis: {e}")
 
-    # Guardar en la base de datos para persistencia.
-    with db.cursor() as cur:
-        cur.execute("INSERT INTO usuarios (id_usuario, ultima_latitud, ultima_longitud, ultima_actualizacion_loc, estado_actual, ultima_bateria_porcentaje) VALUES (%s,%s,%s,%s,%s,%s) ON CONFLICT (id_usuario) DO UPDATE SET ultima_latitud=EXCLUDED.ultima_latitud, ultima_longitud=EXCLUDED.ultima_longitud, ultima_actualizacion_loc=EXCLUDED.ultima_actualizacion_loc, estado_actual=EXCLUDED.estado_actual, ultima_bateria_porcentaje=EXCLUDED.ultima_bateria_porcentaje", (data.id_usuario, data.latitud, data.longitud, ts, data.estado, data.bateria_porcentaje))
-        cur.execute("INSERT INTO ubicaciones_log (id_usuario, latitud, longitud, timestamp) VALUES (%s,%s,%s,%s)", (data.id_usuario, data.latitud, data.longitud, ts))
-        db.commit()
+    # Encolar para persistencia. El upsert en 'usuarios' y el log se escriben en bloque.
+    try:
+        await location_ingest.submit(data.id_usuario, data.latitud, data.longitud, ts, data.estado, data.bateria_porcentaje)
+    except ValueError as e:
+        # Dato inválido (id de usuario demasiado largo, o rechazado por la BD en modo 'sync')
+        raise HTTPException(status_code=422, detail=str(e))
+    except Exception as e:
+        # Solo ocurre en modo 'sync', cuando falla el lote que contenía este ping
+        logger.error(f"No se pudo persistir la ubicación de {data.id_usuario}: {e!r}")
+        raise HTTPException(status_code=503, detail="No se pudo guardar la ubicación. Reintente.")
 
     # --- INICIO DE LA MODIFICACIÓN ---
     # Disparamos el webhook de ubicación en segundo plano.
     # La función trigger_integration_webhooks se encargará de buscar el pedido activo del repartidor.
-    background_tasks.add_task(trigger_integration_webhooks, "DRIVER_LOCATION_UPDATE", data.model_dump(), get_db_connection())
+    background_tasks.add_task(trigger_integration_webhooks, "DRIVER_LOCATION_UPDATE", data.model_dump())
     # --- FIN DE LA MODIFICACIÓN ---
         
     return {"msg": "OK"}
     
 @app.get("/usuarios/{id_usuario}", response_model=Usuario, tags=["Usuarios"], dependencies=[Depends(get_current_user)])
-async def obtener_usuario(id_usuario: str, db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM usuarios WHERE id_usuario = %s", (id_usuario,))
-        data = cur.fetchone()
-        if not data: raise HTTPException(404, "Usuario no encontrado")
-        return Usuario(**data)
+async def obtener_usuario(id_usuario: str, db=Depends(get_async_db)):
+    data = await db.fetchrow("SELECT * FROM usuarios WHERE id_usuario = $1", id_usuario)
+    if not data: raise HTTPException(404, "Usuario no encontrado")
+    return Usuario(**data)
 
 # --- LOGS, CONFIG, GEOCODING, REPORTES ---
 @app.get("/system/logs", tags=["System"], dependencies=[Depends(get_current_user)])
-async def get_system_logs(limit: int = 100, db=Depends(get_db)):
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM system_logs ORDER BY timestamp DESC LIMIT %s", (limit,))
-        return cur.fetchall()
+async def get_system_logs(response: Response, limit: int = Query(100, ge=1, le=1000), dias: Optional[int] = Query(None, ge=1), cursor: Optional[str] = None, db=Depends(get_read_db)):
+    # 'dias' (opcional) permite a Postgres descartar las particiones antiguas de system_logs
+    wb = WhereBuilder()
+    if dias is not None:
+        wb.add("timestamp >= NOW() - make_interval(days => {})", dias)
+    wb.keyset(("timestamp", "id"), cursor)
+    filas, siguiente = paginar(
+        await db.fetch(f"SELECT * FROM system_logs {wb.where()} ORDER BY timestamp DESC, id DESC LIMIT {wb.param(limit + 1)}", *wb.params),
+        limit, ("timestamp", "id")
+    )
+    if siguiente: response.headers["X-Next-Cursor"] = siguiente
+    return [dict(r) for r in filas]
+
+@app.get("/system/metrics", tags=["System"], dependencies=[Depends(get_current_user)])
+async def get_system_metrics():
+    """Métricas internas para monitoreo (pool de conexiones, etc.)."""
+    return {
+        "db_pool": db_pool.stats(),
+        "async_db_pool": async_db.stats(),
+        "replica_db_pool": replica_db.stats() if replica_db else None,
+        "read_routing": read_router.stats(),
+        "outbound": outbound_stats(),
+        "partitions": partitions_stats(),
+        "location_ingest": location_ingest.stats(),
+        "pedidos_index": pedidos_pendientes_index.stats(),
+        "zone_index": zonas_restringidas.stats(),
+        "drivers_geo": await asyncio.to_thread(driver_geo_stats),
+        "dispatch": dispatch_engine.stats(),
+        "route_matrix": route_matrix_stats(),
+        "route_cache": route_cache.stats(),
+        "road_router": road_router.stats(),
+        "pricing": pricing_engine.stats(),
+        "quotes": quotes_stats(),
+    }
 
 @app.get("/config", tags=["Config"], dependencies=[Depends(get_current_user)])
-async def get_all_config_keys(db=Depends(get_db)):
+def get_all_config_keys(db=Depends(get_db)):
     with db.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute("SELECT clave, updated_at FROM app_config ORDER BY clave ASC")
         return cur.fetchall()
 
 @app.get("/config/{key}", tags=["Config"], dependencies=[Depends(get_current_user)])
-async def get_config_by_key(key: str, db=Depends(get_db)):
+def get_config_by_key(key: str, db=Depends(get_db)):
     with db.cursor() as cur:
         cur.execute("SELECT valor FROM app_config WHERE clave = %s", (key,))
         res = cur.fetchone()
@@ -1227,7 +1210,7 @@ async def get_config_by_key(key: str, db=Depends(get_db)):
         return res[0]
 
 @app.put("/config/{key}", tags=["Config"], dependencies=[Depends(get_current_user)])
-async def update_config_by_key(key: str, value: Any = Body(...), db=Depends(get_db), current_user: User = Depends(get_current_user)):
+def update_config_by_key(key: str, value: Any = Body(...), db=Depends(get_db), current_user: User = Depends(get_current_user)):
     """
     Actualiza o crea una clave de configuración.
     (Versión final protegida por rol 'admin').
@@ -1249,17 +1232,76 @@ async def update_config_by_key(key: str, value: Any = Body(...), db=Depends(get_
     # Logueamos con el email del admin que hizo el cambio
     log_system_action(db, "CRITICAL", "config_updated", {"key": key}, usuario=current_user.email)
     db.commit()
+    if key == PRICING_CONFIG_KEY:
+        pricing_engine.invalidar()
     return {"status": "success", "key": key, "value": value}
 
+async def cotizar_items(items: List[CotizacionItem]) -> tuple:
+    """
+    Cotiza y emite (Redis) las cotizaciones de una lista de items. Las rutas se resuelven en
+    un solo paso (matriz OSRM o consultas en paralelo acotado) y las tarifas se aplican
+    vectorizadas. Devuelve (versión de tarifas, resultados en el mismo orden).
+    """
+    async with async_db.connection() as conn:
+        tarifas = await pricing_engine.obtener(conn)
+    if not tarifas:
+        raise HTTPException(503, "Configuración de tarifas no encontrada.")
+
+    pares = [(i.latitud_retiro, i.longitud_retiro, i.latitud_entrega, i.longitud_entrega) for i in items]
+    rutas = await rutas_para_pares(pares)
+    tipos = [i.tipo_vehiculo.value for i in items]
+    precios = tarifas.cotizar_lote([ruta for ruta, _ in rutas], tipos)
+
+    resultados, emitibles = [], []
+    for item, puntos, tipo, (ruta, estimado), precio in zip(items, pares, tipos, rutas, precios):
+        resultado = CotizacionResultado(
+            referencia=item.referencia, tipo_vehiculo=tipo,
+            origen=f"{item.latitud_retiro},{item.longitud_retiro}", destino=f"{item.latitud_entrega},{item.longitud_entrega}",
+            distancia_km=round(ruta['km'], 2), distancia_texto=ruta['distancia_texto'], duracion_texto=ruta['duracion_texto'],
+            estimado=estimado,
+        )
+        if isinstance(precio, dict):
+            resultado.error = precio["error"]
+        else:
+            resultado.tier_aplicado, resultado.costo, resultado.moneda = precio
+            emitibles.append((resultado, puntos))
+        resultados.append(resultado)
+
+    version = tarifas.version.isoformat() if tarifas.version else None
+    vence = datetime.now(CARACAS_TZ) + timedelta(seconds=QUOTE_TTL_SECONDS)
+    ids = await asyncio.to_thread(emitir_cotizaciones, [{
+        "puntos": [float(v) for v in puntos], "tipo_vehiculo": r.tipo_vehiculo, "pricing_version": version,
+        "km": r.distancia_km, "tier_aplicado": r.tier_aplicado, "costo": r.costo, "moneda": r.moneda, "estimado": r.estimado,
+    } for r, puntos in emitibles])
+    for (resultado, _), quote_id in zip(emitibles, ids):
+        if quote_id:
+            resultado.quote_id, resultado.quote_expires_at = quote_id, vence
+    return tarifas.version, resultados
+
+@app.post("/pricing/quote", response_model=CotizacionResultado, tags=["Pricing"])
+async def cotizar(item: CotizacionItem, principal: Any = Depends(get_current_principal)):
+    """Cotiza un envío. Con 'quote_id', POST /pedidos respeta este precio mientras siga vigente."""
+    _, resultados = await cotizar_items([item])
+    return resultados[0]
+
+@app.post("/pricing/quotes", response_model=CotizacionLoteResponse, tags=["Pricing"])
+async def cotizar_en_lote(data: CotizacionLoteRequest, principal: Any = Depends(get_current_principal)):
+    """
+    Cotiza muchos envíos a la vez (listas de entregas de un comercio). Un resultado por item,
+    en el mismo orden, cada uno con su 'quote_id'.
+    """
+    version, resultados = await cotizar_items(data.items)
+    return CotizacionLoteResponse(pricing_version=version, results=resultados)
+
 @app.get("/geocoding/autocomplete", tags=["Geocoding"], dependencies=[Depends(get_current_user)])
 async def autocomplete_address(input: str = Query(...)):
-    res = get_address_autocomplete(input, str(uuid.uuid4()))
+    res = await get_address_autocomplete(input, str(uuid.uuid4()))
     if "error" in res: raise HTTPException(500, res["error"])
     return res
 
 @app.get("/geocoding/details", tags=["Geocoding"], dependencies=[Depends(get_current_user)])
 async def get_coordinates_for_place(place_id: str = Query(...)):
-    res = get_place_details(place_id, str(uuid.uuid4()))
+    res = await get_place_details(place_id, str(uuid.uuid4()))
     if "error" in res: raise HTTPException(500, res["error"])
     return res
     
@@ -1271,7 +1313,7 @@ async def get_report_definitions():
     }
 
 @app.post("/reports/generate", tags=["Reports"], dependencies=[Depends(get_current_user)])
-async def generate_report(request: Request, db=Depends(get_db)):
+async def generate_report(request: Request, db=Depends(get_read_db)):
     config = await request.json()
     selected_keys, filters_config = config.get('columns', []), config.get('filters', {})
     
@@ -1290,67 +1332,68 @@ async def generate_report(request: Request, db=Depends(get_db)):
     
     base_query = "FROM pedidos p LEFT JOIN usuarios u ON p.repartidor_id = u.id_usuario LEFT JOIN comercios c ON p.id_comercio = c.id_comercio"
     
-    where_clauses, params = [], []
+    wb = WhereBuilder()
     for key, value in filters_config.items():
         if key in REPORT_DEFINITIONS['filters'] and value:
             # Soporte para múltiples estados
-            if key == 'estado' and isinstance(value, list):
-                where_clauses.append(f"p.estado = ANY(%s)")
-                params.append(value)
-            elif key == 'estado':
-                where_clauses.append(REPORT_DEFINITIONS['filters'][key])
-                params.append([value]) # Asegurarse de que sea una lista para ANY
-            else:
-                where_clauses.append(REPORT_DEFINITIONS['filters'][key])
-                params.append(value)
-
-    where_string = f"WHERE {' AND '.join(where_clauses)}" if where_clauses else ""
+            if key == 'estado':
+                value = value if isinstance(value, list) else [value] # Asegurarse de que sea una lista para ANY
+            # Los días se convierten en límites de un rango semiabierto en hora de Caracas
+            elif key == 'fecha_inicio':
+                value = inicio_del_dia(value)
+            elif key == 'fecha_fin':
+                value = fin_del_dia(value)
+            wb.add(REPORT_DEFINITIONS['filters'][key], value)
+
+    where_string, params = wb.where(), wb.params
     full_query = f"SELECT {', '.join(select_clauses)} {base_query} {where_string} ORDER BY p.fecha_creacion DESC LIMIT 1000;"
 
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        # --- Ejecutar Query Principal ---
-        cur.execute(full_query, tuple(params))
-        data = cur.fetchall()
-        results = [{k: float(v) if isinstance(v, Decimal) else v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()} for row in data]
-
-        # --- NUEVO: Ejecutar Query de Resumen ---
-        summary_query = f"SELECT COUNT(*) as total_records, SUM(p.costo_servicio) as total_costo_servicio {base_query} {where_string}"
-        cur.execute(summary_query, tuple(params))
-        summary_data = cur.fetchone()
-
-        summary = {
-            "total_records": summary_data.get('total_records', 0),
-            "total_costo_servicio": float(summary_data.get('total_costo_servicio', 0) or 0)
-        }
+    # --- Ejecutar Query Principal ---
+    data = await db.fetch(full_query, *params)
+    results = [{k: float(v) if isinstance(v, Decimal) else v.isoformat() if isinstance(v, datetime) else v for k, v in row.items()} for row in data]
 
-        # --- Formato de respuesta ---
-        response_data = {
-            "headers": headers, 
-            "keys": selected_keys, 
-            "data": results,
-            "summary": summary # Añadir el resumen a la respuesta JSON
-        }
+    # --- NUEVO: Ejecutar Query de Resumen ---
+    summary_query = f"SELECT COUNT(*) as total_records, SUM(p.costo_servicio) as total_costo_servicio {base_query} {where_string}"
+    summary_data = await db.fetchrow(summary_query, *params)
 
-        if "text/csv" in request.headers.get("accept", ""):
-            output = io.StringIO()
-            writer = csv.DictWriter(output, fieldnames=selected_keys)
-            writer.writerow(dict(zip(selected_keys, headers)))
-            writer.writerows(results)
-            return Response(output.getvalue(), media_type="text/csv", headers={"Content-Disposition": "attachment; filename=reporte.csv"})
-        
-        return response_data
+    summary = {
+        "total_records": summary_data['total_records'] or 0,
+        "total_costo_servicio": float(summary_data['total_costo_servicio'] or 0)
+    }
+
+    # --- Formato de respuesta ---
+    response_data = {
+        "headers": headers, 
+        "keys": selected_keys, 
+        "data": results,
+        "summary": summary # Añadir el resumen a la respuesta JSON
+    }
+
+    if "text/csv" in request.headers.get("accept", ""):
+        output = io.StringIO()
+        writer = csv.DictWriter(output, fieldnames=selected_keys)
+        writer.writerow(dict(zip(selected_keys, headers)))
+        writer.writerows(results)
+        return Response(output.getvalue(), media_type="text/csv", headers={"Content-Disposition": "attachment; filename=reporte.csv"})
+    
+    return response_data
 
 @app.get("/comercios", response_model=List[Comercio], tags=["Comercios"], dependencies=[Depends(get_current_user)])
-async def listar_comercios(db=Depends(get_db)):
+async def listar_comercios(response: Response, limit: Optional[int] = Query(None, ge=1, le=1000), cursor: Optional[str] = None, db=Depends(get_read_db)):
     """
     Obtiene una lista de todos los comercios, ordenados alfabéticamente.
+    Con 'limit' devuelve una página y el cursor de la siguiente en 'X-Next-Cursor'.
     """
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT * FROM comercios ORDER BY nombre ASC")
-        return [Comercio(**c) for c in cur.fetchall()]
+    wb = WhereBuilder().keyset(("nombre", "id_comercio"), cursor, descendente=False)
+    q = f"SELECT * FROM comercios {wb.where()} ORDER BY nombre ASC, id_comercio ASC"
+    if limit is None:
+        return [Comercio(**c) for c in await db.fetch(q, *wb.params)]
+    filas, siguiente = paginar(await db.fetch(f"{q} LIMIT {wb.param(limit + 1)}", *wb.params), limit, ("nombre", "id_comercio"))
+    if siguiente: response.headers["X-Next-Cursor"] = siguiente
+    return [Comercio(**c) for c in filas]
 
 @app.get("/comercios/{comercio_id}", response_model=Comercio, tags=["Comercios"], dependencies=[Depends(get_current_user)])
-async def obtener_comercio_por_id(comercio_id: str, db=Depends(get_db)):
+def obtener_comercio_por_id(comercio_id: str, db=Depends(get_db)):
     """
     Obtiene los detalles completos de un único comercio por su ID.
     """
@@ -1362,7 +1405,7 @@ async def obtener_comercio_por_id(comercio_id: str, db=Depends(get_db)):
         return Comercio(**comercio)
 
 @app.post("/comercios", response_model=Comercio, status_code=201, tags=["Comercios"])
-async def crear_comercio(
+def crear_comercio(
     comercio_data: ComercioCreate,
     db=Depends(get_db),
     current_user: User = Depends(get_current_user)
@@ -1396,7 +1439,7 @@ async def crear_comercio(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/comercios/{comercio_id}", response_model=Comercio, tags=["Comercios"])
-async def actualizar_comercio(
+def actualizar_comercio(
     comercio_id: str,
     comercio_data: ComercioUpdate,
     db=Depends(get_db),
@@ -1428,7 +1471,7 @@ async def actualizar_comercio(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/comercios/{comercio_id}", status_code=200, tags=["Comercios"])
-async def eliminar_comercio(
+def eliminar_comercio(
     comercio_id: str,
     db=Depends(get_db),
     current_user: User = Depends(get_current_user)
@@ -1450,99 +1493,130 @@ async def eliminar_comercio(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/dashboard/active-drivers", tags=["Dashboard"], dependencies=[Depends(get_current_user)])
-async def get_active_drivers(db=Depends(get_db)):
-    r = get_redis_client()
+async def get_active_drivers(db=Depends(get_async_db)):
     drivers = []
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute("SELECT id_usuario, nombre_display, estado_actual, ultima_latitud, ultima_longitud, ultima_bateria_porcentaje FROM usuarios WHERE ultima_actualizacion_loc >= NOW() - INTERVAL '2 hours'")
-        db_drivers = cur.fetchall()
-        for d in db_drivers:
-            lat, lng, estado, bateria = d['ultima_latitud'], d['ultima_longitud'], d['estado_actual'], d['ultima_bateria_porcentaje']
-            if r:
-                try:
-                    redis_data = r.hgetall(f"driver:{d['id_usuario']}")
-                    if redis_data:
-                        lat = float(redis_data.get('lat', lat))
-                        lng = float(redis_data.get('lng', lng))
-                        estado = redis_data.get('estado', estado)
-                        bateria = int(redis_data.get('bat', bateria or 0))
-                except Exception: pass
-            if lat and lng:
-                drivers.append({"id": d['id_usuario'], "nombre": d['nombre_display'], "lat": lat, "lng": lng, "estado": estado, "bateria": bateria})
+    db_drivers = await db.fetch("SELECT id_usuario, nombre_display, estado_actual, ultima_latitud, ultima_longitud, ultima_bateria_porcentaje FROM usuarios WHERE ultima_actualizacion_loc >= NOW() - INTERVAL '2 hours'")
+    # Posición en vivo de Redis: un solo pipeline para todos, fuera del event loop
+    hashes = await asyncio.to_thread(leer_hashes, [d['id_usuario'] for d in db_drivers])
+    for d, redis_data in zip(db_drivers, hashes):
+        lat, lng, estado, bateria = d['ultima_latitud'], d['ultima_longitud'], d['estado_actual'], d['ultima_bateria_porcentaje']
+        if redis_data:
+            try:
+                lat = float(redis_data.get('lat', lat))
+                lng = float(redis_data.get('lng', lng))
+                estado = redis_data.get('estado', estado)
+                if redis_data.get('bat'):
+                    bateria = int(float(redis_data['bat']))
+            except Exception: pass
+        if lat and lng:
+            drivers.append({"id": d['id_usuario'], "nombre": d['nombre_display'], "lat": lat, "lng": lng, "estado": estado, "bateria": bateria})
     return drivers
 
-@app.post("/pedidos/{pedido_id}/asignar", response_model=Pedido, tags=["Pedidos"], dependencies=[Depends(get_current_user)])
-async def asignar_repartidor_a_pedido(
-    pedido_id: int, 
-    data: PedidoAsignarRepartidor,
-    background_tasks: BackgroundTasks, 
-    db=Depends(get_db),
-    current_user: User = Depends(get_current_user)
-):
+async def asignar_pedido_a_repartidor(db, pedido_id: int, repartidor_id: str, usuario: str, accion: str = "manual_assign") -> dict:
     """
-    Asigna un repartidor a un pedido (estado 'asignado') y envía Push Notification.
-    El repartidor debe aceptar o rechazar en su app.
+    Deja el pedido en 'asignado' al repartidor, envía el Push y avisa por WebSocket.
+    Lo usan la asignación manual y el despacho automático. Devuelve la fila actualizada
+    (con nombre_comercio); los webhooks quedan a cargo de quien llama.
+    Con accion="auto_dispatch" no se reasigna nada: si el pedido ya no está pendiente y sin
+    repartidor, o el repartidor ya tiene un pedido en curso, devuelve None sin cambios.
     """
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
+    despacho = accion == "auto_dispatch"
+    async with db.transaction():
         # 1. Validaciones
-        cur.execute("SELECT * FROM pedidos WHERE id = %s FOR UPDATE", (pedido_id,))
-        pedido = cur.fetchone()
+        pedido = await db.fetchrow("SELECT * FROM pedidos WHERE id = $1 FOR UPDATE", pedido_id)
         if not pedido:
             raise HTTPException(status.HTTP_404_NOT_FOUND, "Pedido no encontrado")
         
+        if despacho:
+            # Pudo asignarse a mano o aceptarse desde el radar después de la consulta del despacho
+            if pedido['estado'] != 'pendiente' or pedido['repartidor_id'] is not None:
+                return None
         # Permitir reasignar si está pendiente o si ya estaba asignado a otro (corrección)
-        if pedido['estado'] not in ['pendiente', 'asignado']:
+        elif pedido['estado'] not in ['pendiente', 'asignado']:
             raise HTTPException(status.HTTP_400_BAD_REQUEST, f"El pedido está en estado '{pedido['estado']}' y no se puede reasignar.")
 
-        # Obtener token FCM del repartidor
-        cur.execute("SELECT id_usuario, fcm_token FROM usuarios WHERE id_usuario = %s", (data.repartidor_id,))
-        repartidor = cur.fetchone()
+        # Obtener token FCM del repartidor (el despacho bloquea la fila: un pedido a la vez por repartidor)
+        repartidor = await db.fetchrow(
+            f"SELECT id_usuario, fcm_token FROM usuarios WHERE id_usuario = $1{' FOR UPDATE' if despacho else ''}", repartidor_id
+        )
         if not repartidor:
             raise HTTPException(status.HTTP_404_NOT_FOUND, f"Repartidor no encontrado.")
+        if despacho and await db.fetchval(
+            """SELECT EXISTS (SELECT 1 FROM pedidos WHERE repartidor_id = $1
+               AND (estado IN ('asignado', 'aceptado', 'retirando', 'llevando') OR tiene_ticket_abierto = TRUE))""",
+            repartidor_id
+        ):
+            return None
             
         # 2. Actualizar a estado 'asignado' (Intermedio)
-        cur.execute(
-            "UPDATE pedidos SET repartidor_id = %s, estado = 'asignado', fecha_actualizacion = NOW() WHERE id = %s RETURNING *",
-            (data.repartidor_id, pedido_id)
-        )
-        updated_pedido = cur.fetchone()
+        updated_pedido = dict(await db.fetchrow(
+            "UPDATE pedidos SET repartidor_id = $1, estado = 'asignado', fecha_actualizacion = NOW() WHERE id = $2 RETURNING *",
+            repartidor_id, pedido_id
+        ))
 
         # 3. Logs
-        log_pedido_status_change(cur, pedido_id, "asignado", data.repartidor_id, manual_change=True)
-        log_system_action(db, "WARNING", "manual_assign", {"pedido_id": pedido_id, "driver_id": data.repartidor_id}, usuario=current_user.email)
-        
-        db.commit()
+        await log_pedido_status_change(db, pedido_id, "asignado", repartidor_id, manual_change=(accion == "manual_assign"))
+        await log_system_action_async(db, "WARNING", accion, {"pedido_id": pedido_id, "driver_id": repartidor_id}, usuario=usuario)
+
+    pedidos_pendientes_index.sync(updated_pedido)
+
+    # 4. Enviar Push Notification (FCM)
+    if repartidor['fcm_token']:
+        message = messaging.Message(
+            notification=messaging.Notification(
+                title="¡Nuevo Pedido Asignado!",
+                body=f"Te han asignado el pedido #{pedido_id}. Toca para ver detalles.",
+            ),
+            data={
+                "type": "ORDER_ASSIGNED",
+                "order_id": str(pedido_id),
+                "click_action": "FLUTTER_NOTIFICATION_CLICK",
+            },
+            token=repartidor['fcm_token'],
+        )
+        if not await send_fcm_message(message):
+            logger.error(f"Error enviando FCM a {repartidor_id}.")
 
-        # 4. Enviar Push Notification (FCM)
-        if repartidor['fcm_token']:
-            try:
-                message = messaging.Message(
-                    notification=messaging.Notification(
-                        title="¡Nuevo Pedido Asignado!",
-                        body=f"Te han asignado el pedido #{pedido_id}. Toca para ver detalles.",
-                    ),
-                    data={
-                        "type": "ORDER_ASSIGNED",
-                        "order_id": str(pedido_id),
-                        "click_action": "FLUTTER_NOTIFICATION_CLICK",
-                    },
-                    token=repartidor['fcm_token'],
-                )
-                messaging.send(message)
-            except Exception as e:
-                logger.error(f"Error enviando FCM a {data.repartidor_id}: {e}")
+    # 5. Notificar WebSocket
+    updated_pedido['nombre_comercio'] = await db.fetchval("SELECT nombre FROM comercios WHERE id_comercio = $1", updated_pedido['id_comercio'])
+    
+    await manager.broadcast({"type": "ORDER_ASSIGNED", "id": pedido_id, "repartidor_id": repartidor_id, "data": updated_pedido})
+    return updated_pedido
 
-        # 5. Notificar WebSocket y Webhooks
-        cur.execute("SELECT nombre FROM comercios WHERE id_comercio = %s", (updated_pedido['id_comercio'],))
-        updated_pedido['nombre_comercio'] = cur.fetchone()['nombre']
-        
-        await manager.broadcast({"type": "ORDER_ASSIGNED", "id": pedido_id, "repartidor_id": data.repartidor_id, "data": updated_pedido})
-        background_tasks.add_task(trigger_integration_webhooks, "ORDER_STATUS_UPDATE", updated_pedido.copy(), get_db_connection())
+@app.post("/pedidos/{pedido_id}/asignar", response_model=Pedido, tags=["Pedidos"], dependencies=[Depends(get_current_user)])
+async def asignar_repartidor_a_pedido(
+    pedido_id: int, 
+    data: PedidoAsignarRepartidor,
+    background_tasks: BackgroundTasks, 
+    db=Depends(get_async_db),
+    current_user: User = Depends(get_current_user)
+):
+    """
+    Asigna un repartidor a un pedido (estado 'asignado') y envía Push Notification.
+    El repartidor debe aceptar o rechazar en su app.
+    """
+    updated_pedido = await asignar_pedido_a_repartidor(db, pedido_id, data.repartidor_id, current_user.email)
+    background_tasks.add_task(trigger_integration_webhooks, "ORDER_STATUS_UPDATE", updated_pedido.copy())
+
+    return Pedido(**updated_pedido)
+
+async def asignar_por_despacho(pedido_id: int, repartidor_id: str):
+    """Aplica una asignación del despacho automático (fuera de una petición HTTP)."""
+    async with async_db.connection() as db:
+        updated_pedido = await asignar_pedido_a_repartidor(db, pedido_id, repartidor_id, "sistema", accion="auto_dispatch")
+    if updated_pedido is None:
+        return False
+    await trigger_integration_webhooks("ORDER_STATUS_UPDATE", updated_pedido.copy())
+    return True
 
-        return Pedido(**updated_pedido)
+async def ejecutar_despacho():
+    try:
+        await dispatch_engine.tick(asignar_por_despacho)
+    except Exception as e:
+        logger.error(f"Error en el ciclo de despacho automático: {e!r}")
 
 @app.get("/integrations", response_model=List[IntegrationConfig], tags=["Integrations"])
-async def list_integrations(db=Depends(get_db)):
+def list_integrations(db=Depends(get_db)):
     query = """
         SELECT i.*, row_to_json(ak.*) as api_key
         FROM integration_configs i
@@ -1554,7 +1628,7 @@ async def list_integrations(db=Depends(get_db)):
         return [IntegrationConfig(**row) for row in cur.fetchall()]
 
 @app.get("/integrations/{integration_id}", response_model=IntegrationConfig, tags=["Integrations"], dependencies=[Depends(get_current_user)])
-async def get_integration(integration_id: int, db=Depends(get_db)):
+def get_integration(integration_id: int, db=Depends(get_db)):
     """Obtiene los detalles de una configuración de integración específica."""
     with db.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute("SELECT * FROM integration_configs WHERE id = %s", (integration_id,))
@@ -1564,7 +1638,7 @@ async def get_integration(integration_id: int, db=Depends(get_db)):
         return IntegrationConfig(**config)
 
 @app.post("/integrations", response_model=IntegrationConfig, status_code=201, tags=["Integrations"], dependencies=[Depends(get_current_user)])
-async def create_integration(config_data: IntegrationConfigCreate, db=Depends(get_db)):
+def create_integration(config_data: IntegrationConfigCreate, db=Depends(get_db)):
     """Crea una nueva configuración de integración."""
     try:
         with db.cursor(cursor_factory=RealDictCursor) as cur:
@@ -1587,7 +1661,7 @@ async def create_integration(config_data: IntegrationConfigCreate, db=Depends(ge
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/integrations/{integration_id}", response_model=IntegrationConfig, tags=["Integrations"], dependencies=[Depends(get_current_user)])
-async def update_integration(integration_id: int, config_data: IntegrationConfigUpdate, db=Depends(get_db)):
+def update_integration(integration_id: int, config_data: IntegrationConfigUpdate, db=Depends(get_db)):
     """Actualiza una configuración de integración existente."""
     update_dict = config_data.model_dump(exclude_unset=True)
     if not update_dict:
@@ -1617,7 +1691,7 @@ async def update_integration(integration_id: int, config_data: IntegrationConfig
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.delete("/integrations/{integration_id}", status_code=200, tags=["Integrations"], dependencies=[Depends(get_current_user)])
-async def delete_integration(integration_id: int, db=Depends(get_db)):
+def delete_integration(integration_id: int, db=Depends(get_db)):
     """Elimina una configuración de integración."""
     with db.cursor() as cur:
         cur.execute("DELETE FROM integration_configs WHERE id = %s", (integration_id,))
@@ -1632,26 +1706,20 @@ async def get_analytics_summary(
     end_date: date,
     repartidor_id: Optional[str] = None,
     id_comercio: Optional[str] = None,
-    db=Depends(get_db),
+    db=Depends(get_read_db),
     current_user: User = Depends(get_current_user)
 ):
     """
     Calcula y devuelve un resumen completo de estadísticas, AHORA CON CORRECCIÓN DE ZONA HORARIA.
     """
-    # --- INICIO DE LA CORRECCIÓN CLAVE ---
-    timezone = str(CARACAS_TZ) # Usamos la zona horaria definida en la configuración
-    params = {'start_date': start_date, 'end_date': end_date, 'tz': timezone}
-    
-    # Construimos los filtros dinámicos, convirtiendo la fecha del pedido a la zona horaria local ANTES de comparar
-    filter_clauses = "WHERE (p.fecha_creacion AT TIME ZONE %(tz)s)::date BETWEEN %(start_date)s AND %(end_date)s"
-    # --- FIN DE LA CORRECCIÓN CLAVE ---
-    
+    # Los días se interpretan en hora de Caracas y se comparan como rango de timestamps,
+    # sin funciones sobre p.fecha_creacion, para que se use el índice
+    wb = WhereBuilder().date_range("p.fecha_creacion", start_date, end_date)
     if repartidor_id:
-        filter_clauses += " AND p.repartidor_id = %(repartidor_id)s"
-        params['repartidor_id'] = repartidor_id
+        wb.add("p.repartidor_id = {}", repartidor_id)
     if id_comercio:
-        filter_clauses += " AND p.id_comercio = %(id_comercio)s"
-        params['id_comercio'] = id_comercio
+        wb.add("p.id_comercio = {}", id_comercio)
+    filter_clauses, params = wb.where(), wb.params
 
     # El resto de la query funciona igual, ya que opera sobre los datos ya filtrados correctamente.
     query = f"""
@@ -1692,22 +1760,17 @@ async def get_analytics_summary(
         LEFT JOIN TiemposPorPedido t ON p.id = t.id_pedido
     """
 
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(query, params)
-        results = cur.fetchone()
+    results = await db.fetchrow(query, *params)
 
-        total_orders = results['total_orders']
-        cancellation_rate = (results['cancelled_orders'] / total_orders * 100) if total_orders > 0 else 0
-        
-        # Aplicamos la misma corrección de zona horaria a las sub-queries
-        cur.execute(f"SELECT COUNT(*) as total_tickets FROM tickets t JOIN pedidos p ON t.id_pedido = p.id {filter_clauses}", params)
-        total_tickets = cur.fetchone()['total_tickets']
-        
-        cur.execute(f"SELECT u.nombre_display, COUNT(p.id) as order_count FROM pedidos p JOIN usuarios u ON p.repartidor_id = u.id_usuario {filter_clauses} AND p.repartidor_id IS NOT NULL GROUP BY u.nombre_display ORDER BY order_count DESC LIMIT 5", params)
-        top_drivers = cur.fetchall()
-        
-        cur.execute(f"SELECT c.nombre, COUNT(p.id) as order_count FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio {filter_clauses} GROUP BY c.nombre ORDER BY order_count DESC LIMIT 5", params)
-        top_merchants = cur.fetchall()
+    total_orders = results['total_orders']
+    cancellation_rate = (results['cancelled_orders'] / total_orders * 100) if total_orders > 0 else 0
+    
+    # Las sub-queries usan el mismo filtro
+    total_tickets = await db.fetchval(f"SELECT COUNT(*) as total_tickets FROM tickets t JOIN pedidos p ON t.id_pedido = p.id {filter_clauses}", *params)
+    
+    top_drivers = [dict(r) for r in await db.fetch(f"SELECT u.nombre_display, COUNT(p.id) as order_count FROM pedidos p JOIN usuarios u ON p.repartidor_id = u.id_usuario {filter_clauses} AND p.repartidor_id IS NOT NULL GROUP BY u.nombre_display ORDER BY order_count DESC LIMIT 5", *params)]
+    
+    top_merchants = [dict(r) for r in await db.fetch(f"SELECT c.nombre, COUNT(p.id) as order_count FROM pedidos p JOIN comercios c ON p.id_comercio = c.id_comercio {filter_clauses} GROUP BY c.nombre ORDER BY order_count DESC LIMIT 5", *params)]
 
     net_revenue = results['total_revenue'] - results['total_driver_commission']
     
@@ -1738,7 +1801,7 @@ async def get_analytics_summary(
     return response
 
 @app.post("/api-keys", response_model=NewApiKeyResponse, tags=["API Keys"])
-async def create_api_key(api_key_data: ApiKeyCreate, db=Depends(get_db)):
+def create_api_key(api_key_data: ApiKeyCreate, db=Depends(get_db)):
     prefix = f"{api_key_data.client_name[:4].lower()}_sk"
     secret = secrets.token_urlsafe(32)
     full_key = f"{prefix}_{secret}"
@@ -1770,7 +1833,7 @@ async def create_api_key(api_key_data: ApiKeyCreate, db=Depends(get_db)):
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.put("/api-keys/{prefix}/revoke", response_model=ApiKey, tags=["API Keys"])
-async def revoke_api_key(prefix: str, db=Depends(get_db)):
+def revoke_api_key(prefix: str, db=Depends(get_db)):
     with db.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute("UPDATE api_keys SET is_active = FALSE WHERE prefix = %s RETURNING *", (prefix,))
         if cur.rowcount == 0:
@@ -1782,14 +1845,14 @@ async def revoke_api_key(prefix: str, db=Depends(get_db)):
 # --- ENDPOINTS CRUD PARA ZONAS RESTRINGIDAS ---
 
 @app.get("/zones", response_model=List[RestrictedZone], tags=["Zones"])
-async def list_restricted_zones(db=Depends(get_db)):
+def list_restricted_zones(db=Depends(get_db)):
     """Obtiene una lista de todas las zonas restringidas configuradas."""
     with db.cursor(cursor_factory=RealDictCursor) as cur:
         cur.execute("SELECT * FROM restricted_zones ORDER BY name ASC")
         return [RestrictedZone(**row) for row in cur.fetchall()]
 
 @app.post("/zones", response_model=RestrictedZone, status_code=201, tags=["Zones"])
-async def create_restricted_zone(zone_data: RestrictedZoneCreate, db=Depends(get_db)):
+def create_restricted_zone(zone_data: RestrictedZoneCreate, db=Depends(get_db)):
     """Crea una nueva zona restringida."""
     try:
         with db.cursor(cursor_factory=RealDictCursor) as cur:
@@ -1804,13 +1867,32 @@ async def create_restricted_zone(zone_data: RestrictedZoneCreate, db=Depends(get
             ))
             new_zone = cur.fetchone()
             db.commit()
+            cur.execute(ZONAS_ACTIVAS_QUERY)
+            zonas_restringidas.cargar(cur.fetchall())
             return RestrictedZone(**new_zone)
     except Exception as e:
         db.rollback()
         raise HTTPException(status_code=500, detail=str(e))
 
+@app.post("/zones/check", response_model=ZoneCheckResponse, tags=["Zones"])
+def check_points_in_zones(data: ZoneCheckRequest, principal: Any = Depends(get_current_principal)):
+    """
+    Verifica muchas direcciones a la vez contra las zonas restringidas activas, para que las
+    integraciones puedan validar antes de crear pedidos. Usa el mismo criterio que POST /pedidos.
+    """
+    version, resultados = zonas_restringidas.verificar_puntos(
+        [p.lat for p in data.points], [p.lng for p in data.points], datetime.now(CARACAS_TZ).time()
+    )
+    return ZoneCheckResponse(zones_version=version, results=[
+        ZoneCheckResult(
+            lat=p.lat, lng=p.lng, restricted_now=restringida,
+            zone_id=zona.id if zona else None, zone_name=zona.name if zona else None,
+        )
+        for p, (zona, restringida) in zip(data.points, resultados)
+    ])
+
 @app.put("/zones/{zone_id}", response_model=RestrictedZone, tags=["Zones"])
-async def update_restricted_zone(zone_id: int, zone_data: RestrictedZoneUpdate, db=Depends(get_db)):
+def update_restricted_zone(zone_id: int, zone_data: RestrictedZoneUpdate, db=Depends(get_db)):
     """Actualiza una zona restringida existente."""
     update_dict = zone_data.model_dump(exclude_unset=True)
     if not update_dict:
@@ -1830,23 +1912,28 @@ async def update_restricted_zone(zone_id: int, zone_data: RestrictedZoneUpdate,
             raise HTTPException(status_code=404, detail="Zona no encontrada")
         updated_zone = cur.fetchone()
         db.commit()
+        cur.execute(ZONAS_ACTIVAS_QUERY)
+        zonas_restringidas.cargar(cur.fetchall())
         return RestrictedZone(**updated_zone)
 
 @app.delete("/zones/{zone_id}", status_code=200, tags=["Zones"])
-async def delete_restricted_zone(zone_id: int, db=Depends(get_db)):
+def delete_restricted_zone(zone_id: int, db=Depends(get_db)):
     """Elimina una zona restringida."""
     with db.cursor() as cur:
         cur.execute("DELETE FROM restricted_zones WHERE id = %s", (zone_id,))
         if cur.rowcount == 0:
             raise HTTPException(status_code=404, detail="Zona no encontrada")
         db.commit()
+    with db.cursor(cursor_factory=RealDictCursor) as cur:
+        cur.execute(ZONAS_ACTIVAS_QUERY)
+        zonas_restringidas.cargar(cur.fetchall())
     return {"status": "deleted", "id": zone_id}
 
 
 @app.get("/pedidos/activos/mi-reparto", response_model=List[Pedido], tags=["Pedidos"])
 async def obtener_pedidos_activos_del_repartidor(
     user: User = Depends(get_current_user), # Usamos get_current_user para obtener el repartidor autenticado
-    db=Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Obtiene todos los pedidos activos asignados al repartidor que realiza la petición.
@@ -1861,47 +1948,43 @@ async def obtener_pedidos_activos_del_repartidor(
         FROM pedidos p
         JOIN comercios c ON p.id_comercio = c.id_comercio
         LEFT JOIN integraciones i ON p.id = i.pedido_id
-        WHERE p.repartidor_id = %s
+        WHERE p.repartidor_id = $1
         AND p.estado NOT IN ('entregado', 'cancelado')
         ORDER BY p.fecha_creacion ASC;
     """
 
-    with db.cursor(cursor_factory=RealDictCursor) as cur:
-        cur.execute(query, (repartidor_id,))
-        pedidos_activos = cur.fetchall()
-        
-        # El modelo 'Pedido' espera que cada objeto tenga un 'nombre_comercio',
-        # que ya obtenemos con el JOIN.
-        return [Pedido(**pedido) for pedido in pedidos_activos]
+    pedidos_activos = await db.fetch(query, repartidor_id)
+    
+    # El modelo 'Pedido' espera que cada objeto tenga un 'nombre_comercio',
+    # que ya obtenemos con el JOIN.
+    return [Pedido(**pedido) for pedido in pedidos_activos]
 
 
 @app.post("/auth/login-success", tags=["Auth"], dependencies=[Depends(get_current_user)])
 async def register_login_success(
     data: LoginSuccessRequest,
     user: User = Depends(get_current_user),
-    db=Depends(get_db)
+    db=Depends(get_async_db)
 ):
     """
     Registra el inicio de sesión exitoso y actualiza el token FCM del usuario.
     """
     try:
-        with db.cursor() as cur:
+        async with db.transaction():
             # 1. Actualizar Token FCM
             if data.fcm_token:
-                cur.execute(
-                    "UPDATE usuarios SET fcm_token = %s, ultima_actualizacion_loc = NOW() WHERE id_usuario = %s",
-                    (data.fcm_token, user.email)
+                await db.execute(
+                    "UPDATE usuarios SET fcm_token = $1, ultima_actualizacion_loc = NOW() WHERE id_usuario = $2",
+                    data.fcm_token, user.email
                 )
             
             # 2. Registrar Log de Acceso
-            log_system_action(db, "INFO", "user_login", {
+            await log_system_action_async(db, "INFO", "user_login", {
                 "user_id": user.email,
                 "device": data.device_info,
                 "has_fcm": bool(data.fcm_token)
             }, usuario=user.email)
             
-            db.commit()
-            
         return {"status": "success", "msg": "FCM Token updated"}
     except Exception as e:
         logger.error(f"Error en login-success: {e}")
@@ -0,0 +1,394 @@
+import logging
+import os
+import re
+import time
+from dataclasses import dataclass
+
+import psycopg2
+
+logger = logging.getLogger(__name__)
+
+# --- MIGRACIONES VERSIONADAS DEL ESQUEMA ---
+# Cada migración se aplica una sola vez y queda registrada en 'schema_migrations'.
+# Para cambiar el esquema se AÑADE una migración nueva al final de MIGRATIONS;
+# nunca se edita una que ya se haya aplicado en producción.
+
+# Clave del advisory lock: evita que dos workers de uvicorn migren a la vez
+MIGRATIONS_LOCK_KEY = 724001
+
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    statements: tuple
+    # CREATE INDEX CONCURRENTLY no puede ejecutarse dentro de una transacción
+    transactional: bool = True
+
+
+MIGRATIONS = [
+    Migration(1, "esquema_inicial", (
+        "CREATE TABLE IF NOT EXISTS usuarios (id_usuario VARCHAR(255) PRIMARY KEY, nombre_display VARCHAR(255), ultima_latitud DOUBLE PRECISION, ultima_longitud DOUBLE PRECISION, ultima_actualizacion_loc TIMESTAMP WITH TIME ZONE, estado_actual VARCHAR(50) DEFAULT 'Disponible', porcentaje_comision DOUBLE PRECISION DEFAULT 0.0, ultima_bateria_porcentaje INTEGER, fcm_token TEXT);",
+        "CREATE TABLE IF NOT EXISTS comercios (id_comercio VARCHAR(255) PRIMARY KEY, nombre VARCHAR(255) NOT NULL, direccion TEXT, latitud DOUBLE PRECISION, longitud DOUBLE PRECISION, numero_contacto VARCHAR(50));",
+        """CREATE TABLE IF NOT EXISTS pedidos (
+            id SERIAL PRIMARY KEY,
+            pedido TEXT NOT NULL,
+            direccion_entrega TEXT NOT NULL,
+            latitud_entrega DOUBLE PRECISION NOT NULL,
+            longitud_entrega DOUBLE PRECISION NOT NULL,
+            latitud_retiro DOUBLE PRECISION NOT NULL,
+            longitud_retiro DOUBLE PRECISION NOT NULL,
+            estado VARCHAR(50) DEFAULT 'pendiente',
+            estado_previo_novedad VARCHAR(50),
+            fecha_creacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            fecha_actualizacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
+            detalles TEXT,
+            telefono_contacto VARCHAR(50),
+            telefono_comercio VARCHAR(50),
+            link_maps TEXT,
+            id_comercio VARCHAR(255) NOT NULL,
+            costo_servicio DOUBLE PRECISION,
+            repartidor_id VARCHAR(255),
+            tiene_ticket_abierto BOOLEAN DEFAULT FALSE,
+            tipo_vehiculo VARCHAR(20) NOT NULL,
+            creado_por_usuario_id VARCHAR(255),
+            FOREIGN KEY (repartidor_id) REFERENCES usuarios(id_usuario) ON DELETE SET NULL,
+            FOREIGN KEY (id_comercio) REFERENCES comercios(id_comercio) ON DELETE CASCADE
+        );""",
+        """
+        CREATE TABLE IF NOT EXISTS admin_users (
+            uid VARCHAR(255) PRIMARY KEY,
+            email VARCHAR(255) NOT NULL UNIQUE,
+            display_name VARCHAR(255),
+            role VARCHAR(50) DEFAULT 'viewer',
+            is_disabled BOOLEAN DEFAULT FALSE,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS restricted_zones (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            -- Guardaremos las coordenadas del polígono como un array de puntos en JSONB
+            -- Ejemplo: [[-66.90, 10.48], [-66.88, 10.48], [-66.88, 10.46], [-66.90, 10.46]]
+            polygon_coords JSONB NOT NULL,
+            -- Horarios en formato 24h (ej: '08:00', '22:30')
+            restricted_from TIME, -- Puede ser NULL si está prohibido 24/7
+            restricted_to TIME,   -- Puede ser NULL si está prohibido 24/7
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """,
+        "CREATE TABLE IF NOT EXISTS ubicaciones_log (id_log SERIAL PRIMARY KEY, id_usuario VARCHAR(255) NOT NULL, latitud DOUBLE PRECISION NOT NULL, longitud DOUBLE PRECISION NOT NULL, timestamp TIMESTAMP WITH TIME ZONE NOT NULL, FOREIGN KEY (id_usuario) REFERENCES usuarios(id_usuario) ON DELETE CASCADE);",
+        "CREATE TABLE IF NOT EXISTS tickets (id_ticket SERIAL PRIMARY KEY, id_pedido INTEGER NOT NULL, id_usuario_creador VARCHAR(255) NOT NULL, estado_ticket VARCHAR(50) DEFAULT 'abierto', fecha_creacion_ticket TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, asunto_ticket TEXT, FOREIGN KEY (id_pedido) REFERENCES pedidos(id) ON DELETE CASCADE, FOREIGN KEY (id_usuario_creador) REFERENCES usuarios(id_usuario) ON DELETE CASCADE);",
+        "CREATE TABLE IF NOT EXISTS mensajes_ticket (id_mensaje SERIAL PRIMARY KEY, id_ticket INTEGER NOT NULL, id_remitente VARCHAR(255) NOT NULL, tipo_remitente VARCHAR(50) NOT NULL, contenido_mensaje TEXT, nombre_archivo_adjunto VARCHAR(255), timestamp_mensaje TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (id_ticket) REFERENCES tickets(id_ticket) ON DELETE CASCADE);",
+        "CREATE TABLE IF NOT EXISTS pedidos_logs (log_id SERIAL PRIMARY KEY, id_pedido INTEGER NOT NULL, repartidor_id VARCHAR(255), estado_registrado VARCHAR(50) NOT NULL, latitud DOUBLE PRECISION, longitud DOUBLE PRECISION, timestamp_log TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (id_pedido) REFERENCES pedidos(id) ON DELETE CASCADE);",
+        "CREATE TABLE IF NOT EXISTS integraciones (pedido_id INTEGER PRIMARY KEY, id_externo VARCHAR(255) NOT NULL, fecha_creacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP, FOREIGN KEY (pedido_id) REFERENCES pedidos(id) ON DELETE CASCADE);",
+        "CREATE TABLE IF NOT EXISTS system_logs (id SERIAL PRIMARY KEY, nivel VARCHAR(20) NOT NULL, accion VARCHAR(100) NOT NULL, usuario_responsable VARCHAR(255), detalles JSONB, timestamp TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE TABLE IF NOT EXISTS app_config (clave VARCHAR(100) PRIMARY KEY, valor JSONB NOT NULL, updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
+        "CREATE TABLE IF NOT EXISTS pedidos_programados (id SERIAL PRIMARY KEY, payload_pedido JSONB NOT NULL, fecha_liberacion TIMESTAMP WITH TIME ZONE NOT NULL, estado VARCHAR(50) DEFAULT 'pendiente', fecha_creacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP);",
+        """
+        CREATE TABLE IF NOT EXISTS integration_configs (
+            id SERIAL PRIMARY KEY,
+            name VARCHAR(100) NOT NULL UNIQUE,
+            is_active BOOLEAN DEFAULT TRUE,
+            id_externo_prefix VARCHAR(50) NOT NULL,
+            webhooks JSONB,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS api_keys (
+            id SERIAL PRIMARY KEY,
+            hashed_key VARCHAR(255) NOT NULL UNIQUE,
+            prefix VARCHAR(8) NOT NULL,
+            client_name VARCHAR(100) NOT NULL,
+            is_active BOOLEAN DEFAULT TRUE,
+            created_at TIMESTAMPTZ DEFAULT NOW(),
+            last_used_at TIMESTAMPTZ
+        );
+        """,
+    )),
+    # Reemplaza el antiguo bloque 'DO $$' que se ejecutaba en cada arranque
+    Migration(2, "ajustes_esquema_legacy", (
+        "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS fecha_actualizacion TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP;",
+        "ALTER TABLE integration_configs DROP CONSTRAINT IF EXISTS integration_configs_id_externo_prefix_key;",
+        "ALTER TABLE api_keys DROP CONSTRAINT IF EXISTS api_keys_prefix_key;",
+    )),
+    Migration(3, "indices_integraciones", (
+        "CREATE INDEX IF NOT EXISTS idx_integration_configs_prefix ON integration_configs(id_externo_prefix);",
+        "CREATE INDEX IF NOT EXISTS idx_integraciones_id_externo ON integraciones(id_externo);",
+        "CREATE INDEX IF NOT EXISTS idx_api_keys_prefix ON api_keys(prefix);",
+    )),
+    # Índices para las consultas más frecuentes (listados por estado, pedidos del repartidor,
+    # historial de un pedido, rastro GPS, logs del sistema, tickets abiertos, repartidores activos)
+    Migration(4, "indices_consultas_frecuentes", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_estado_fecha ON pedidos(estado, fecha_creacion);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_repartidor_estado ON pedidos(repartidor_id, estado);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_logs_pedido_fecha ON pedidos_logs(id_pedido, timestamp_log);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_ubicaciones_log_usuario_fecha ON ubicaciones_log(id_usuario, timestamp);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_system_logs_timestamp ON system_logs(timestamp);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tickets_estado ON tickets(estado_ticket);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_usuarios_ultima_loc ON usuarios(ultima_actualizacion_loc);",
+    ), transactional=False),
+    # Particionado por rango de fecha. La tabla existente se conserva como partición
+    # '<tabla>_legacy' que cubre todo el histórico hasta el corte; las particiones nuevas
+    # las crea y elimina partitions.py según la política de retención.
+    Migration(5, "particionar_ubicaciones_y_system_logs", (
+        "ALTER TABLE ubicaciones_log RENAME TO ubicaciones_log_legacy;",
+        "ALTER TABLE ubicaciones_log_legacy DROP CONSTRAINT ubicaciones_log_pkey;",
+        "ALTER TABLE ubicaciones_log_legacy DROP CONSTRAINT IF EXISTS ubicaciones_log_id_usuario_fkey;",
+        "ALTER INDEX IF EXISTS idx_ubicaciones_log_usuario_fecha RENAME TO idx_ubicaciones_log_legacy_usuario_fecha;",
+        """CREATE TABLE ubicaciones_log (
+            id_log INTEGER NOT NULL DEFAULT nextval('ubicaciones_log_id_log_seq'),
+            id_usuario VARCHAR(255) NOT NULL,
+            latitud DOUBLE PRECISION NOT NULL,
+            longitud DOUBLE PRECISION NOT NULL,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL,
+            PRIMARY KEY (id_log, timestamp),
+            FOREIGN KEY (id_usuario) REFERENCES usuarios(id_usuario) ON DELETE CASCADE
+        ) PARTITION BY RANGE (timestamp);""",
+        "ALTER SEQUENCE ubicaciones_log_id_log_seq OWNED BY ubicaciones_log.id_log;",
+        "CREATE INDEX idx_ubicaciones_log_usuario_fecha ON ubicaciones_log(id_usuario, timestamp);",
+        """DO $$
+        DECLARE corte TIMESTAMPTZ;
+        BEGIN
+            SELECT GREATEST(
+                date_trunc('day', NOW() AT TIME ZONE 'America/Caracas') + INTERVAL '1 day',
+                COALESCE(date_trunc('day', MAX(timestamp) AT TIME ZONE 'America/Caracas') + INTERVAL '1 day', '-infinity')
+            ) AT TIME ZONE 'America/Caracas' INTO corte FROM ubicaciones_log_legacy;
+            EXECUTE format('ALTER TABLE ubicaciones_log ATTACH PARTITION ubicaciones_log_legacy FOR VALUES FROM (MINVALUE) TO (%L)', corte);
+        END $$;""",
+        # Red de seguridad: filas con fechas fuera de las particiones creadas (ej: reloj del teléfono mal configurado)
+        "CREATE TABLE ubicaciones_log_default PARTITION OF ubicaciones_log DEFAULT;",
+
+        "ALTER TABLE system_logs RENAME TO system_logs_legacy;",
+        "ALTER TABLE system_logs_legacy DROP CONSTRAINT system_logs_pkey;",
+        "UPDATE system_logs_legacy SET timestamp = 'epoch' WHERE timestamp IS NULL;",
+        "ALTER TABLE system_logs_legacy ALTER COLUMN timestamp SET NOT NULL;",
+        "ALTER INDEX IF EXISTS idx_system_logs_timestamp RENAME TO idx_system_logs_legacy_timestamp;",
+        """CREATE TABLE system_logs (
+            id INTEGER NOT NULL DEFAULT nextval('system_logs_id_seq'),
+            nivel VARCHAR(20) NOT NULL,
+            accion VARCHAR(100) NOT NULL,
+            usuario_responsable VARCHAR(255),
+            detalles JSONB,
+            timestamp TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+            PRIMARY KEY (id, timestamp)
+        ) PARTITION BY RANGE (timestamp);""",
+        "ALTER SEQUENCE system_logs_id_seq OWNED BY system_logs.id;",
+        "CREATE INDEX idx_system_logs_timestamp ON system_logs(timestamp);",
+        """DO $$
+        DECLARE corte TIMESTAMPTZ;
+        BEGIN
+            SELECT GREATEST(
+                date_trunc('month', NOW() AT TIME ZONE 'America/Caracas') + INTERVAL '1 month',
+                COALESCE(date_trunc('month', MAX(timestamp) AT TIME ZONE 'America/Caracas') + INTERVAL '1 month', '-infinity')
+            ) AT TIME ZONE 'America/Caracas' INTO corte FROM system_logs_legacy;
+            EXECUTE format('ALTER TABLE system_logs ATTACH PARTITION system_logs_legacy FOR VALUES FROM (MINVALUE) TO (%L)', corte);
+        END $$;""",
+        "CREATE TABLE system_logs_default PARTITION OF system_logs DEFAULT;",
+    )),
+    # Rangos de fecha sin filtro de estado (listados, reportes y analíticas, ver query_builder.py)
+    # y claves de orden de la paginación keyset: (orden, id) para que cada página sea un index
+    # range scan. (fecha_creacion, id) sirve también para los rangos de fecha solos.
+    Migration(6, "indices_fecha_y_paginacion_keyset", (
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_fecha_id ON pedidos(fecha_creacion, id);",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_tickets_activos_fecha_id ON tickets(fecha_creacion_ticket, id_ticket) WHERE estado_ticket IN ('abierto', 'en_progreso');",
+        "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_comercios_nombre_id ON comercios(nombre, id_comercio);",
+    ), transactional=False),
+    # system_logs está particionada: CONCURRENTLY no se admite sobre la tabla padre
+    Migration(7, "indice_system_logs_timestamp_id", (
+        "CREATE INDEX IF NOT EXISTS idx_system_logs_timestamp_id ON system_logs(timestamp, id);",
+        "DROP INDEX IF EXISTS idx_system_logs_timestamp;",
+    )),
+    # Despacho automático (dispatch.py): vehículo del repartidor. NULL = puede llevar cualquier pedido
+    Migration(8, "usuarios_tipo_vehiculo", (
+        "ALTER TABLE usuarios ADD COLUMN IF NOT EXISTS tipo_vehiculo VARCHAR(20);",
+    )),
+]
+
+_CONCURRENT_INDEX_RE = re.compile(r"CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+(\w+)", re.IGNORECASE)
+
+
+def _drop_invalid_index(cur, statement: str):
+    """
+    Si un CREATE INDEX CONCURRENTLY anterior falló, Postgres deja un índice INVÁLIDO
+    con ese nombre y 'IF NOT EXISTS' lo saltaría. Lo eliminamos para reconstruirlo.
+    """
+    match = _CONCURRENT_INDEX_RE.search(statement)
+    if not match:
+        return
+    index_name = match.group(1)
+    cur.execute(
+        "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid WHERE c.relname = %s AND NOT i.indisvalid",
+        (index_name,)
+    )
+    if cur.fetchone():
+        logger.warning(f"Índice inválido '{index_name}' encontrado. Se elimina para reconstruirlo.")
+        cur.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index_name};")
+
+
+def _applied_versions(cur) -> set:
+    cur.execute("""
+        CREATE TABLE IF NOT EXISTS schema_migrations (
+            version INTEGER PRIMARY KEY,
+            name VARCHAR(100) NOT NULL,
+            applied_at TIMESTAMPTZ DEFAULT NOW(),
+            duration_ms INTEGER
+        );
+    """)
+    cur.execute("SELECT version FROM schema_migrations")
+    return {row[0] for row in cur.fetchall()}
+
+
+def _apply(conn, migration: Migration):
+    inicio = time.monotonic()
+    if migration.transactional:
+        conn.autocommit = False
+        try:
+            with conn.cursor() as cur:
+                for statement in migration.statements:
+                    cur.execute(statement)
+                cur.execute(
+                    "INSERT INTO schema_migrations (version, name, duration_ms) VALUES (%s, %s, %s)",
+                    (migration.version, migration.name, int((time.monotonic() - inicio) * 1000))
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            conn.autocommit = True
+    else:
+        # Cada sentencia debe ser idempotente: si el proceso muere a mitad,
+        # la migración se vuelve a ejecutar completa en el siguiente arranque.
+        with conn.cursor() as cur:
+            for statement in migration.statements:
+                _drop_invalid_index(cur, statement)
+                cur.execute(statement)
+            cur.execute(
+                "INSERT INTO schema_migrations (version, name, duration_ms) VALUES (%s, %s, %s)",
+                (migration.version, migration.name, int((time.monotonic() - inicio) * 1000))
+            )
+
+
+def run_migrations(conn) -> list:
+    """
+    Aplica en orden las migraciones pendientes sobre una conexión psycopg2.
+    Devuelve la lista de versiones aplicadas en esta ejecución.
+    """
+    conn.autocommit = True
+    aplicadas = []
+    with conn.cursor() as cur:
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+    try:
+        with conn.cursor() as cur:
+            ya_aplicadas = _applied_versions(cur)
+        for migration in sorted(MIGRATIONS, key=lambda m: m.version):
+            if migration.version in ya_aplicadas:
+                continue
+            logger.info(f"Aplicando migración {migration.version:04d} '{migration.name}'...")
+            try:
+                _apply(conn, migration)
+            except psycopg2.Error as e:
+                logger.error(f"Error en migración {migration.version:04d} '{migration.name}': {e}")
+                raise
+            aplicadas.append(migration.version)
+    finally:
+        with conn.cursor() as cur:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+    if aplicadas:
+        logger.info(f"Migraciones aplicadas: {aplicadas}")
+    else:
+        logger.info("Esquema al día. No hay migraciones pendientes.")
+    return aplicadas
+
+
+# --- MODO POSTGIS OPCIONAL (fuera de las migraciones versionadas) ---
+# Se ejecuta en cada arranque, después de run_migrations, y es idempotente: si la extensión
+# aparece más tarde (p. ej. al pasar a la imagen postgis/postgis), las columnas se crean en
+# ese arranque. Para no reescribir 'pedidos' bajo ACCESS EXCLUSIVE, geo_retiro/geo_entrega
+# son columnas normales (ADD COLUMN sin default no reescribe la tabla) que mantiene un
+# trigger; las filas existentes se completan por lotes y los índices GiST se crean
+# CONCURRENTLY. spatial_index.py usa PostGIS solo cuando el índice del radar es válido.
+
+POSTGIS_BACKFILL_BATCH = int(os.getenv("POSTGIS_BACKFILL_BATCH", 5000))
+
+_POSTGIS_COLUMNAS = (
+    "ALTER TABLE pedidos ADD COLUMN IF NOT EXISTS geo_retiro geography(Point, 4326), ADD COLUMN IF NOT EXISTS geo_entrega geography(Point, 4326);",
+)
+
+_POSTGIS_TRIGGER = (
+    """CREATE OR REPLACE FUNCTION pedidos_geo_actualizar() RETURNS trigger AS $$
+    BEGIN
+        NEW.geo_retiro := ST_SetSRID(ST_MakePoint(NEW.longitud_retiro, NEW.latitud_retiro), 4326)::geography;
+        NEW.geo_entrega := ST_SetSRID(ST_MakePoint(NEW.longitud_entrega, NEW.latitud_entrega), 4326)::geography;
+        RETURN NEW;
+    END $$ LANGUAGE plpgsql;""",
+    """CREATE OR REPLACE TRIGGER trg_pedidos_geo
+    BEFORE INSERT OR UPDATE OF latitud_retiro, longitud_retiro, latitud_entrega, longitud_entrega ON pedidos
+    FOR EACH ROW EXECUTE FUNCTION pedidos_geo_actualizar();""",
+)
+
+_POSTGIS_BACKFILL = """
+    UPDATE pedidos SET
+        geo_retiro = ST_SetSRID(ST_MakePoint(longitud_retiro, latitud_retiro), 4326)::geography,
+        geo_entrega = ST_SetSRID(ST_MakePoint(longitud_entrega, latitud_entrega), 4326)::geography
+    WHERE id IN (
+        SELECT id FROM pedidos WHERE id > %s AND (geo_retiro IS NULL OR geo_entrega IS NULL) ORDER BY id LIMIT %s
+    )
+    RETURNING id
+"""
+
+_POSTGIS_INDICES = (
+    # El radar solo busca entre pendientes: índice parcial, pequeño y siempre caliente
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_geo_retiro_pendientes ON pedidos USING GIST (geo_retiro) WHERE estado = 'pendiente';",
+    "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_pedidos_geo_entrega ON pedidos USING GIST (geo_entrega);",
+)
+
+
+def preparar_postgis(conn) -> bool:
+    """
+    Crea (si faltan) la extensión, las columnas geography, su trigger y los índices GiST.
+    Devuelve False sin tocar nada si PostGIS no está instalado o no hay permisos.
+    """
+    conn.autocommit = True
+    with conn.cursor() as cur:
+        cur.execute("SELECT EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'postgis')")
+        if not cur.fetchone()[0]:
+            logger.info("PostGIS no está disponible; /pedidos/cercanos usa la cuadrícula en memoria.")
+            return False
+        try:
+            cur.execute("CREATE EXTENSION IF NOT EXISTS postgis;")
+        except psycopg2.errors.InsufficientPrivilege:
+            logger.warning("Sin permisos para CREATE EXTENSION postgis; /pedidos/cercanos usa la cuadrícula en memoria.")
+            return False
+
+        cur.execute("SELECT pg_advisory_lock(%s)", (MIGRATIONS_LOCK_KEY,))
+        try:
+            for statement in _POSTGIS_COLUMNAS:
+                cur.execute(statement)
+            for statement in _POSTGIS_TRIGGER:
+                cur.execute(statement)
+            # Lotes en orden de id (cada uno en su propia transacción, por autocommit)
+            completadas, ultimo_id = 0, 0
+            while True:
+                cur.execute(_POSTGIS_BACKFILL, (ultimo_id, POSTGIS_BACKFILL_BATCH))
+                ids = [fila[0] for fila in cur.fetchall()]
+                completadas += len(ids)
+                if len(ids) < POSTGIS_BACKFILL_BATCH:
+                    break
+                ultimo_id = max(ids)
+            if completadas:
+                logger.info(f"PostGIS: {completadas} pedidos completados con geo_retiro/geo_entrega.")
+            for statement in _POSTGIS_INDICES:
+                _drop_invalid_index(cur, statement)
+                cur.execute(statement)
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATIONS_LOCK_KEY,))
+    logger.info("PostGIS listo para /pedidos/cercanos.")
+    return True
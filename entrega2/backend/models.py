@@ -65,6 +65,38 @@ class CostoDeliveryResponse(BaseModel):
     moneda: str
     tipo_vehiculo: str
 
+# --- COTIZACIÓN EN LOTE (POST /pricing/quotes) ---
+class CotizacionItem(BaseModel):
+    latitud_retiro: float
+    longitud_retiro: float
+    latitud_entrega: float
+    longitud_entrega: float
+    tipo_vehiculo: TipoVehiculo
+    referencia: Optional[str] = None  # Identificador del cliente, se devuelve tal cual
+
+class CotizacionLoteRequest(BaseModel):
+    items: List[CotizacionItem] = Field(..., min_length=1, max_length=1000)
+
+class CotizacionResultado(BaseModel):
+    referencia: Optional[str] = None
+    origen: str
+    destino: str
+    tipo_vehiculo: str
+    distancia_km: Optional[float] = None
+    distancia_texto: Optional[str] = None
+    duracion_texto: Optional[str] = None
+    tier_aplicado: Optional[str] = None
+    costo: Optional[float] = None
+    moneda: Optional[str] = None
+    estimado: bool = False  # True si la distancia es la estimación en línea recta (sin ruta)
+    error: Optional[str] = None
+    quote_id: Optional[str] = None  # Para POST /pedidos: mantiene este precio hasta quote_expires_at
+    quote_expires_at: Optional[datetime] = None
+
+class CotizacionLoteResponse(BaseModel):
+    pricing_version: Optional[datetime] = None
+    results: List[CotizacionResultado]
+
 # --- PEDIDO MODELS ---
 class PedidoBase(BaseModel):
     pedido: str
@@ -86,7 +118,7 @@ class PedidoBase(BaseModel):
     model_config = { "from_attributes": True, "use_enum_values": True }
 
 class PedidoCreate(PedidoBase):
-    pass
+    quote_id: Optional[str] = None  # Cotización de /pricing/quote(s) a respetar (si sigue vigente)
 
 class Pedido(PedidoBase):
     id: int
@@ -139,6 +171,7 @@ class Usuario(BaseModel):
     estado_actual: Optional[str] = None
     porcentaje_comision: Optional[float] = Field(default=0.0)
     ultima_bateria_porcentaje: Optional[int] = None
+    tipo_vehiculo: Optional[str] = None
     fcm_token: Optional[str] = None
     
     model_config = {"from_attributes": True}
@@ -157,6 +190,7 @@ class ChangePasswordRequest(BaseModel):
 
 class UsuarioProfileUpdate(BaseModel):
     nombre_display: Optional[str] = None
+    tipo_vehiculo: Optional[TipoVehiculo] = None
 
 class UpdateCommissionRequest(BaseModel):
     porcentaje_comision: float = Field(..., ge=0, le=100)
@@ -322,6 +356,34 @@ class RestrictedZone(RestrictedZoneBase):
     class Config:
         from_attributes = True
 
+class ZoneCheckPoint(BaseModel):
+    lat: float
+    lng: float
+
+class ZoneCheckRequest(BaseModel):
+    points: List[ZoneCheckPoint] = Field(..., min_length=1, max_length=5000)
+
+class ZoneCheckResult(BaseModel):
+    lat: float
+    lng: float
+    zone_id: Optional[int] = None  # Zona restringida que contiene el punto (None si ninguna)
+    zone_name: Optional[str] = None
+    restricted_now: bool = False  # True si la zona está restringida en este horario
+
+class ZoneCheckResponse(BaseModel):
+    zones_version: int
+    results: List[ZoneCheckResult]
+
+class RepartidorCercano(BaseModel):
+    id_usuario: str
+    nombre_display: Optional[str] = None
+    distancia_km: float
+    latitud: float
+    longitud: float
+    bateria_porcentaje: Optional[int] = None
+    estado: Optional[str] = None
+    ultima_actualizacion: Optional[str] = None
+
 class LoginSuccessRequest(BaseModel):
     fcm_token: Optional[str] = None
     device_info: Optional[str] = None
\ No newline at end of file
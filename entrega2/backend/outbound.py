@@ -0,0 +1,233 @@
+import asyncio
+import functools
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+from firebase_admin import auth, messaging
+
+from database import (
+    GOOGLE_MAPS_API_KEY, OSRM_BASE_URL, FIREBASE_INITIALIZED,
+    estimar_ruta_lineal,
+)
+from route_cache import route_cache
+from pricing import TarifasCompiladas
+from road_router import road_router, ROUTING_BACKEND
+
+logger = logging.getLogger(__name__)
+
+# --- CAPA DE E/S SALIENTE (OSRM, GOOGLE PLACES, FCM, WEBHOOKS) ---
+# Cada servicio externo tiene su propio cliente httpx con keep-alive, un límite
+# de peticiones simultáneas y un timeout. Las llamadas a SDKs síncronos
+# (firebase_admin) se ejecutan en un pool de hilos acotado, nunca en el event loop.
+
+OUTBOUND_SDK_WORKERS = int(os.getenv("OUTBOUND_SDK_WORKERS", 8))
+
+_sdk_executor = ThreadPoolExecutor(max_workers=OUTBOUND_SDK_WORKERS, thread_name_prefix="outbound-sdk")
+
+
+class Upstream:
+    """Servicio externo con concurrencia y timeout propios (configurables por variables de entorno)."""
+    def __init__(self, name: str, max_concurrency: int, timeout: float):
+        env_name = name.upper()
+        self.name = name
+        self.max_concurrency = int(os.getenv(f"OUTBOUND_{env_name}_CONCURRENCY", max_concurrency))
+        self.timeout = float(os.getenv(f"OUTBOUND_{env_name}_TIMEOUT", timeout))
+        self._client = None
+        self._semaphore = None
+        self._stats = {"requests": 0, "errors": 0, "timeouts": 0, "in_flight": 0}
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # Se crea de forma perezosa para que pertenezca al event loop de la aplicación
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                timeout=self.timeout,
+                limits=httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency),
+            )
+        return self._client
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._semaphore
+
+    async def request(self, method: str, url: str, **kwargs) -> httpx.Response:
+        async with self.semaphore:
+            self._stats["requests"] += 1
+            self._stats["in_flight"] += 1
+            try:
+                return await self.client.request(method, url, **kwargs)
+            except httpx.TimeoutException:
+                self._stats["timeouts"] += 1
+                raise
+            except httpx.HTTPError:
+                self._stats["errors"] += 1
+                raise
+            finally:
+                self._stats["in_flight"] -= 1
+
+    async def get(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("GET", url, **kwargs)
+
+    async def post(self, url: str, **kwargs) -> httpx.Response:
+        return await self.request("POST", url, **kwargs)
+
+    async def run_blocking(self, fn, *args, **kwargs):
+        """
+        Ejecuta una llamada síncrona (SDK) en el pool de hilos acotado.
+        Si excede el timeout se libera al llamador; el hilo termina su trabajo por su cuenta.
+        """
+        async with self.semaphore:
+            self._stats["requests"] += 1
+            self._stats["in_flight"] += 1
+            loop = asyncio.get_running_loop()
+            try:
+                return await asyncio.wait_for(
+                    loop.run_in_executor(_sdk_executor, functools.partial(fn, *args, **kwargs)),
+                    timeout=self.timeout
+                )
+            except asyncio.TimeoutError:
+                self._stats["timeouts"] += 1
+                raise
+            except Exception:
+                self._stats["errors"] += 1
+                raise
+            finally:
+                self._stats["in_flight"] -= 1
+
+    async def aclose(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def stats(self) -> dict:
+        return {**self._stats, "max_concurrency": self.max_concurrency, "timeout_s": self.timeout}
+
+
+osrm = Upstream("osrm", max_concurrency=10, timeout=5)
+google_places = Upstream("google_places", max_concurrency=10, timeout=5)
+webhooks = Upstream("webhooks", max_concurrency=20, timeout=10)
+fcm = Upstream("fcm", max_concurrency=8, timeout=10)
+firebase_auth = Upstream("firebase_auth", max_concurrency=16, timeout=5)
+
+UPSTREAMS = (osrm, google_places, webhooks, fcm, firebase_auth)
+
+
+async def close_outbound():
+    """Cierra los clientes HTTP y el pool de hilos. Se llama al apagar la aplicación."""
+    for upstream in UPSTREAMS:
+        await upstream.aclose()
+    _sdk_executor.shutdown(wait=False)
+
+
+def outbound_stats() -> dict:
+    return {upstream.name: upstream.stats() for upstream in UPSTREAMS}
+
+
+# --- RUTAS Y COSTOS ---
+
+async def obtener_distancia_osrm(origen_coords: str, destino_coords: str) -> dict | None:
+    """
+    Obtiene distancia y duración usando OSRM (OpenStreetMap) o el enrutador embebido
+    (según ROUTING_BACKEND), pasando por la caché de rutas.
+    """
+    return await route_cache.obtener(origen_coords, destino_coords, _consultar_ruta)
+
+async def _consultar_ruta(origen_coords: str, destino_coords: str) -> dict | None:
+    if ROUTING_BACKEND in ("local", "auto"):
+        ruta = await road_router.ruta_async(origen_coords, destino_coords)
+        if ruta is not None or ROUTING_BACKEND == "local":
+            return ruta
+    return await _consultar_ruta_osrm(origen_coords, destino_coords)
+
+async def _consultar_ruta_osrm(origen_coords: str, destino_coords: str) -> dict | None:
+    try:
+        lat1, lon1 = origen_coords.split(',')
+        lat2, lon2 = destino_coords.split(',')
+
+        url = f"{OSRM_BASE_URL}/{lon1},{lat1};{lon2},{lat2}?overview=false"
+        response = await osrm.get(url)
+
+        if response.status_code != 200:
+            logger.error(f"Error OSRM API: {response.status_code}")
+            return None
+
+        data = response.json()
+        if data.get("code") != "Ok" or not data.get("routes"):
+            return None
+
+        route = data["routes"][0]
+        return {
+            "km": route["distance"] / 1000,
+            "distancia_texto": f"{route['distance']/1000:.1f} km",
+            "duracion_texto": f"{route['duration']/60:.0f} min"
+        }
+    except Exception as e:
+        logger.error(f"Error conectando con OSRM: {e!r}")
+        return None
+
+async def calcular_costo_delivery_ruta(origen_coords: str, destino_coords: str, tipo_vehiculo: str, tarifas: TarifasCompiladas) -> dict:
+    """
+    Calcula el costo de un envío, con manejo de fallos de OSRM.
+    'tarifas' son las vigentes, de pricing_engine.obtener().
+    """
+    info_ruta = await obtener_distancia_osrm(origen_coords, destino_coords)
+
+    if not info_ruta:
+        # Si OSRM falla (ej: ruta imposible), intentamos un cálculo en línea recta como fallback
+        logger.warning(f"OSRM falló para {origen_coords} -> {destino_coords}. Usando cálculo Haversine como fallback.")
+        info_ruta = estimar_ruta_lineal(origen_coords, destino_coords)
+        if not info_ruta:
+            # Si ni siquiera podemos parsear las coordenadas, devolvemos error.
+            return {"error": "Coordenadas inválidas."}
+
+    return tarifas.cotizar(info_ruta, origen_coords, destino_coords, tipo_vehiculo)
+
+
+# --- GEOCODIFICACIÓN (GOOGLE PLACES) ---
+
+async def get_address_autocomplete(input_text: str, session_token: str) -> dict:
+    if not GOOGLE_MAPS_API_KEY: return {"error": "Google API Key no configurada"}
+    api_url = "https://maps.googleapis.com/maps/api/place/autocomplete/json"
+    params = {"input": input_text, "key": GOOGLE_MAPS_API_KEY, "language": "es", "components": "country:VE", "sessiontoken": session_token}
+    try:
+        response = await google_places.get(api_url, params=params)
+        data = response.json()
+        if data['status'] == 'OK': return {"suggestions": data['predictions']}
+        return {"error": data.get('error_message', 'Error API')}
+    except Exception as e: return {"error": str(e) or repr(e)}
+
+async def get_place_details(place_id: str, session_token: str) -> dict:
+    if not GOOGLE_MAPS_API_KEY: return {"error": "Google API Key no configurada"}
+    api_url = "https://maps.googleapis.com/maps/api/place/details/json"
+    params = {"place_id": place_id, "fields": "geometry,formatted_address", "key": GOOGLE_MAPS_API_KEY, "language": "es", "sessiontoken": session_token}
+    try:
+        response = await google_places.get(api_url, params=params)
+        data = response.json()
+        if data['status'] == 'OK': return {"details": data['result']}
+        return {"error": data.get('error_message', 'Error API')}
+    except Exception as e: return {"error": str(e) or repr(e)}
+
+
+# --- FIREBASE (SDK SÍNCRONO EN POOL DE HILOS) ---
+
+async def send_fcm_message(message) -> bool:
+    """Envía un 'messaging.Message' ya construido sin bloquear el event loop."""
+    try:
+        await fcm.run_blocking(messaging.send, message)
+        return True
+    except Exception as e:
+        logger.error(f"FCM Error: {e!r}")
+        return False
+
+async def send_fcm_notification(token: str, title: str, body: str, data: dict = None) -> bool:
+    if not FIREBASE_INITIALIZED or not token: return False
+    message = messaging.Message(notification=messaging.Notification(title=title, body=body), data=data or {}, token=token)
+    return await send_fcm_message(message)
+
+async def verify_id_token(token: str) -> dict:
+    """auth.verify_id_token puede descargar los certificados públicos de Google; se ejecuta fuera del event loop."""
+    return await firebase_auth.run_blocking(auth.verify_id_token, token)
@@ -0,0 +1,132 @@
+import logging
+import os
+from datetime import datetime, timedelta
+
+import psycopg2
+import pytz
+from psycopg2 import sql
+
+logger = logging.getLogger(__name__)
+
+# --- MANTENIMIENTO DE TABLAS PARTICIONADAS POR FECHA ---
+# ubicaciones_log (diaria) y system_logs (mensual) están particionadas por 'timestamp'
+# (ver migración 5). Este módulo crea las particiones futuras y aplica la retención.
+
+PARTITION_TZ = pytz.timezone('America/Caracas')
+
+PARTITIONED_TABLES = {
+    "ubicaciones_log": {"intervalo": "day", "retencion_dias": int(os.getenv("UBICACIONES_LOG_RETENTION_DAYS", 30))},
+    "system_logs": {"intervalo": "month", "retencion_dias": int(os.getenv("SYSTEM_LOGS_RETENTION_DAYS", 180))},
+}
+PARTITION_PREMAKE = int(os.getenv("PARTITION_PREMAKE", 3))  # Periodos futuros que se crean por adelantado
+PARTITION_RETENTION_ACTION = os.getenv("PARTITION_RETENTION_ACTION", "drop")  # 'drop' elimina, 'detach' solo desengancha (para archivar)
+
+_ultimo_mantenimiento = {}
+
+
+def _inicio_periodo(momento: datetime, intervalo: str) -> datetime:
+    local = momento.astimezone(PARTITION_TZ)
+    if intervalo == "month":
+        inicio = datetime(local.year, local.month, 1)
+    else:
+        inicio = datetime(local.year, local.month, local.day)
+    return PARTITION_TZ.localize(inicio)
+
+
+def _siguiente_periodo(inicio: datetime, intervalo: str) -> datetime:
+    if intervalo == "month":
+        anio, mes = (inicio.year + 1, 1) if inicio.month == 12 else (inicio.year, inicio.month + 1)
+        return PARTITION_TZ.localize(datetime(anio, mes, 1))
+    return PARTITION_TZ.localize(datetime(inicio.year, inicio.month, inicio.day) + timedelta(days=1))
+
+
+def _nombre_particion(tabla: str, inicio: datetime, intervalo: str) -> str:
+    return f"{tabla}_p{inicio.strftime('%Y%m' if intervalo == 'month' else '%Y%m%d')}"
+
+
+def _crear_particiones_futuras(conn, tabla: str, intervalo: str) -> list:
+    creadas = []
+    inicio = _inicio_periodo(datetime.now(PARTITION_TZ), intervalo)
+    for _ in range(PARTITION_PREMAKE + 1):
+        fin = _siguiente_periodo(inicio, intervalo)
+        nombre = _nombre_particion(tabla, inicio, intervalo)
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT to_regclass(%s)", (nombre,))
+                if cur.fetchone()[0] is None:
+                    cur.execute(
+                        sql.SQL("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM (%s) TO (%s)").format(sql.Identifier(nombre), sql.Identifier(tabla)),
+                        (inicio, fin)
+                    )
+                    creadas.append(nombre)
+            conn.commit()
+        except psycopg2.errors.InvalidObjectDefinition:
+            # El rango ya está cubierto por otra partición (ej: la partición '_legacy')
+            conn.rollback()
+        except psycopg2.errors.CheckViolation:
+            conn.rollback()
+            logger.warning(f"No se pudo crear {nombre}: la partición DEFAULT de {tabla} ya tiene filas en ese rango.")
+        inicio = fin
+    return creadas
+
+
+def _aplicar_retencion(conn, tabla: str, retencion_dias: int) -> list:
+    """Elimina (o desengancha) las particiones cuyo rango terminó antes del límite de retención."""
+    limite = datetime.now(PARTITION_TZ) - timedelta(days=retencion_dias)
+    with conn.cursor() as cur:
+        cur.execute("""
+            SELECT c.relname
+            FROM pg_inherits i
+            JOIN pg_class c ON c.oid = i.inhrelid
+            WHERE i.inhparent = %s::regclass
+              AND pg_get_expr(c.relpartbound, c.oid) <> 'DEFAULT'
+              AND (regexp_match(pg_get_expr(c.relpartbound, c.oid), 'TO \\(''(.*)''\\)'))[1]::timestamptz <= %s
+        """, (tabla, limite))
+        expiradas = [row[0] for row in cur.fetchall()]
+    for nombre in expiradas:
+        with conn.cursor() as cur:
+            if PARTITION_RETENTION_ACTION == "detach":
+                cur.execute(sql.SQL("ALTER TABLE {} DETACH PARTITION {}").format(sql.Identifier(tabla), sql.Identifier(nombre)))
+            else:
+                cur.execute(sql.SQL("DROP TABLE {}").format(sql.Identifier(nombre)))
+        conn.commit()
+    return expiradas
+
+
+def _filas_en_default(conn, tabla: str) -> int:
+    with conn.cursor() as cur:
+        cur.execute(sql.SQL("SELECT COUNT(*) FROM {}").format(sql.Identifier(f"{tabla}_default")))
+        return cur.fetchone()[0]
+
+
+def mantener_particiones(conn) -> dict:
+    """
+    Crea las particiones de los próximos PARTITION_PREMAKE periodos y aplica la retención.
+    Se ejecuta al arrancar y periódicamente desde el planificador. Es idempotente.
+    """
+    resultado = {}
+    for tabla, config in PARTITIONED_TABLES.items():
+        try:
+            creadas = _crear_particiones_futuras(conn, tabla, config["intervalo"])
+            expiradas = _aplicar_retencion(conn, tabla, config["retencion_dias"])
+            en_default = _filas_en_default(conn, tabla)
+            conn.commit()
+        except psycopg2.Error as e:
+            conn.rollback()
+            logger.error(f"Error en mantenimiento de particiones de {tabla}: {e}")
+            continue
+        if creadas or expiradas:
+            logger.info(f"Particiones de {tabla}: creadas={creadas}, {PARTITION_RETENTION_ACTION}={expiradas}")
+        if en_default:
+            logger.warning(f"{tabla}_default tiene {en_default} filas fuera de las particiones por fecha.")
+        resultado[tabla] = {"creadas": creadas, "expiradas": expiradas, "filas_en_default": en_default}
+    _ultimo_mantenimiento.update({"timestamp": datetime.now(PARTITION_TZ).isoformat(), "tablas": resultado})
+    return resultado
+
+
+def partitions_stats() -> dict:
+    return {
+        "retention_action": PARTITION_RETENTION_ACTION,
+        "retention_days": {tabla: config["retencion_dias"] for tabla, config in PARTITIONED_TABLES.items()},
+        "last_run": dict(_ultimo_mantenimiento),
+    }
@@ -0,0 +1,274 @@
+import logging
+import os
+import time
+from bisect import bisect_left
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- MOTOR DE TARIFAS PRECOMPILADO ---
+# 'pricing_tiers' (app_config) se compila una sola vez por versión (app_config.updated_at):
+# por tipo de vehículo, los tiers se ordenan como siempre (por min_km) y se reducen a un
+# arreglo de límites creciente, así que buscar el tier de una distancia es un bisect en vez
+# de ordenar y recorrer la lista en cada cotización. La versión se revisa como mucho cada
+# PRICING_CONFIG_CHECK_SECONDS (solo se lee 'updated_at'); PUT /config/pricing_tiers la
+# invalida al instante en esta instancia.
+#
+# Semántica (idéntica a la implementación anterior): se recorren los tiers ordenados por
+# min_km; el primero con 'max_km' >= distancia aplica su precio fijo, y el primero sin
+# 'max_km' pero con 'precio_base' aplica precio_base + (distancia - min_km) * precio_por_km
+# y corta el recorrido (los tiers posteriores nunca se alcanzan).
+
+PRICING_CONFIG_KEY = "pricing_tiers"
+PRICING_CONFIG_CHECK_SECONDS = float(os.getenv("PRICING_CONFIG_CHECK_SECONDS", 5))
+
+
+class TarifaVehiculo:
+    """Tiers de un tipo de vehículo, listos para bisect."""
+    __slots__ = ("moneda", "limites", "tiers_fijos", "tier_abierto", "_limites_np")
+
+    def __init__(self, config_vehiculo: dict):
+        self.moneda = config_vehiculo.get("moneda", "USD")
+        tiers_fijos, maximos, self.tier_abierto = [], [], None
+        for tier in sorted(config_vehiculo.get('tiers', []), key=lambda x: x.get('min_km', float('inf'))):
+            if 'max_km' in tier:
+                tiers_fijos.append((tier.get('nombre'), tier.get('precio_fijo')))
+                maximos.append(tier['max_km'])
+            elif 'precio_base' in tier:
+                self.tier_abierto = (
+                    tier.get('nombre'), tier.get('min_km', 0),
+                    tier.get("precio_base", 0), tier.get("precio_por_km_adicional", 0),
+                )
+                break
+        # Máximo acumulado: el primer i con limites[i] >= d es el primer tier con max_km >= d,
+        # aunque los max_km no estén en orden
+        self.limites = []
+        for maximo in maximos:
+            self.limites.append(maximo if not self.limites or maximo > self.limites[-1] else self.limites[-1])
+        self.tiers_fijos = tiers_fijos
+        self._limites_np = np.array(self.limites, dtype=np.float64)
+
+    def tier_para(self, distancia_km: float) -> tuple:
+        """(nombre del tier, costo) para una distancia; ('No definido', 0.0) si ninguno aplica."""
+        if distancia_km == distancia_km:  # NaN no cumple ningún max_km
+            i = bisect_left(self.limites, distancia_km)
+            if i < len(self.limites):
+                return self.tiers_fijos[i]
+        if self.tier_abierto is not None:
+            nombre, min_km, precio_base, precio_por_km = self.tier_abierto
+            distancia_adicional = distancia_km - min_km
+            return nombre, precio_base + (distancia_adicional * precio_por_km)
+        return "No definido", 0.0
+
+    def tiers_para_lote(self, distancias_km: np.ndarray) -> list:
+        """tier_para() de muchas distancias a la vez: un searchsorted (== bisect_left) y la fórmula del tier abierto en NumPy."""
+        indices = np.searchsorted(self._limites_np, distancias_km, side="left")  # NaN queda al final: sin tier fijo
+        abiertos = None
+        if self.tier_abierto is not None:
+            nombre_abierto, min_km, precio_base, precio_por_km = self.tier_abierto
+            with np.errstate(invalid="ignore"):  # inf * 0 -> NaN, igual que con floats de Python
+                abiertos = precio_base + ((distancias_km - min_km) * precio_por_km)
+        resultado = []
+        for k, i in enumerate(indices.tolist()):
+            if i < len(self.tiers_fijos):
+                resultado.append(self.tiers_fijos[i])
+            elif abiertos is not None:
+                resultado.append((nombre_abierto, float(abiertos[k])))
+            else:
+                resultado.append(("No definido", 0.0))
+        return resultado
+
+
+class TarifasCompiladas:
+    def __init__(self, config_completa: dict, version=None):
+        self.version = version
+        self.vehiculos = {tipo: TarifaVehiculo(config) for tipo, config in config_completa.items()}
+
+    def cotizar(self, info_ruta: dict, origen_coords: str, destino_coords: str, tipo_vehiculo: str) -> dict:
+        """Aplica las tarifas a una ruta ya resuelta."""
+        distancia_km = info_ruta['km']
+        tarifa = self.vehiculos.get(tipo_vehiculo)
+        if tarifa is None:
+            return {"error": f"Tipo de vehículo '{tipo_vehiculo}' no está definido en la configuración."}
+        tier_aplicado, costo = tarifa.tier_para(distancia_km)
+        return {
+            "origen": origen_coords, "destino": destino_coords,
+            "distancia_km": round(distancia_km, 2),
+            "distancia_texto": info_ruta.get('distancia_texto', 'N/A'),
+            "duracion_estimada": info_ruta.get('duracion_estimada', 'N/A'),
+            "tier_aplicado": tier_aplicado,
+            "costo": round(costo, 2),
+            "moneda": tarifa.moneda,
+            "tipo_vehiculo": tipo_vehiculo
+        }
+
+
+    def cotizar_lote(self, rutas: list, tipos_vehiculo: list) -> list:
+        """
+        cotizar() para muchas rutas ya resueltas: (tier, costo, moneda) por ruta, o un dict con
+        'error' si el tipo de vehículo no existe. Los tiers se evalúan por tipo, vectorizados.
+        """
+        resultado = [None] * len(rutas)
+        por_tipo = {}
+        for k, tipo in enumerate(tipos_vehiculo):
+            por_tipo.setdefault(tipo, []).append(k)
+        for tipo, posiciones in por_tipo.items():
+            tarifa = self.vehiculos.get(tipo)
+            if tarifa is None:
+                for k in posiciones:
+                    resultado[k] = {"error": f"Tipo de vehículo '{tipo}' no está definido en la configuración."}
+                continue
+            distancias = np.array([float(rutas[k]['km']) for k in posiciones], dtype=np.float64)
+            for k, (tier_aplicado, costo) in zip(posiciones, tarifa.tiers_para_lote(distancias)):
+                resultado[k] = (tier_aplicado, round(costo, 2), tarifa.moneda)
+        return resultado
+
+
+class PricingEngine:
+    """Tarifas compiladas de la versión vigente de 'pricing_tiers'."""
+    def __init__(self):
+        self._tarifas = None
+        self._revisado = 0.0  # monotonic de la última comprobación de versión
+        self._stats = {"lookups": 0, "version_checks": 0, "compilations": 0, "last_compile_ms": 0.0}
+
+    async def obtener(self, db) -> TarifasCompiladas | None:
+        """Tarifas vigentes usando una conexión asyncpg. None si 'pricing_tiers' no existe."""
+        self._stats["lookups"] += 1
+        if self._tarifas is not None and time.monotonic() - self._revisado < PRICING_CONFIG_CHECK_SECONDS:
+            return self._tarifas
+        self._stats["version_checks"] += 1
+        fila = await db.fetchrow("SELECT updated_at FROM app_config WHERE clave = $1", PRICING_CONFIG_KEY)
+        if not fila:
+            self._tarifas = None
+            return None
+        # Sin updated_at no hay forma de saber si cambió: se recompila en cada revisión
+        if self._tarifas is None or fila['updated_at'] is None or self._tarifas.version != fila['updated_at']:
+            fila = await db.fetchrow("SELECT valor, updated_at FROM app_config WHERE clave = $1", PRICING_CONFIG_KEY)
+            if not fila:
+                self._tarifas = None
+                return None
+            self._compilar(fila['valor'], fila['updated_at'])
+        self._revisado = time.monotonic()
+        return self._tarifas
+
+    def _compilar(self, config_completa: dict, version):
+        inicio = time.monotonic()
+        self._tarifas = TarifasCompiladas(config_completa, version)
+        self._stats["compilations"] += 1
+        self._stats["last_compile_ms"] = round((time.monotonic() - inicio) * 1000, 3)
+        logger.info(f"Tarifas compiladas (versión {version}): {', '.join(self._tarifas.vehiculos) or 'sin vehículos'}.")
+
+    def invalidar(self):
+        """Fuerza a revisar la versión en la próxima cotización (tras editar la configuración)."""
+        self._revisado = 0.0
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "version": self._tarifas.version.isoformat() if self._tarifas and self._tarifas.version else None,
+            "vehicle_types": sorted(self._tarifas.vehiculos) if self._tarifas else [],
+            "check_seconds": PRICING_CONFIG_CHECK_SECONDS,
+        }
+
+
+pricing_engine = PricingEngine()
+
+
+if __name__ == "__main__":
+    # Equivalencia con la implementación anterior (database.calcular_costo_con_ruta) sobre
+    # configuraciones aleatorias y casos límite, y microbenchmark de una cotización.
+    import random
+    import timeit
+
+    def calcular_costo_con_ruta_anterior(info_ruta, origen_coords, destino_coords, tipo_vehiculo, config_completa):
+        distancia_km = info_ruta['km']
+        if tipo_vehiculo not in config_completa:
+            return {"error": f"Tipo de vehículo '{tipo_vehiculo}' no está definido en la configuración."}
+        config_vehiculo = config_completa[tipo_vehiculo]
+        tiers = config_vehiculo.get('tiers', [])
+        costo = 0.0
+        tier_aplicado = "No definido"
+        sorted_tiers = sorted(tiers, key=lambda x: x.get('min_km', float('inf')))
+        for tier in sorted_tiers:
+            if 'max_km' in tier:
+                if distancia_km <= tier['max_km']:
+                    tier_aplicado = tier.get('nombre')
+                    costo = tier.get('precio_fijo')
+                    break
+            elif 'precio_base' in tier:
+                tier_aplicado = tier.get('nombre')
+                distancia_adicional = distancia_km - tier.get('min_km', 0)
+                costo = tier.get("precio_base", 0) + (distancia_adicional * tier.get("precio_por_km_adicional", 0))
+                break
+        return {
+            "origen": origen_coords, "destino": destino_coords,
+            "distancia_km": round(distancia_km, 2),
+            "distancia_texto": info_ruta.get('distancia_texto', 'N/A'),
+            "duracion_estimada": info_ruta.get('duracion_estimada', 'N/A'),
+            "tier_aplicado": tier_aplicado,
+            "costo": round(costo, 2),
+            "moneda": config_vehiculo.get("moneda", "USD"),
+            "tipo_vehiculo": tipo_vehiculo
+        }
+
+    def config_aleatoria(rng):
+        tiers = []
+        for k in range(rng.randint(0, 12)):
+            tier = {"nombre": f"t{k}"}
+            if rng.random() < 0.85:
+                tier["min_km"] = rng.choice([0, 1, 2.5, 3, 5, 8, 10, 15, 20, 30])
+            tipo = rng.random()
+            if tipo < 0.7:
+                tier["max_km"] = rng.choice([1, 2.5, 3, 5, 7.5, 10, 15, 20, 25])
+                tier["precio_fijo"] = rng.choice([2, 2.5, 3, 4.75, 6])
+            elif tipo < 0.95:
+                tier["precio_base"] = rng.choice([3, 5, 7.5])
+                if rng.random() < 0.8:
+                    tier["precio_por_km_adicional"] = rng.choice([0.3, 0.5, 0.75])
+            tiers.append(tier)
+        config = {"tiers": tiers}
+        if rng.random() < 0.5:
+            config["moneda"] = "VES"
+        return config
+
+    rng = random.Random(17)
+    distancias = [0.0, 1.0, 2.5, 5.0, 7.5, 25.0, 1e9, float('inf'), float('nan'), -1.0] + [rng.uniform(0, 40) for _ in range(300)]
+    casos = iguales = 0
+    for _ in range(2000):
+        config = {"moto": config_aleatoria(rng), "carro": config_aleatoria(rng)}
+        tarifas = TarifasCompiladas(config)
+        for d in distancias:
+            for tipo in ("moto", "carro", "van"):
+                ruta = {"km": d, "distancia_texto": "x"}
+                esperado = calcular_costo_con_ruta_anterior(ruta, "o", "d", tipo, config)
+                obtenido = tarifas.cotizar(ruta, "o", "d", tipo)
+                casos += 1
+                # NaN != NaN: se comparan como texto
+                iguales += repr(esperado) == repr(obtenido)
+    print(f"Equivalencia con la implementación anterior: {iguales}/{casos}")
+    assert iguales == casos, "TarifasCompiladas.cotizar difiere de la implementación anterior"
+
+    casos = iguales = 0
+    for _ in range(500):
+        config = {"moto": config_aleatoria(rng), "carro": config_aleatoria(rng)}
+        tarifas = TarifasCompiladas(config)
+        rutas = [{"km": d} for d in distancias] * 3
+        tipos = ["moto"] * len(distancias) + ["carro"] * len(distancias) + ["van"] * len(distancias)
+        for ruta, tipo, lote in zip(rutas, tipos, tarifas.cotizar_lote(rutas, tipos)):
+            uno = tarifas.cotizar(ruta, "o", "d", tipo)
+            casos += 1
+            iguales += repr(lote) == repr(uno if "error" in uno else (uno["tier_aplicado"], uno["costo"], uno["moneda"]))
+    print(f"cotizar_lote == cotizar: {iguales}/{casos}")
+    assert iguales == casos, "cotizar_lote difiere de cotizar"
+
+    config = {"moto": {"moneda": "USD", "tiers": [
+        {"nombre": f"hasta {k} km", "min_km": k - 1, "max_km": k, "precio_fijo": 1 + k * 0.4} for k in range(1, 16)
+    ] + [{"nombre": "largo", "min_km": 15, "precio_base": 7, "precio_por_km_adicional": 0.5}]}}
+    tarifas = TarifasCompiladas(config)
+    rutas = [{"km": rng.uniform(0, 30)} for _ in range(1000)]
+    n = 20
+    t_anterior = min(timeit.repeat(lambda: [calcular_costo_con_ruta_anterior(r, "o", "d", "moto", config) for r in rutas], number=n, repeat=5)) / (n * len(rutas))
+    t_compilado = min(timeit.repeat(lambda: [tarifas.cotizar(r, "o", "d", "moto") for r in rutas], number=n, repeat=5)) / (n * len(rutas))
+    t_lote = min(timeit.repeat(lambda: tarifas.cotizar_lote(rutas, ["moto"] * len(rutas)), number=n, repeat=5)) / (n * len(rutas))
+    print(f"16 tiers: anterior {t_anterior * 1e6:.2f} µs/cotización, compilado {t_compilado * 1e6:.2f} µs ({t_anterior / t_compilado:.1f}x), lote {t_lote * 1e6:.2f} µs ({t_anterior / t_lote:.1f}x)")
@@ -0,0 +1,114 @@
+import base64
+import json
+from datetime import date, datetime, time, timedelta
+from typing import Optional
+
+import pytz
+from fastapi import HTTPException
+
+# --- CONSTRUCTOR DE FILTROS SQL CON RANGOS DE FECHA EN HORA LOCAL ---
+# Los filtros por día ("del 2024-05-01 al 2024-05-03") se traducen a rangos semiabiertos
+# de timestamps en America/Caracas: fecha_creacion >= inicio AND fecha_creacion < fin.
+# Así la columna queda sin funciones alrededor y Postgres puede usar los índices btree,
+# en lugar de DATE(columna) o (columna AT TIME ZONE ...)::date, que obligan a un seq scan.
+
+BUSINESS_TZ = pytz.timezone('America/Caracas')
+
+
+def parse_fecha(valor) -> date:
+    """Convierte un filtro de fecha 'AAAA-MM-DD' (o ISO completo) en 'date'. asyncpg no castea texto a fecha."""
+    if isinstance(valor, date):
+        return valor
+    try:
+        return date.fromisoformat(str(valor)[:10])
+    except ValueError:
+        raise HTTPException(status_code=400, detail=f"Fecha inválida: '{valor}'. Use el formato AAAA-MM-DD.")
+
+
+def inicio_del_dia(dia) -> datetime:
+    """00:00 del día indicado en hora de Caracas (límite inferior inclusivo)."""
+    return BUSINESS_TZ.localize(datetime.combine(parse_fecha(dia), time.min))
+
+
+def fin_del_dia(dia) -> datetime:
+    """00:00 del día siguiente en hora de Caracas (límite superior exclusivo)."""
+    return BUSINESS_TZ.localize(datetime.combine(parse_fecha(dia) + timedelta(days=1), time.min))
+
+
+def hoy() -> date:
+    return datetime.now(BUSINESS_TZ).date()
+
+
+# --- CURSORES OPACOS PARA PAGINACIÓN KEYSET ---
+# El cursor guarda los valores de la clave de orden de la última fila entregada
+# (ej: fecha_creacion e id). La página siguiente empieza justo después de esa fila
+# usando el índice, así que cuesta lo mismo que la primera (sin OFFSET).
+
+def encode_cursor(*valores) -> str:
+    serializables = [{"dt": v.isoformat()} if isinstance(v, datetime) else v for v in valores]
+    return base64.urlsafe_b64encode(json.dumps(serializables).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> list:
+    try:
+        relleno = "=" * (-len(cursor) % 4)
+        valores = json.loads(base64.urlsafe_b64decode(cursor + relleno))
+        return [datetime.fromisoformat(v["dt"]) if isinstance(v, dict) else v for v in valores]
+    except (ValueError, TypeError, KeyError):
+        raise HTTPException(status_code=400, detail="Cursor de paginación inválido.")
+
+
+def paginar(filas: list, limit: int, claves: tuple):
+    """
+    Recibe hasta limit+1 filas. Devuelve (filas_de_la_pagina, cursor_siguiente);
+    el cursor es None cuando no hay más resultados.
+    """
+    if len(filas) <= limit:
+        return filas, None
+    pagina = filas[:limit]
+    return pagina, encode_cursor(*(pagina[-1][k] for k in claves))
+
+
+class WhereBuilder:
+    """
+    Acumula condiciones y parámetros posicionales ($1, $2, ...) para asyncpg.
+
+        wb = WhereBuilder()
+        wb.add("p.estado = ANY({})", ["pendiente"])
+        wb.date_range("p.fecha_creacion", "2024-05-01", "2024-05-03")
+        await db.fetch(f"SELECT ... {wb.where()}", *wb.params)
+    """
+    def __init__(self):
+        self.clauses = []
+        self.params = []
+
+    def param(self, valor) -> str:
+        self.params.append(valor)
+        return f"${len(self.params)}"
+
+    def add(self, clausula: str, *valores):
+        """Cada '{}' de la cláusula se reemplaza por el marcador del valor correspondiente."""
+        self.clauses.append(clausula.format(*[self.param(v) for v in valores]))
+        return self
+
+    def date_range(self, columna: str, desde=None, hasta=None):
+        """Filtra 'columna' (timestamptz) por días completos, ambos extremos inclusivos."""
+        if desde:
+            self.add(f"{columna} >= {{}}", inicio_del_dia(desde))
+        if hasta:
+            self.add(f"{columna} < {{}}", fin_del_dia(hasta))
+        return self
+
+    def keyset(self, columnas: tuple, cursor: Optional[str], descendente: bool = True):
+        """Continúa después de la fila del cursor: (col1, col2) < (v1, v2) en orden descendente."""
+        if cursor:
+            valores = decode_cursor(cursor)
+            if len(valores) != len(columnas):
+                raise HTTPException(status_code=400, detail="Cursor de paginación inválido.")
+            marcadores = ", ".join("{}" for _ in columnas)
+            self.add(f"({', '.join(columnas)}) {'<' if descendente else '>'} ({marcadores})", *valores)
+        return self
+
+    def where(self) -> str:
+        return f"WHERE {' AND '.join(self.clauses)}" if self.clauses else ""
+
@@ -0,0 +1,91 @@
+import json
+import logging
+import os
+import uuid
+
+from database import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# --- COTIZACIONES EMITIDAS (REDIS) ---
+# Cada cotización de /pricing/quote(s) se guarda en Redis con un ID y un TTL, junto con las
+# coordenadas, el tipo de vehículo, la versión de 'pricing_tiers' y el resultado (distancia y
+# precio). Si POST /pedidos trae 'quote_id' y la cotización sigue vigente para los mismos
+# puntos, vehículo y versión de tarifas, el pedido usa ese precio sin volver a calcular la
+# ruta: el cliente paga lo que vio y OSRM no se consulta dos veces. Si algo no coincide
+# (o no hay Redis) el pedido se cotiza como siempre. El cliente de Redis es síncrono: desde
+# código async estas funciones se llaman con asyncio.to_thread.
+
+QUOTE_TTL_SECONDS = int(os.getenv("QUOTE_TTL_SECONDS", 900))
+QUOTE_KEY_PREFIX = "cotizacion"
+QUOTE_COORD_TOLERANCE = 1e-6  # grados (~0.1 m): margen para el redondeo de floats en el cliente
+
+_stats = {"issued": 0, "redeemed": 0, "not_found": 0, "rejected": 0, "errors": 0}
+
+
+def emitir_cotizaciones(cotizaciones: list) -> list:
+    """
+    Guarda las cotizaciones (dicts) en un solo viaje a Redis. Devuelve el ID de cada una,
+    o None para todas si Redis no está disponible.
+    """
+    r = get_redis_client()
+    if not r or not cotizaciones:
+        return [None] * len(cotizaciones)
+    ids = [uuid.uuid4().hex for _ in cotizaciones]
+    try:
+        pipe = r.pipeline(transaction=False)
+        for quote_id, cotizacion in zip(ids, cotizaciones):
+            pipe.set(f"{QUOTE_KEY_PREFIX}:{quote_id}", json.dumps({**cotizacion, "id": quote_id}), ex=QUOTE_TTL_SECONDS)
+        pipe.execute()
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.warning(f"No se pudieron guardar {len(cotizaciones)} cotizaciones en Redis: {e!r}")
+        return [None] * len(cotizaciones)
+    _stats["issued"] += len(ids)
+    return ids
+
+
+def _motivo_rechazo(cotizacion: dict, puntos: tuple, tipo_vehiculo: str, version: str | None) -> str | None:
+    if cotizacion.get("tipo_vehiculo") != tipo_vehiculo:
+        return "tipo de vehículo distinto"
+    if cotizacion.get("pricing_version") != version:
+        return "las tarifas cambiaron"
+    guardados = cotizacion.get("puntos")
+    # zip() cortaría en silencio una lista incompleta: sin los 4 valores no hay comparación posible
+    if not isinstance(guardados, list) or len(guardados) != 4 or len(puntos) != 4:
+        return "coordenadas distintas"
+    if any(v is None or c is None or abs(v - c) > QUOTE_COORD_TOLERANCE for v, c in zip(puntos, guardados)):
+        return "coordenadas distintas"
+    return None
+
+
+def canjear_cotizacion(quote_id: str, puntos: tuple, tipo_vehiculo: str, version: str | None) -> dict | None:
+    """
+    La cotización 'quote_id' si sigue vigente para estos puntos (lat_retiro, lon_retiro,
+    lat_entrega, lon_entrega), vehículo y versión de tarifas; None si hay que recalcular.
+    """
+    r = get_redis_client()
+    if not r:
+        return None
+    try:
+        valor = r.get(f"{QUOTE_KEY_PREFIX}:{quote_id}")
+    except Exception as e:
+        _stats["errors"] += 1
+        logger.warning(f"No se pudo leer la cotización {quote_id} de Redis: {e!r}")
+        return None
+    if valor is None:
+        _stats["not_found"] += 1
+        logger.info(f"Cotización {quote_id} inexistente o vencida. Se recalcula el precio.")
+        return None
+    cotizacion = json.loads(valor)
+    motivo = _motivo_rechazo(cotizacion, puntos, tipo_vehiculo, version)
+    if motivo:
+        _stats["rejected"] += 1
+        logger.info(f"Cotización {quote_id} no aplicable ({motivo}). Se recalcula el precio.")
+        return None
+    _stats["redeemed"] += 1
+    return cotizacion
+
+
+def quotes_stats() -> dict:
+    return {**_stats, "ttl_seconds": QUOTE_TTL_SECONDS}
@@ -0,0 +1,499 @@
+import asyncio
+import heapq
+import logging
+import math
+import os
+import time
+from array import array
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from geo import haversine_km, haversine_uno_a_muchos
+
+logger = logging.getLogger(__name__)
+
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.csgraph import dijkstra as _dijkstra_scipy
+    SCIPY_AVAILABLE = True
+except ImportError:
+    SCIPY_AVAILABLE = False
+
+try:
+    import osmium
+    OSMIUM_AVAILABLE = True
+except ImportError:
+    OSMIUM_AVAILABLE = False
+
+# --- ENRUTADOR VIAL EMBEBIDO (SIN CONEXIÓN) ---
+# Alternativa local a OSRM: al arrancar se carga un extracto de la red vial de la región
+# (archivo .npz generado con 'python road_router.py construir region.osm.pbf grafo.npz')
+# en un grafo compacto en arreglos (formato CSR: offsets + destinos + metros + segundos).
+# Las consultas punto a punto usan A* con landmarks (ALT); las de uno a muchos, un único
+# Dijkstra que se detiene al alcanzar todos los destinos. Como OSRM, la ruta minimiza el
+# tiempo y devuelve la distancia de esa ruta. Las distancias a los landmarks se calculan al
+# construir el archivo, así que la carga solo lee arreglos.
+# ROUTING_BACKEND elige quién responde obtener_distancia_osrm:
+#   osrm  -> solo OSRM (por defecto)
+#   local -> solo el enrutador embebido
+#   auto  -> el enrutador embebido y OSRM si este no encuentra la ruta (o no hay grafo)
+
+ROUTING_BACKEND = os.getenv("ROUTING_BACKEND", "osrm")  # osrm | local | auto
+ROAD_GRAPH_PATH = os.getenv("ROAD_GRAPH_PATH", "")
+ROAD_ROUTER_MAX_SNAP_KM = float(os.getenv("ROAD_ROUTER_MAX_SNAP_KM", 0.5))  # Más lejos de una vía: sin ruta
+ROAD_ROUTER_WORKERS = int(os.getenv("ROAD_ROUTER_WORKERS", 2))
+ROAD_ROUTER_LANDMARKS = 16        # Landmarks que se calculan al construir el grafo
+ROAD_ROUTER_ACTIVE_LANDMARKS = 4  # Los que se usan por consulta (los de mejor cota para ese par)
+
+_SNAP_CELL_DEG = 0.005  # ~550 m: celdas del índice para ubicar el nodo más cercano
+_SIN_CAMINO = 1e30      # Tiempo a/desde un landmark cuando no hay camino
+
+# Velocidad (km/h) por tipo de vía cuando el extracto no trae 'maxspeed'
+VELOCIDADES_KMH = {
+    "motorway": 90, "trunk": 70, "primary": 55, "secondary": 45, "tertiary": 35,
+    "motorway_link": 50, "trunk_link": 40, "primary_link": 35, "secondary_link": 30, "tertiary_link": 25,
+    "unclassified": 25, "residential": 20, "living_street": 10, "service": 12,
+}
+
+_executor = ThreadPoolExecutor(max_workers=ROAD_ROUTER_WORKERS, thread_name_prefix="road-router")
+
+
+def _a_array(tipo: str, valores: np.ndarray) -> array:
+    """array.array: tan compacto como NumPy, pero indexar desde Python devuelve int/float nativos (más rápido)."""
+    arreglo = array(tipo)
+    arreglo.frombytes(np.ascontiguousarray(valores, dtype={"i": np.int32, "f": np.float32}[tipo]).tobytes())
+    return arreglo
+
+
+class RoadRouter:
+    def __init__(self):
+        self.cargado = False
+        self.ruta_archivo = None
+        self._stats = {"queries": 0, "one_to_many": 0, "no_route": 0, "snap_failures": 0, "settled_nodes": 0, "load_ms": 0.0}
+
+    # --- CARGA ---
+
+    def cargar(self, ruta_archivo: str):
+        inicio = time.monotonic()
+        with np.load(ruta_archivo) as datos:
+            self.lat = datos["lat"].astype(np.float64)
+            self.lon = datos["lon"].astype(np.float64)
+            self.offsets = _a_array("i", datos["offsets"])
+            self.destinos = _a_array("i", datos["destinos"])
+            self.metros = _a_array("f", datos["metros"])
+            self.segundos = _a_array("f", datos["segundos"])
+            self.landmarks = [int(v) for v in datos["landmarks"]]
+            # Por landmark L: tiempo L -> v ('desde') y v -> L ('hacia')
+            self._lm_desde = [_a_array("f", fila) for fila in datos["lm_desde"]]
+            self._lm_hacia = [_a_array("f", fila) for fila in datos["lm_hacia"]]
+            self.velocidad_max_ms = float(datos["velocidad_max_ms"])
+
+        # Índice de celdas para ubicar coordenadas: claves ordenadas + posición del nodo
+        claves = self._claves_celda(self.lat, self.lon)
+        self._orden_celdas = np.argsort(claves, kind="stable").astype(np.int32)
+        self._claves_ordenadas = claves[self._orden_celdas]
+
+        self.ruta_archivo = ruta_archivo
+        self.cargado = True
+        self._stats["load_ms"] = round((time.monotonic() - inicio) * 1000, 3)
+        logger.info(f"Grafo vial cargado desde '{ruta_archivo}': {len(self.lat)} nodos, {len(self.destinos)} aristas, {len(self.landmarks)} landmarks ({self._stats['load_ms']:.0f} ms).")
+
+    @staticmethod
+    def _claves_celda(lats, lons) -> np.ndarray:
+        filas = np.floor(np.asarray(lats) / _SNAP_CELL_DEG).astype(np.int64)
+        columnas = np.floor(np.asarray(lons) / _SNAP_CELL_DEG).astype(np.int64)
+        return (filas << 32) + (columnas & 0xFFFFFFFF)
+
+    def nodo_cercano(self, lat: float, lon: float) -> int | None:
+        """Nodo del grafo más cercano dentro de ROAD_ROUTER_MAX_SNAP_KM, revisando la celda y sus 8 vecinas."""
+        fila0, columna0 = math.floor(lat / _SNAP_CELL_DEG), math.floor(lon / _SNAP_CELL_DEG)
+        candidatos = []
+        for fila in (fila0 - 1, fila0, fila0 + 1):
+            for columna in (columna0 - 1, columna0, columna0 + 1):
+                clave = (fila << 32) + (columna & 0xFFFFFFFF)
+                desde = np.searchsorted(self._claves_ordenadas, clave, side="left")
+                hasta = np.searchsorted(self._claves_ordenadas, clave, side="right")
+                if hasta > desde:
+                    candidatos.append(self._orden_celdas[desde:hasta])
+        if not candidatos:
+            return None
+        nodos = np.concatenate(candidatos)
+        distancias = haversine_uno_a_muchos(lat, lon, self.lat[nodos], self.lon[nodos])
+        mejor = int(np.argmin(distancias))
+        if distancias[mejor] > ROAD_ROUTER_MAX_SNAP_KM:
+            return None
+        return int(nodos[mejor])
+
+    # --- BÚSQUEDAS ---
+
+    def _heuristica(self, destino: int):
+        """Cota inferior del tiempo v -> destino (ALT). Sin landmarks, línea recta a la velocidad máxima."""
+        if not self.landmarks:
+            lat_t, lon_t, lat, lon, v_max = float(self.lat[destino]), float(self.lon[destino]), self.lat, self.lon, self.velocidad_max_ms
+            return lambda v: haversine_km(lat[v], lon[v], lat_t, lon_t) * 1000 / v_max
+
+        # Solo los landmarks más alejados del destino (son los que dan las cotas más ajustadas)
+        cotas = sorted(
+            range(len(self.landmarks)),
+            key=lambda k: -max(v for v in (self._lm_desde[k][destino], self._lm_hacia[k][destino], 0.0) if v < _SIN_CAMINO),
+        )[:ROAD_ROUTER_ACTIVE_LANDMARKS]
+        activos = [(self._lm_desde[k], self._lm_hacia[k], self._lm_desde[k][destino], self._lm_hacia[k][destino]) for k in cotas]
+
+        def h(v):
+            mejor = 0.0
+            for desde, hacia, desde_t, hacia_t in activos:
+                # Desigualdad triangular: d(v,t) >= d(L,t) - d(L,v) y d(v,t) >= d(v,L) - d(t,L)
+                cota = desde_t - desde[v]
+                if cota > mejor:
+                    mejor = cota
+                cota = hacia[v] - hacia_t
+                if cota > mejor:
+                    mejor = cota
+            return mejor
+        return h
+
+    def _alt(self, origen: int, destino: int):
+        """(segundos, metros) de la ruta más rápida, o None si no hay camino."""
+        if origen == destino:
+            return 0.0, 0.0
+        h = self._heuristica(destino)
+        offsets, destinos, metros, segundos = self.offsets, self.destinos, self.metros, self.segundos
+        tiempo = {origen: 0.0}
+        distancia = {origen: 0.0}
+        cerrados = set()
+        cola = [(h(origen), 0.0, origen)]
+        while cola:
+            _, t_v, v = heapq.heappop(cola)
+            if v == destino:
+                self._stats["settled_nodes"] += len(cerrados)
+                return t_v, distancia[v]
+            if v in cerrados:
+                continue
+            cerrados.add(v)
+            d_v = distancia[v]
+            for e in range(offsets[v], offsets[v + 1]):
+                w = destinos[e]
+                t_w = t_v + segundos[e]
+                if t_w < tiempo.get(w, math.inf):
+                    tiempo[w] = t_w
+                    distancia[w] = d_v + metros[e]
+                    heapq.heappush(cola, (t_w + h(w), t_w, w))
+        self._stats["settled_nodes"] += len(cerrados)
+        return None
+
+    def _dijkstra_hacia(self, origen: int, objetivos: set) -> tuple:
+        """Tiempos y metros desde 'origen'; se detiene al cerrar todos los objetivos."""
+        offsets, destinos, metros, segundos = self.offsets, self.destinos, self.metros, self.segundos
+        tiempo = {origen: 0.0}
+        distancia = {origen: 0.0}
+        pendientes = set(objetivos)
+        cerrados = set()
+        cola = [(0.0, origen)]
+        while cola and pendientes:
+            t_v, v = heapq.heappop(cola)
+            if v in cerrados:
+                continue
+            cerrados.add(v)
+            pendientes.discard(v)
+            d_v = distancia[v]
+            for e in range(offsets[v], offsets[v + 1]):
+                w = destinos[e]
+                t_w = t_v + segundos[e]
+                if t_w < tiempo.get(w, math.inf):
+                    tiempo[w] = t_w
+                    distancia[w] = d_v + metros[e]
+                    heapq.heappush(cola, (t_w, w))
+        self._stats["settled_nodes"] += len(cerrados)
+        return tiempo, distancia, cerrados
+
+    # --- API ---
+
+    def ruta(self, lat1: float, lon1: float, lat2: float, lon2: float) -> dict | None:
+        """Mismo formato que obtener_distancia_osrm. None si algún punto está lejos de la red o no hay camino."""
+        self._stats["queries"] += 1
+        origen, destino = self.nodo_cercano(lat1, lon1), self.nodo_cercano(lat2, lon2)
+        if origen is None or destino is None:
+            self._stats["snap_failures"] += 1
+            return None
+        resultado = self._alt(origen, destino)
+        if resultado is None:
+            self._stats["no_route"] += 1
+            return None
+        segundos, metros = resultado
+        return {
+            "km": metros / 1000,
+            "distancia_texto": f"{metros/1000:.1f} km",
+            "duracion_texto": f"{segundos/60:.0f} min"
+        }
+
+    def uno_a_muchos(self, lat: float, lon: float, destinos: list) -> tuple:
+        """
+        (km, segundos) desde un punto a cada (lat, lon) de 'destinos', como arreglos (M,).
+        NaN donde no hay ruta o el punto está lejos de la red.
+        """
+        self._stats["one_to_many"] += 1
+        km = np.full(len(destinos), np.nan)
+        segundos = np.full(len(destinos), np.nan)
+        origen = self.nodo_cercano(lat, lon)
+        if origen is None:
+            self._stats["snap_failures"] += 1
+            return km, segundos
+        nodos = [self.nodo_cercano(lat_d, lon_d) for lat_d, lon_d in destinos]
+        tiempo, distancia, cerrados = self._dijkstra_hacia(origen, {n for n in nodos if n is not None})
+        for j, nodo in enumerate(nodos):
+            if nodo is not None and nodo in cerrados:
+                km[j], segundos[j] = distancia[nodo] / 1000, tiempo[nodo]
+        return km, segundos
+
+    async def ruta_async(self, origen_coords: str, destino_coords: str) -> dict | None:
+        """Versión para el event loop: la búsqueda (CPU) corre en el pool de hilos del enrutador."""
+        if not self.cargado:
+            return None
+        try:
+            lat1, lon1 = map(float, origen_coords.split(','))
+            lat2, lon2 = map(float, destino_coords.split(','))
+        except (AttributeError, ValueError):
+            return None
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, self.ruta, lat1, lon1, lat2, lon2)
+
+    async def uno_a_muchos_async(self, lat: float, lon: float, destinos: list) -> tuple:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(_executor, self.uno_a_muchos, lat, lon, destinos)
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "backend": ROUTING_BACKEND,
+            "loaded": self.cargado,
+            "graph": self.ruta_archivo,
+            "nodes": len(self.lat) if self.cargado else 0,
+            "edges": len(self.destinos) if self.cargado else 0,
+            "landmarks": len(self.landmarks) if self.cargado else 0,
+        }
+
+
+road_router = RoadRouter()
+
+
+async def cargar_grafo_vial():
+    """Carga ROAD_GRAPH_PATH al arrancar (si el backend lo usa), sin bloquear el event loop."""
+    if ROUTING_BACKEND == "osrm":
+        return
+    if not ROAD_GRAPH_PATH or not os.path.exists(ROAD_GRAPH_PATH):
+        logger.warning(f"ROUTING_BACKEND={ROUTING_BACKEND} pero ROAD_GRAPH_PATH ('{ROAD_GRAPH_PATH}') no existe. Se usará OSRM/estimación.")
+        return
+    try:
+        await asyncio.get_running_loop().run_in_executor(_executor, road_router.cargar, ROAD_GRAPH_PATH)
+    except Exception as e:
+        logger.error(f"Error cargando el grafo vial '{ROAD_GRAPH_PATH}': {e!r}")
+
+
+# --- CONSTRUCCIÓN DEL ARCHIVO DEL GRAFO ---
+
+def _dijkstra_completo(offsets, destinos, pesos, origen: int) -> np.ndarray:
+    """Tiempos desde 'origen' a todos los nodos (inf si no se alcanzan). Solo se usa al construir."""
+    n = len(offsets) - 1
+    if SCIPY_AVAILABLE:
+        grafo = csr_matrix((pesos, destinos, offsets), shape=(n, n))
+        return _dijkstra_scipy(grafo, directed=True, indices=origen)
+    tiempo = np.full(n, np.inf)
+    tiempo[origen] = 0.0
+    cola = [(0.0, origen)]
+    offsets, destinos, pesos = offsets.tolist(), destinos.tolist(), pesos.tolist()
+    while cola:
+        t_v, v = heapq.heappop(cola)
+        if t_v > tiempo[v]:
+            continue
+        for e in range(offsets[v], offsets[v + 1]):
+            w = destinos[e]
+            if t_v + pesos[e] < tiempo[w]:
+                tiempo[w] = t_v + pesos[e]
+                heapq.heappush(cola, (tiempo[w], w))
+    return tiempo
+
+
+def construir_grafo(lat, lon, origenes, destinos, metros, segundos, n_landmarks: int = ROAD_ROUTER_LANDMARKS) -> dict:
+    """
+    Arreglos del archivo .npz a partir de una lista de aristas dirigidas (índices de nodo).
+    Los landmarks se eligen por el método del más lejano: cada uno es el nodo alcanzable más
+    alejado (en tiempo) de los ya elegidos, lo que da buenas cotas en los bordes de la región.
+    """
+    lat, lon = np.asarray(lat, dtype=np.float64), np.asarray(lon, dtype=np.float64)
+    origenes, destinos = np.asarray(origenes, dtype=np.int64), np.asarray(destinos, dtype=np.int64)
+    metros, segundos = np.asarray(metros, dtype=np.float64), np.asarray(segundos, dtype=np.float64)
+    n = len(lat)
+
+    orden = np.lexsort((destinos, origenes))
+    origenes, destinos, metros, segundos = origenes[orden], destinos[orden], metros[orden], segundos[orden]
+    offsets = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(offsets, origenes + 1, 1)
+    offsets = np.cumsum(offsets)
+    # Grafo inverso para las distancias v -> landmark
+    orden_inv = np.lexsort((origenes, destinos))
+    offsets_inv = np.zeros(n + 1, dtype=np.int64)
+    np.add.at(offsets_inv, destinos + 1, 1)
+    offsets_inv = np.cumsum(offsets_inv)
+
+    landmarks, lm_desde, lm_hacia = [], [], []
+    minimo = np.full(n, np.inf)
+    actual = int(np.argmax(np.bincount(origenes, minlength=n)))  # Arranque: un nodo bien conectado
+    for _ in range(min(n_landmarks, n)):
+        desde = _dijkstra_completo(offsets, destinos, segundos, actual)
+        hacia = _dijkstra_completo(offsets_inv, origenes[orden_inv], segundos[orden_inv], actual)
+        landmarks.append(actual)
+        lm_desde.append(desde)
+        lm_hacia.append(hacia)
+        minimo = np.minimum(minimo, np.where(np.isfinite(desde), desde, np.inf))
+        candidatos = np.where(np.isfinite(minimo), minimo, -1)
+        actual = int(np.argmax(candidatos))
+        if candidatos[actual] <= 0:
+            break
+
+    # Nodo no alcanzable -> _SIN_CAMINO (grande y finito, cabe en float32). Las cotas que
+    # resultan siguen siendo válidas: si L llega a v pero no a t, v tampoco llega a t.
+    desde = np.where(np.isfinite(lm_desde), lm_desde, _SIN_CAMINO)
+    hacia = np.where(np.isfinite(lm_hacia), lm_hacia, _SIN_CAMINO)
+    return {
+        "lat": lat.astype(np.float32), "lon": lon.astype(np.float32),
+        "offsets": offsets.astype(np.int32), "destinos": destinos.astype(np.int32),
+        "metros": metros.astype(np.float32), "segundos": segundos.astype(np.float32),
+        "landmarks": np.array(landmarks, dtype=np.int32),
+        "lm_desde": desde.astype(np.float32), "lm_hacia": hacia.astype(np.float32),
+        "velocidad_max_ms": np.float64(np.max(metros / np.maximum(segundos, 1e-9)) if len(metros) else 1.0),
+    }
+
+
+def _velocidad_kmh(etiquetas) -> float | None:
+    tipo = etiquetas.get("highway")
+    if tipo not in VELOCIDADES_KMH:
+        return None
+    maxspeed = etiquetas.get("maxspeed", "")
+    if maxspeed.isdigit():
+        return float(maxspeed)
+    return float(VELOCIDADES_KMH[tipo])
+
+
+def construir_desde_osm(ruta_pbf: str) -> dict:
+    """Lee un extracto OSM (.osm.pbf) con pyosmium y arma el grafo de vías transitables en carro/moto."""
+    if not OSMIUM_AVAILABLE:
+        raise RuntimeError("Para construir el grafo desde OSM hace falta 'osmium' (pip install osmium).")
+
+    indices, lats, lons = {}, [], []
+    origenes, destinos, metros, segundos = [], [], [], []
+
+    def nodo(ref, lat, lon):
+        idx = indices.get(ref)
+        if idx is None:
+            idx = indices[ref] = len(lats)
+            lats.append(lat)
+            lons.append(lon)
+        return idx
+
+    class Vias(osmium.SimpleHandler):
+        def way(self, w):
+            etiquetas = {t.k: t.v for t in w.tags}
+            velocidad = _velocidad_kmh(etiquetas)
+            if velocidad is None or etiquetas.get("access") in ("no", "private") or etiquetas.get("motor_vehicle") == "no":
+                return
+            oneway = etiquetas.get("oneway", "no")
+            ida = oneway != "-1"
+            vuelta = oneway in ("no", "false", "0") and etiquetas.get("junction") != "roundabout" and etiquetas.get("highway") != "motorway"
+            if oneway == "-1":
+                vuelta = True
+            puntos = [(n.ref, n.location.lat, n.location.lon) for n in w.nodes if n.location.valid()]
+            for (ref1, lat1, lon1), (ref2, lat2, lon2) in zip(puntos, puntos[1:]):
+                a, b = nodo(ref1, lat1, lon1), nodo(ref2, lat2, lon2)
+                largo = haversine_km(lat1, lon1, lat2, lon2) * 1000
+                duracion = largo / (velocidad / 3.6)
+                for u, v, sentido in ((a, b, ida), (b, a, vuelta)):
+                    if sentido:
+                        origenes.append(u)
+                        destinos.append(v)
+                        metros.append(largo)
+                        segundos.append(duracion)
+
+    Vias().apply_file(ruta_pbf, locations=True)
+    logger.info(f"Extracto OSM leído: {len(lats)} nodos, {len(origenes)} aristas. Calculando landmarks...")
+    return construir_grafo(lats, lons, origenes, destinos, metros, segundos)
+
+
+def _grafo_de_prueba(lado: int, seed: int = 7) -> dict:
+    """Cuadrícula de calles de 'lado' x 'lado' alrededor de Caracas, con velocidades y sentidos únicos aleatorios."""
+    rng = np.random.default_rng(seed)
+    paso = 0.0015  # ~165 m entre esquinas
+    filas, columnas = np.divmod(np.arange(lado * lado), lado)
+    lat = 10.40 + filas * paso + rng.uniform(-0.0002, 0.0002, lado * lado)
+    lon = -67.00 + columnas * paso + rng.uniform(-0.0002, 0.0002, lado * lado)
+    origenes, destinos = [], []
+    for a, b in [(i, i + 1) for i in range(lado * lado) if (i + 1) % lado] + [(i, i + lado) for i in range(lado * (lado - 1))]:
+        sentido = rng.random()
+        if sentido > 0.15:
+            origenes.append(a)
+            destinos.append(b)
+        if sentido < 0.85 or sentido > 0.95:
+            origenes.append(b)
+            destinos.append(a)
+    origenes, destinos = np.array(origenes), np.array(destinos)
+    metros = np.array([haversine_km(lat[u], lon[u], lat[v], lon[v]) * 1000 for u, v in zip(origenes, destinos)])
+    velocidades = rng.choice([20, 30, 45, 60], size=len(metros), p=[0.5, 0.25, 0.15, 0.1]) / 3.6
+    return construir_grafo(lat, lon, origenes, destinos, metros, metros / velocidades)
+
+
+if __name__ == "__main__":
+    # Uso:
+    #   python road_router.py construir region.osm.pbf grafo.npz   -> genera el archivo para ROAD_GRAPH_PATH
+    #   python road_router.py [lado]                               -> verificación y benchmark con una cuadrícula sintética
+    import random
+    import sys
+    import tempfile
+
+    logging.basicConfig(level=logging.INFO)
+    if len(sys.argv) == 4 and sys.argv[1] == "construir":
+        inicio = time.perf_counter()
+        np.savez(sys.argv[3], **construir_desde_osm(sys.argv[2]))
+        print(f"Grafo guardado en {sys.argv[3]} ({time.perf_counter() - inicio:.1f} s).")
+        sys.exit(0)
+
+    lado = int(sys.argv[1]) if len(sys.argv) > 1 else 150
+    inicio = time.perf_counter()
+    datos = _grafo_de_prueba(lado)
+    print(f"Cuadrícula {lado}x{lado}: {lado * lado} nodos, {len(datos['destinos'])} aristas, construcción {time.perf_counter() - inicio:.1f} s")
+    with tempfile.TemporaryDirectory() as carpeta:
+        archivo = os.path.join(carpeta, "grafo.npz")
+        np.savez(archivo, **datos)
+        router = RoadRouter()
+        router.cargar(archivo)
+
+    random.seed(1)
+    pares = [(random.randrange(lado * lado), random.randrange(lado * lado)) for _ in range(100)]
+    t_alt = t_dijkstra = 0.0
+    iguales, nodos_alt, nodos_dijkstra = 0, 0, 0
+    for s, t in pares:
+        antes = router._stats["settled_nodes"]
+        inicio = time.perf_counter()
+        alt = router._alt(s, t)
+        t_alt += time.perf_counter() - inicio
+        nodos_alt += router._stats["settled_nodes"] - antes
+        antes = router._stats["settled_nodes"]
+        inicio = time.perf_counter()
+        tiempo, distancia, cerrados = router._dijkstra_hacia(s, {t})
+        t_dijkstra += time.perf_counter() - inicio
+        nodos_dijkstra += router._stats["settled_nodes"] - antes
+        referencia = (tiempo[t], distancia[t]) if t in cerrados else None
+        iguales += (alt is None and referencia is None) or (alt is not None and referencia is not None and math.isclose(alt[0], referencia[0], rel_tol=1e-6))
+    print(f"ALT == Dijkstra en {iguales}/{len(pares)} pares")
+    assert iguales == len(pares), "ALT difiere de Dijkstra"
+    print(f"punto a punto: ALT {t_alt / len(pares) * 1000:.2f} ms ({nodos_alt // len(pares)} nodos), Dijkstra {t_dijkstra / len(pares) * 1000:.2f} ms ({nodos_dijkstra // len(pares)} nodos)")
+
+    origen = (float(router.lat[0]), float(router.lon[0]))
+    destinos_prueba = [(float(router.lat[t]), float(router.lon[t])) for _, t in pares]
+    inicio = time.perf_counter()
+    km, segundos = router.uno_a_muchos(*origen, destinos_prueba)
+    t_uno = time.perf_counter() - inicio
+    individuales = np.array([(router.ruta(*origen, *d) or {"km": np.nan})["km"] for d in destinos_prueba])
+    igual = np.allclose(km, individuales, equal_nan=True, rtol=1e-6)
+    print(f"uno a muchos ({len(destinos_prueba)} destinos): {t_uno * 1000:.1f} ms, igual a punto a punto: {igual}")
+    assert igual, "uno_a_muchos difiere de ruta() punto a punto"
+    print("ejemplo:", router.ruta(*origen, *destinos_prueba[0]), "fuera de la red:", router.ruta(0.0, 0.0, *origen))
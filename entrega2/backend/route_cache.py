@@ -0,0 +1,145 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+
+from database import get_redis_client
+
+logger = logging.getLogger(__name__)
+
+# --- CACHÉ DE RUTAS (LRU EN PROCESO + REDIS) ---
+# Muchos pedidos salen del mismo comercio hacia direcciones cercanas. Antes de ir a OSRM se
+# busca la ruta en un LRU en memoria y luego en Redis (compartido entre instancias, con TTL).
+# La clave son las coordenadas redondeadas a ROUTE_CACHE_PRECISION decimales
+# (4 decimales ~ 11 m), así que puntos prácticamente iguales comparten la entrada.
+# Si varias peticiones piden a la vez la misma ruta que no está en caché, solo una consulta
+# OSRM y las demás esperan su resultado. Las respuestas fallidas (None) no se guardan.
+# Las lecturas y escrituras en Redis (cliente síncrono) se hacen con asyncio.to_thread.
+
+ROUTE_CACHE_ENABLED = os.getenv("ROUTE_CACHE_ENABLED", "true").lower() == "true"
+ROUTE_CACHE_PRECISION = int(os.getenv("ROUTE_CACHE_PRECISION", 4))
+ROUTE_CACHE_LRU_SIZE = int(os.getenv("ROUTE_CACHE_LRU_SIZE", 10000))
+ROUTE_CACHE_TTL_SECONDS = int(os.getenv("ROUTE_CACHE_TTL_SECONDS", 86400))
+ROUTE_CACHE_REDIS_PREFIX = "ruta"
+
+
+def clave_ruta(origen_coords: str, destino_coords: str, precision: int = ROUTE_CACHE_PRECISION) -> str | None:
+    """'lat,lon' x 2 -> clave cuantizada, o None si las coordenadas no se pueden leer."""
+    try:
+        valores = [float(v) for c in (origen_coords, destino_coords) for v in c.split(',')]
+    except (AttributeError, ValueError):
+        return None
+    if len(valores) != 4:
+        return None
+    # '+ 0.0' evita claves distintas para 0.0 y -0.0
+    return ";".join(f"{round(v, precision) + 0.0:.{precision}f}" for v in valores)
+
+
+class RouteCache:
+    def __init__(self, max_entries: int = ROUTE_CACHE_LRU_SIZE, ttl_seconds: int = ROUTE_CACHE_TTL_SECONDS):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lru = OrderedDict()  # clave -> (ruta, expira en epoch)
+        self._en_vuelo = {}        # clave -> asyncio.Future de la consulta en curso
+        self._stats = {"lru_hits": 0, "redis_hits": 0, "misses": 0, "coalesced": 0, "uncached": 0, "redis_errors": 0}
+
+    def _leer_lru(self, clave: str):
+        entrada = self._lru.get(clave)
+        if entrada is None:
+            return None
+        if entrada[1] < time.time():
+            del self._lru[clave]
+            return None
+        self._lru.move_to_end(clave)
+        return entrada[0]
+
+    def _guardar_lru(self, clave: str, ruta: dict, expira: float):
+        self._lru[clave] = (ruta, expira)
+        self._lru.move_to_end(clave)
+        while len(self._lru) > self.max_entries:
+            self._lru.popitem(last=False)
+
+    def _leer_redis(self, clave: str):
+        r = get_redis_client()
+        if not r:
+            return None
+        try:
+            pipe = r.pipeline(transaction=False)
+            pipe.get(f"{ROUTE_CACHE_REDIS_PREFIX}:{clave}")
+            pipe.ttl(f"{ROUTE_CACHE_REDIS_PREFIX}:{clave}")
+            valor, ttl = pipe.execute()
+            if valor is None:
+                return None
+            return json.loads(valor), time.time() + max(ttl, 1)
+        except Exception as e:
+            self._stats["redis_errors"] += 1
+            logger.warning(f"Caché de rutas: error leyendo Redis: {e!r}")
+            return None
+
+    def _guardar_redis(self, clave: str, ruta: dict):
+        r = get_redis_client()
+        if not r:
+            return
+        try:
+            r.set(f"{ROUTE_CACHE_REDIS_PREFIX}:{clave}", json.dumps(ruta), ex=self.ttl_seconds)
+        except Exception as e:
+            self._stats["redis_errors"] += 1
+            logger.warning(f"Caché de rutas: error escribiendo en Redis: {e!r}")
+
+    async def _resolver(self, clave: str, consultar, origen_coords: str, destino_coords: str):
+        # redis-py es síncrono (y get_redis_client puede reconectar): se usa desde un hilo
+        guardada = await asyncio.to_thread(self._leer_redis, clave)
+        if guardada is not None:
+            self._stats["redis_hits"] += 1
+            self._guardar_lru(clave, *guardada)
+            return guardada[0]
+        self._stats["misses"] += 1
+        ruta = await consultar(origen_coords, destino_coords)
+        if ruta is not None:
+            self._guardar_lru(clave, ruta, time.time() + self.ttl_seconds)
+            await asyncio.to_thread(self._guardar_redis, clave, ruta)
+        return ruta
+
+    async def obtener(self, origen_coords: str, destino_coords: str, consultar):
+        """
+        Ruta entre dos puntos 'lat,lon'. 'consultar(origen, destino)' es la corrutina que va a
+        OSRM en caso de fallo de caché (devuelve el dict de la ruta o None).
+        """
+        clave = clave_ruta(origen_coords, destino_coords) if ROUTE_CACHE_ENABLED else None
+        if clave is None:
+            self._stats["uncached"] += 1
+            return await consultar(origen_coords, destino_coords)
+
+        ruta = self._leer_lru(clave)
+        if ruta is not None:
+            self._stats["lru_hits"] += 1
+            return ruta
+
+        en_curso = self._en_vuelo.get(clave)
+        if en_curso is not None:
+            self._stats["coalesced"] += 1
+            # shield: si esta petición se cancela, la consulta compartida sigue para las demás
+            return await asyncio.shield(en_curso)
+
+        tarea = asyncio.ensure_future(self._resolver(clave, consultar, origen_coords, destino_coords))
+        self._en_vuelo[clave] = tarea
+        tarea.add_done_callback(lambda _: self._en_vuelo.pop(clave, None))
+        return await asyncio.shield(tarea)
+
+    def stats(self) -> dict:
+        consultas = self._stats["lru_hits"] + self._stats["redis_hits"] + self._stats["misses"] + self._stats["coalesced"]
+        aciertos = consultas - self._stats["misses"]
+        return {
+            **self._stats,
+            "hit_ratio": round(aciertos / consultas, 4) if consultas else None,
+            "lru_entries": len(self._lru),
+            "in_flight": len(self._en_vuelo),
+            "enabled": ROUTE_CACHE_ENABLED,
+            "precision": ROUTE_CACHE_PRECISION,
+            "ttl_seconds": self.ttl_seconds,
+        }
+
+
+route_cache = RouteCache()
@@ -0,0 +1,240 @@
+import asyncio
+import logging
+import os
+from dataclasses import dataclass
+
+import numpy as np
+
+from database import OSRM_BASE_URL, estimar_ruta_lineal
+from geo import haversine_muchos_a_muchos, FACTOR_CALLE
+from outbound import osrm, obtener_distancia_osrm
+from road_router import ROUTING_BACKEND
+
+logger = logging.getLogger(__name__)
+
+# --- MATRICES DE DISTANCIA (OSRM /table) ---
+# obtener_distancia_osrm hace una petición /route por par origen-destino. Para operaciones
+# en lote (recotizar, despacho, cotizar muchas direcciones) se usa el servicio /table de OSRM,
+# que devuelve la matriz completa en una sola petición. Las matrices que superan el límite de
+# coordenadas del servidor se parten en bloques que se piden en paralelo (con la concurrencia
+# del upstream 'osrm'). Un bloque que falla, o una celda sin ruta, se completa con la
+# estimación en línea recta x FACTOR_CALLE, igual que estimar_ruta_lineal.
+
+# Por defecto se deriva de OSRM_URL: .../route/v1/driving -> .../table/v1/driving
+OSRM_TABLE_URL = os.getenv("OSRM_TABLE_URL", OSRM_BASE_URL.replace("/route/", "/table/"))
+# Máximo de coordenadas (orígenes + destinos) por petición; OSRM usa 100 por defecto (--max-table-size)
+OSRM_TABLE_MAX_COORDS = int(os.getenv("OSRM_TABLE_MAX_COORDS", 100))
+# rutas_para_pares: hasta este tamaño (orígenes únicos x destinos únicos) se usa una matriz;
+# por encima, consultas por par (con caché) con esta concurrencia
+ROUTE_PAIRS_MAX_MATRIX_CELLS = int(os.getenv("ROUTE_PAIRS_MAX_MATRIX_CELLS", 20000))
+ROUTE_PAIRS_CONCURRENCY = int(os.getenv("ROUTE_PAIRS_CONCURRENCY", 20))
+
+_stats = {"matrices": 0, "cells": 0, "requests": 0, "failed_requests": 0, "estimated_cells": 0}
+
+
+@dataclass
+class MatrizRutas:
+    """
+    Resultado de N orígenes x M destinos. 'km' siempre tiene valor (inf si la coordenada es
+    inválida); 'segundos' es NaN donde no hubo ruta OSRM. 'estimado' marca esas celdas.
+    """
+    km: np.ndarray
+    segundos: np.ndarray
+    estimado: np.ndarray
+
+    def ruta(self, i: int, j: int) -> dict:
+        """Una celda con el mismo formato que obtener_distancia_osrm / estimar_ruta_lineal."""
+        km = float(self.km[i, j])
+        if self.estimado[i, j]:
+            return {"km": km, "distancia_texto": f"~{km:.1f} km (est.)", "duracion_texto": "N/A"}
+        return {"km": km, "distancia_texto": f"{km:.1f} km", "duracion_texto": f"{self.segundos[i, j] / 60:.0f} min"}
+
+
+def _tamanos_de_bloque(n: int, m: int, limite: int) -> tuple:
+    """Filas y columnas por bloque de modo que filas + columnas <= limite."""
+    if n + m <= limite:
+        return n, m
+    if m <= limite // 2:
+        return limite - m, m
+    if n <= limite // 2:
+        return n, limite - n
+    return limite // 2, limite - limite // 2
+
+
+def _coordenadas(puntos) -> str:
+    return ";".join(f"{lon:.6f},{lat:.6f}" for lat, lon in puntos)
+
+
+async def _pedir_bloque(origenes: list, destinos: list):
+    """Una petición /table. Devuelve (km, segundos) con NaN donde OSRM no encontró ruta, o None si falla."""
+    n = len(origenes)
+    url = (
+        f"{OSRM_TABLE_URL}/{_coordenadas(origenes + destinos)}"
+        f"?sources={';'.join(map(str, range(n)))}"
+        f"&destinations={';'.join(map(str, range(n, n + len(destinos))))}"
+        f"&annotations=distance,duration"
+    )
+    _stats["requests"] += 1
+    try:
+        response = await osrm.get(url)
+        if response.status_code != 200:
+            logger.error(f"Error OSRM /table: {response.status_code}")
+            return None
+        data = response.json()
+        if data.get("code") != "Ok" or "distances" not in data:
+            logger.error(f"OSRM /table respondió {data.get('code')}: {data.get('message')}")
+            return None
+        # null (sin ruta) -> NaN
+        metros = np.array(data["distances"], dtype=np.float64)
+        segundos = np.array(data.get("durations") or np.full(metros.shape, np.nan), dtype=np.float64)
+        if metros.shape != (n, len(destinos)):
+            logger.error(f"OSRM /table devolvió una matriz {metros.shape}, se esperaba {(n, len(destinos))}")
+            return None
+        return metros / 1000, segundos
+    except Exception as e:
+        logger.error(f"Error conectando con OSRM /table: {e!r}")
+        return None
+
+
+async def obtener_matriz_osrm(origenes: list, destinos: list) -> MatrizRutas:
+    """
+    Distancias y duraciones por calle de cada origen a cada destino. 'origenes' y 'destinos'
+    son listas de (lat, lon). Nunca falla por OSRM: lo que no se pueda resolver se estima.
+    """
+    origenes = [(float(lat), float(lon)) for lat, lon in origenes]
+    destinos = [(float(lat), float(lon)) for lat, lon in destinos]
+    n, m = len(origenes), len(destinos)
+    _stats["matrices"] += 1
+    _stats["cells"] += n * m
+    km = np.full((n, m), np.nan)
+    segundos = np.full((n, m), np.nan)
+    if n and m:
+        filas, columnas = _tamanos_de_bloque(n, m, max(OSRM_TABLE_MAX_COORDS, 2))
+        bloques = [(i, j) for i in range(0, n, filas) for j in range(0, m, columnas)]
+        resultados = await asyncio.gather(*(
+            _pedir_bloque(origenes[i:i + filas], destinos[j:j + columnas]) for i, j in bloques
+        ))
+        for (i, j), resultado in zip(bloques, resultados):
+            if resultado is None:
+                _stats["failed_requests"] += 1
+                continue
+            km[i:i + filas, j:j + columnas], segundos[i:i + filas, j:j + columnas] = resultado
+
+    estimado = np.isnan(km)
+    if estimado.any():
+        _stats["estimated_cells"] += int(estimado.sum())
+        lineal = haversine_muchos_a_muchos(
+            [p[0] for p in origenes], [p[1] for p in origenes], [p[0] for p in destinos], [p[1] for p in destinos]
+        ) * FACTOR_CALLE
+        km = np.where(estimado, lineal, km)
+        segundos = np.where(estimado, np.nan, segundos)
+    return MatrizRutas(km=km, segundos=segundos, estimado=estimado)
+
+
+async def rutas_para_pares(pares: list) -> list:
+    """
+    Rutas de una lista de pares (lat1, lon1, lat2, lon2): [(ruta, estimado)] en el mismo orden,
+    con 'ruta' en el formato de obtener_distancia_osrm. Con pocos orígenes/destinos distintos
+    (p. ej. un comercio hacia muchas direcciones) es una sola matriz /table; si no, o si el
+    backend de rutas no es OSRM, consultas por par en paralelo acotado (pasan por la caché).
+    """
+    origenes = list(dict.fromkeys((p[0], p[1]) for p in pares))
+    destinos = list(dict.fromkeys((p[2], p[3]) for p in pares))
+    if ROUTING_BACKEND == "osrm" and len(origenes) * len(destinos) <= ROUTE_PAIRS_MAX_MATRIX_CELLS:
+        fila = {punto: i for i, punto in enumerate(origenes)}
+        columna = {punto: j for j, punto in enumerate(destinos)}
+        matriz = await obtener_matriz_osrm(origenes, destinos)
+        celdas = [(fila[(p[0], p[1])], columna[(p[2], p[3])]) for p in pares]
+        return [(matriz.ruta(i, j), bool(matriz.estimado[i, j])) for i, j in celdas]
+
+    limite = asyncio.Semaphore(ROUTE_PAIRS_CONCURRENCY)
+
+    async def resolver(lat1, lon1, lat2, lon2):
+        origen, destino = f"{lat1},{lon1}", f"{lat2},{lon2}"
+        async with limite:
+            ruta = await obtener_distancia_osrm(origen, destino)
+        if ruta is None:
+            _stats["estimated_cells"] += 1
+            return estimar_ruta_lineal(origen, destino), True
+        return ruta, False
+
+    return await asyncio.gather(*(resolver(*p) for p in pares))
+
+
+def route_matrix_stats() -> dict:
+    return {**_stats, "max_coords": OSRM_TABLE_MAX_COORDS}
+
+
+if __name__ == "__main__":
+    # Prueba contra un OSRM simulado local (http.server): /table responde con la línea recta
+    # x 1.3 y sin ruta para destinos al sur de -5°. Verifica que la matriz por bloques sea
+    # idéntica a la de una sola petición y que sin servidor todo caiga en la estimación.
+    # (uso: python route_matrix.py)
+    import json
+    import random
+    import threading
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+    from urllib.parse import urlsplit, parse_qs
+
+    class OSRMSimulado(BaseHTTPRequestHandler):
+        peticiones = 0
+
+        def do_GET(self):
+            OSRMSimulado.peticiones += 1
+            url = urlsplit(self.path)
+            puntos = [tuple(map(float, c.split(","))) for c in url.path.rsplit("/", 1)[1].split(";")]  # (lon, lat)
+            qs = parse_qs(url.query)
+            fuentes = [puntos[int(k)] for k in qs["sources"][0].split(";")]
+            destinos_q = [puntos[int(k)] for k in qs["destinations"][0].split(";")]
+            metros = haversine_muchos_a_muchos(
+                [p[1] for p in fuentes], [p[0] for p in fuentes], [p[1] for p in destinos_q], [p[0] for p in destinos_q]
+            ) * 1300
+            distancias = [[None if d[1] < -5 else round(float(v), 1) for v, d in zip(fila, destinos_q)] for fila in metros]
+            duraciones = [[None if v is None else round(v / 8.0, 1) for v in fila] for fila in distancias]
+            cuerpo = json.dumps({"code": "Ok", "distances": distancias, "durations": duraciones}).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(cuerpo)))
+            self.end_headers()
+            self.wfile.write(cuerpo)
+
+        def log_message(self, *args):
+            pass
+
+    servidor = ThreadingHTTPServer(("127.0.0.1", 0), OSRMSimulado)
+    threading.Thread(target=servidor.serve_forever, daemon=True).start()
+
+    random.seed(3)
+    origenes = [(random.uniform(10.40, 10.55), random.uniform(-67.00, -66.75)) for _ in range(130)]
+    destinos = [(random.uniform(10.40, 10.55), random.uniform(-67.00, -66.75)) for _ in range(170)] + [(-6.0, -66.9)]
+
+    async def probar():
+        global OSRM_TABLE_URL, OSRM_TABLE_MAX_COORDS
+        OSRM_TABLE_URL = f"http://127.0.0.1:{servidor.server_address[1]}/table/v1/driving"
+        OSRM_TABLE_MAX_COORDS = 10_000
+        completa = await obtener_matriz_osrm(origenes, destinos)
+        print("una petición:", OSRMSimulado.peticiones, "estimadas:", int(completa.estimado.sum()), "(la columna sin ruta)")
+        assert OSRMSimulado.peticiones == 1
+        assert completa.estimado[:, -1].all() and not completa.estimado[:, :-1].any(), "solo la columna sin ruta se estima"
+
+        OSRMSimulado.peticiones = 0
+        OSRM_TABLE_MAX_COORDS = 100
+        por_bloques = await obtener_matriz_osrm(origenes, destinos)
+        identica = np.array_equal(completa.km, por_bloques.km) and np.array_equal(completa.segundos, por_bloques.segundos, equal_nan=True)
+        print(f"por bloques: {OSRMSimulado.peticiones} peticiones, idéntica:", identica)
+        assert OSRMSimulado.peticiones > 1 and identica, "la matriz por bloques difiere de la de una sola petición"
+        print("celda:", por_bloques.ruta(0, 0), por_bloques.ruta(0, len(destinos) - 1))
+
+        servidor.shutdown()
+        servidor.server_close()
+        sin_servidor = await obtener_matriz_osrm(origenes[:5], destinos[:5])
+        esperado = haversine_muchos_a_muchos(
+            [p[0] for p in origenes[:5]], [p[1] for p in origenes[:5]], [p[0] for p in destinos[:5]], [p[1] for p in destinos[:5]]
+        ) * FACTOR_CALLE
+        lineal = bool(sin_servidor.estimado.all()) and np.allclose(sin_servidor.km, esperado)
+        print("sin servidor -> estimación lineal:", lineal)
+        assert lineal, "sin servidor la matriz debe ser la estimación lineal"
+        print(route_matrix_stats())
+        await osrm.aclose()
+
+    asyncio.run(probar())
@@ -0,0 +1,205 @@
+import logging
+import math
+import os
+import time
+from datetime import datetime
+
+import numpy as np
+
+from async_db import async_db
+from geo import haversine_uno_a_muchos
+
+logger = logging.getLogger(__name__)
+
+# --- ÍNDICE ESPACIAL EN MEMORIA DE PEDIDOS PENDIENTES ---
+# /pedidos/cercanos es la consulta más frecuente (cada repartidor la llama en bucle).
+# En lugar de traer todos los pedidos pendientes y medir la distancia a cada uno,
+# los puntos de retiro se guardan en una cuadrícula de celdas de PEDIDOS_GRID_CELL_KM
+# y el radar solo revisa las celdas que caben en su radio máximo.
+# El índice se actualiza en cada cambio de estado del pedido y se resincroniza con la
+# base de datos cada PEDIDOS_INDEX_RESYNC_SECONDS por si otra instancia modificó pedidos.
+
+PEDIDOS_GRID_CELL_KM = float(os.getenv("PEDIDOS_GRID_CELL_KM", 1.0))
+PEDIDOS_INDEX_RESYNC_SECONDS = int(os.getenv("PEDIDOS_INDEX_RESYNC_SECONDS", 30))
+
+# Radar expansivo: radio base + 1 km por cada intervalo de espera, con un máximo
+# (0s -> 0.2 km, 10s -> 1.2 km, 20s -> 2.2 km, 30s o más -> 3.0 km)
+RADAR_BASE_KM = 0.2
+RADAR_MAX_KM = 3.0
+RADAR_EXPANSION_SECONDS = 10
+
+_KM_POR_GRADO = 111.32
+
+# --- MODO POSTGIS (OPCIONAL) ---
+# Si preparar_postgis() (migrations.py) creó las columnas geography (extensión postgis
+# instalada), el radar se resuelve en SQL con ST_DWithin sobre el índice GiST parcial de
+# geo_retiro y la cuadrícula en memoria no se usa. 'auto' elige PostGIS cuando ese índice
+# existe y es válido (se crea después de completar las filas); 'grid' fuerza la cuadrícula.
+PEDIDOS_GEO_BACKEND = os.getenv("PEDIDOS_GEO_BACKEND", "auto")  # auto | postgis | grid
+
+# El primer ST_DWithin (radio máximo constante) es el que aprovecha el índice; el segundo
+# aplica el radio del radar según la edad del pedido, igual que PendingOrderGrid.buscar().
+# $1 = id del repartidor, $2 = latitud, $3 = longitud. 'false' = esfera, como haversine.
+RADAR_POSTGIS_QUERY = f"""
+    SELECT p.*, c.nombre as nombre_comercio, i.id_externo
+    FROM pedidos p
+    JOIN comercios c ON p.id_comercio = c.id_comercio
+    LEFT JOIN integraciones i ON p.id = i.pedido_id
+    WHERE p.estado = 'pendiente'
+    AND (
+        p.repartidor_id = $1
+        OR (
+            p.repartidor_id IS NULL
+            AND ST_DWithin(p.geo_retiro, ST_SetSRID(ST_MakePoint($3, $2), 4326)::geography, {RADAR_MAX_KM * 1000}, false)
+            AND ST_DWithin(
+                p.geo_retiro, ST_SetSRID(ST_MakePoint($3, $2), 4326)::geography,
+                1000 * LEAST({RADAR_BASE_KM} + GREATEST(EXTRACT(EPOCH FROM (NOW() - p.fecha_creacion)), 0) / {RADAR_EXPANSION_SECONDS}, {RADAR_MAX_KM}),
+                false
+            )
+        )
+    )
+    ORDER BY p.fecha_creacion ASC;
+"""
+
+
+class PendingOrderGrid:
+    """
+    Cuadrícula lat/lon con los pedidos pendientes que aún no tienen repartidor.
+    Solo guarda lo necesario para el radar (id, punto de retiro y fecha de creación);
+    los datos completos del pedido se leen después por id, lo que además revalida
+    el estado en la base de datos.
+    """
+    def __init__(self, db, cell_km: float = PEDIDOS_GRID_CELL_KM):
+        self.db = db
+        self.cell_deg = cell_km / _KM_POR_GRADO
+        self._celdas = {}   # (fila, columna) -> {id_pedido: (lat, lon, fecha_creacion en epoch)}
+        self._pedidos = {}  # id_pedido -> (fila, columna)
+        self._cambios_en_recarga = None  # Cambios recibidos mientras se recarga desde la BD
+        self.postgis = False  # True: el radar va por RADAR_POSTGIS_QUERY y la cuadrícula queda vacía
+        self._stats = {"queries": 0, "cells_scanned": 0, "candidates_checked": 0, "upserts": 0, "removals": 0, "reloads": 0, "last_reload_ms": 0.0}
+
+    def _celda(self, lat: float, lon: float) -> tuple:
+        return (math.floor(lat / self.cell_deg), math.floor(lon / self.cell_deg))
+
+    def _insertar(self, id_pedido: int, lat: float, lon: float, fecha_creacion: datetime):
+        self._quitar(id_pedido)
+        celda = self._celda(lat, lon)
+        self._celdas.setdefault(celda, {})[id_pedido] = (lat, lon, fecha_creacion.timestamp())
+        self._pedidos[id_pedido] = celda
+
+    def _quitar(self, id_pedido: int):
+        celda = self._pedidos.pop(id_pedido, None)
+        if celda is not None:
+            pedidos_celda = self._celdas[celda]
+            del pedidos_celda[id_pedido]
+            if not pedidos_celda:
+                del self._celdas[celda]
+
+    def _aplicar(self, pedido: dict) -> str | None:
+        visible = (
+            pedido.get("estado") == "pendiente" and pedido.get("repartidor_id") is None
+            and pedido.get("latitud_retiro") is not None and pedido.get("longitud_retiro") is not None
+        )
+        if visible:
+            self._insertar(pedido["id"], float(pedido["latitud_retiro"]), float(pedido["longitud_retiro"]), pedido["fecha_creacion"])
+            return "upserts"
+        if pedido["id"] in self._pedidos:
+            self._quitar(pedido["id"])
+            return "removals"
+        return None
+
+    def sync(self, pedido: dict):
+        """Refleja en el índice el estado de un pedido recién insertado o actualizado (fila completa)."""
+        if self.postgis:
+            return
+        if self._cambios_en_recarga is not None:
+            self._cambios_en_recarga.append(pedido)
+        accion = self._aplicar(pedido)
+        if accion:
+            self._stats[accion] += 1
+
+    def discard(self, id_pedido: int):
+        """Para actualizaciones que sacan al pedido de 'pendiente' sin devolver la fila."""
+        self.sync({"id": id_pedido, "estado": None})
+
+    def buscar(self, lat: float, lon: float, ahora: datetime) -> list:
+        """Ids de los pedidos cuyo punto de retiro está dentro de su radio de radar actual."""
+        self._stats["queries"] += 1
+        filas = math.ceil(RADAR_MAX_KM / (self.cell_deg * _KM_POR_GRADO))
+        # Un grado de longitud mide menos a medida que nos alejamos del ecuador
+        columnas = math.ceil(RADAR_MAX_KM / (self.cell_deg * _KM_POR_GRADO * max(math.cos(math.radians(lat)), 0.01)))
+        fila0, columna0 = self._celda(lat, lon)
+
+        ids, puntos = [], []
+        for fila in range(fila0 - filas, fila0 + filas + 1):
+            for columna in range(columna0 - columnas, columna0 + columnas + 1):
+                pedidos_celda = self._celdas.get((fila, columna))
+                if pedidos_celda:
+                    self._stats["cells_scanned"] += 1
+                    ids.extend(pedidos_celda.keys())
+                    puntos.extend(pedidos_celda.values())
+        if not ids:
+            return []
+        self._stats["candidates_checked"] += len(ids)
+
+        # Distancias y radios de radar de todos los candidatos en una sola pasada
+        lats, lons, creados = np.array(puntos, dtype=np.float64).T
+        distancias = haversine_uno_a_muchos(lat, lon, lats, lons)
+        radios = np.minimum(RADAR_BASE_KM + np.maximum(ahora.timestamp() - creados, 0) / RADAR_EXPANSION_SECONDS, RADAR_MAX_KM)
+        return [ids[i] for i in np.flatnonzero(distancias <= radios)]
+
+    async def detectar_postgis(self) -> bool:
+        """Decide el backend según PEDIDOS_GEO_BACKEND y si está listo el índice geography del radar."""
+        if PEDIDOS_GEO_BACKEND == "grid":
+            self.postgis = False
+            return False
+        async with self.db.connection() as conn:
+            disponible = await conn.fetchval(
+                """SELECT EXISTS (SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid
+                   WHERE c.relname = 'idx_pedidos_geo_retiro_pendientes' AND i.indisvalid)"""
+            )
+        if PEDIDOS_GEO_BACKEND == "postgis" and not disponible:
+            logger.warning("PEDIDOS_GEO_BACKEND=postgis pero el índice de 'pedidos.geo_retiro' no existe (¿falta la extensión?). Usando la cuadrícula en memoria.")
+        self.postgis = bool(disponible)
+        logger.info(f"Búsqueda de pedidos cercanos: {'PostGIS' if self.postgis else 'cuadrícula en memoria'}.")
+        return self.postgis
+
+    async def recargar(self):
+        """Reconstruye el índice desde la base de datos (al arrancar y periódicamente)."""
+        if self.postgis:
+            return
+        inicio = time.monotonic()
+        self._cambios_en_recarga = []
+        try:
+            async with self.db.connection() as conn:
+                filas = await conn.fetch(
+                    "SELECT id, estado, repartidor_id, latitud_retiro, longitud_retiro, fecha_creacion FROM pedidos WHERE estado = 'pendiente' AND repartidor_id IS NULL"
+                )
+            cambios = self._cambios_en_recarga
+        except Exception as e:
+            logger.error(f"Error recargando el índice de pedidos pendientes: {e!r}")
+            return
+        finally:
+            self._cambios_en_recarga = None
+
+        self._celdas, self._pedidos = {}, {}
+        for fila in filas:
+            self._aplicar(dict(fila))
+        # Lo que cambió mientras corría la consulta es más reciente que la foto de la BD
+        for pedido in cambios:
+            self._aplicar(pedido)
+        self._stats["reloads"] += 1
+        self._stats["last_reload_ms"] = round((time.monotonic() - inicio) * 1000, 3)
+
+    def stats(self) -> dict:
+        return {
+            **self._stats,
+            "backend": "postgis" if self.postgis else "grid",
+            "indexed_orders": len(self._pedidos),
+            "occupied_cells": len(self._celdas),
+            "cell_km": PEDIDOS_GRID_CELL_KM,
+            "resync_seconds": PEDIDOS_INDEX_RESYNC_SECONDS,
+        }
+
+
+pedidos_pendientes_index = PendingOrderGrid(async_db)
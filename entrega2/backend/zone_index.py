@@ -0,0 +1,302 @@
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass
+from datetime import time as dtime
+from typing import List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+# --- ÍNDICE EN MEMORIA DE ZONAS RESTRINGIDAS ---
+# crear_pedido valida la dirección de entrega contra las zonas activas. En lugar de leer
+# 'restricted_zones' y recorrer cada polígono en cada pedido, las zonas activas se compilan
+# una vez (caja envolvente, aristas precalculadas y ventana horaria) y el índice se
+# reconstruye cuando /zones crea, modifica o elimina una zona. Como otra instancia puede
+# haber hecho el cambio, cada ZONES_INDEX_RESYNC_SECONDS se compara una huella barata de la
+# tabla (filas y último updated_at) y, si cambió, se vuelve a cargar.
+
+ZONAS_ACTIVAS_QUERY = "SELECT * FROM restricted_zones WHERE is_active = TRUE ORDER BY id ASC"
+ZONAS_HUELLA_QUERY = "SELECT count(*) AS filas, max(updated_at) AS ultima FROM restricted_zones"
+ZONES_INDEX_RESYNC_SECONDS = int(os.getenv("ZONES_INDEX_RESYNC_SECONDS", 10))
+# Tope de celdas (puntos x aristas) por bloque en la verificación vectorizada, para acotar la memoria
+ZONES_CHECK_MAX_CELLS = int(os.getenv("ZONES_CHECK_MAX_CELLS", 2_000_000))
+
+
+def is_point_in_polygon(point_lat: float, point_lng: float, polygon_coords: List[List[float]]) -> bool:
+    """
+    Determina si un punto (lat, lng) está dentro de un polígono.
+    El polígono se define como una lista de puntos [[lng, lat], ...].
+    Algoritmo: Ray Casting.
+    """
+    num_vertices = len(polygon_coords)
+    if num_vertices < 3:
+        return False
+    
+    inside = False
+    
+    # El primer punto del polígono
+    p1_lng, p1_lat = polygon_coords[0]
+    
+    for i in range(1, num_vertices + 1):
+        # El siguiente punto del polígono (el último se conecta con el primero)
+        p2_lng, p2_lat = polygon_coords[i % num_vertices]
+        
+        # Comprobar si el punto está entre las latitudes de la arista del polígono
+        if min(p1_lat, p2_lat) < point_lat <= max(p1_lat, p2_lat):
+            # Comprobar si el punto está a la izquierda de la arista
+            if point_lng <= max(p1_lng, p2_lng):
+                # Calcular la intersección en el eje X
+                if p1_lat != p2_lat:
+                    x_intersection = (point_lat - p1_lat) * (p2_lng - p1_lng) / (p2_lat - p1_lat) + p1_lng
+                
+                # Si el punto está a la izquierda de la intersección, cruzamos una arista
+                if p1_lng == p2_lng or point_lng <= x_intersection:
+                    inside = not inside
+                    
+        # Mover al siguiente punto
+        p1_lng, p1_lat = p2_lng, p2_lat
+        
+    return inside
+
+
+
+@dataclass(frozen=True)
+class CompiledZone:
+    id: int
+    name: str
+    min_lat: float
+    max_lat: float
+    min_lng: float
+    max_lng: float
+    # Aristas no horizontales: (lat1, lng1, min_lat, max_lat, max_lng, dlng, dlat)
+    aristas: tuple
+    restricted_from: Optional[dtime]
+    restricted_to: Optional[dtime]
+
+    @property
+    def es_24_7(self) -> bool:
+        return self.restricted_from is None and self.restricted_to is None
+
+    def contiene(self, lat: float, lng: float) -> bool:
+        """Ray casting con el mismo criterio de bordes que is_point_in_polygon."""
+        if not (self.min_lat <= lat <= self.max_lat and self.min_lng <= lng <= self.max_lng):
+            return False
+        dentro = False
+        for lat1, lng1, arista_min_lat, arista_max_lat, arista_max_lng, dlng, dlat in self.aristas:
+            if arista_min_lat < lat <= arista_max_lat and lng <= arista_max_lng:
+                if dlng == 0 or lng <= (lat - lat1) * dlng / dlat + lng1:
+                    dentro = not dentro
+        return dentro
+
+    def restringida_a_las(self, hora: dtime) -> bool:
+        if self.es_24_7:
+            return True
+        if self.restricted_from is None or self.restricted_to is None:
+            # Solo un extremo definido: la zona no restringe (igual que antes)
+            return False
+        if self.restricted_from > self.restricted_to:  # Rango que cruza la medianoche (ej: 22:00 a 06:00)
+            return hora >= self.restricted_from or hora <= self.restricted_to
+        return self.restricted_from <= hora <= self.restricted_to
+
+
+def compilar_zona(zona: dict) -> Optional[CompiledZone]:
+    """Convierte una fila de 'restricted_zones' (polygon_coords = [[lng, lat], ...]) en CompiledZone."""
+    coords = [(float(lng), float(lat)) for lng, lat in zona["polygon_coords"] or []]
+    if len(coords) < 3:
+        return None
+    aristas = []
+    for i, (lng1, lat1) in enumerate(coords):
+        lng2, lat2 = coords[(i + 1) % len(coords)]
+        if lat1 == lat2:
+            continue  # Una arista horizontal nunca cruza el rayo
+        aristas.append((lat1, lng1, min(lat1, lat2), max(lat1, lat2), max(lng1, lng2), lng2 - lng1, lat2 - lat1))
+    lngs = [c[0] for c in coords]
+    lats = [c[1] for c in coords]
+    return CompiledZone(
+        id=zona["id"], name=zona["name"],
+        min_lat=min(lats), max_lat=max(lats), min_lng=min(lngs), max_lng=max(lngs),
+        aristas=tuple(aristas),
+        restricted_from=zona["restricted_from"], restricted_to=zona["restricted_to"],
+    )
+
+
+@dataclass(frozen=True)
+class _ZoneSet:
+    version: int
+    zonas: tuple
+    cajas: np.ndarray           # Z x 4: min_lat, max_lat, min_lng, max_lng
+    aristas: np.ndarray         # E x 7: columnas de CompiledZone.aristas, todas las zonas concatenadas
+    limites: np.ndarray         # Z + 1: las aristas de la zona k son aristas[limites[k]:limites[k + 1]]
+
+
+def _compilar_conjunto(zonas: tuple, version: int) -> _ZoneSet:
+    filas = [arista for zona in zonas for arista in zona.aristas]
+    return _ZoneSet(
+        version=version,
+        zonas=zonas,
+        cajas=np.array([(z.min_lat, z.max_lat, z.min_lng, z.max_lng) for z in zonas], dtype=np.float64).reshape(-1, 4),
+        aristas=np.array(filas, dtype=np.float64).reshape(-1, 7),
+        limites=np.cumsum([0] + [len(z.aristas) for z in zonas]),
+    )
+
+
+class ZoneIndex:
+    """
+    Conjunto compilado de zonas activas. 'cargar' reemplaza el conjunto completo de una vez,
+    así que es seguro llamarlo desde los endpoints síncronos (hilos) mientras el event loop consulta.
+    """
+    def __init__(self):
+        self._conjunto = _compilar_conjunto((), 0)
+        self._lock = threading.Lock()
+        self._huella = None  # (filas, último updated_at) de la tabla con la que se cargó; None = desconocida
+        self._stats = {
+            "checks": 0, "inside_hits": 0, "rejections": 0, "batch_checks": 0, "batch_points": 0,
+            "rebuilds": 0, "last_rebuild_ms": 0.0, "resync_checks": 0, "resyncs": 0,
+        }
+
+    @property
+    def zonas(self) -> tuple:
+        return self._conjunto.zonas
+
+    @property
+    def version(self) -> int:
+        return self._conjunto.version
+
+    def cargar(self, filas, huella: Optional[tuple] = None) -> int:
+        """Reemplaza el conjunto. 'huella' es la de ZONAS_HUELLA_QUERY leída ANTES que 'filas'."""
+        inicio = time.monotonic()
+        compiladas = tuple(z for z in (compilar_zona(dict(f)) for f in filas) if z is not None)
+        with self._lock:
+            self._conjunto = _compilar_conjunto(compiladas, self._conjunto.version + 1)
+            self._huella = huella
+            self._stats["rebuilds"] += 1
+            self._stats["last_rebuild_ms"] = round((time.monotonic() - inicio) * 1000, 3)
+        logger.info(f"Índice de zonas restringidas reconstruido: {len(compiladas)} zonas activas (versión {self.version}).")
+        return self.version
+
+    async def resincronizar(self, conn) -> bool:
+        """
+        Con una conexión asyncpg: recarga el conjunto si 'restricted_zones' cambió desde la
+        última carga (o si esa carga no registró huella). Devuelve True si recargó.
+        """
+        self._stats["resync_checks"] += 1
+        huella = tuple(await conn.fetchrow(ZONAS_HUELLA_QUERY))
+        if self._huella is not None and self._huella == huella:
+            return False
+        self.cargar(await conn.fetch(ZONAS_ACTIVAS_QUERY), huella)
+        self._stats["resyncs"] += 1
+        return True
+
+    def zona_restringida(self, lat: float, lng: float, hora: dtime) -> Optional[CompiledZone]:
+        """Primera zona que contiene el punto y está restringida a esa hora, o None."""
+        self._stats["checks"] += 1
+        for zona in self.zonas:
+            if zona.contiene(lat, lng):
+                self._stats["inside_hits"] += 1
+                if zona.restringida_a_las(hora):
+                    self._stats["rejections"] += 1
+                    return zona
+        return None
+
+    def verificar_puntos(self, lats, lngs, hora: dtime) -> tuple:
+        """
+        Versión vectorizada para muchos puntos. Devuelve (versión, resultados) con un
+        (zona, restringida_ahora) por punto: la primera zona restringida a esa hora que
+        contiene el punto (la misma que rechazaría crear_pedido); si no hay, la primera
+        zona que lo contiene con restringida_ahora=False; si ninguna, (None, False).
+        """
+        conjunto = self._conjunto
+        lat = np.asarray(lats, dtype=np.float64)
+        lng = np.asarray(lngs, dtype=np.float64)
+        self._stats["batch_checks"] += 1
+        self._stats["batch_points"] += len(lat)
+
+        contenido = self._contenido(conjunto, lat, lng)
+        restringidas = np.array([z.restringida_a_las(hora) for z in conjunto.zonas], dtype=bool)
+        en_restringida = contenido & restringidas
+
+        resultados = []
+        for fila_r, fila_c in zip(en_restringida, contenido):
+            if fila_r.any():
+                resultados.append((conjunto.zonas[int(fila_r.argmax())], True))
+            elif fila_c.any():
+                resultados.append((conjunto.zonas[int(fila_c.argmax())], False))
+            else:
+                resultados.append((None, False))
+        return conjunto.version, resultados
+
+    @staticmethod
+    def _contenido(conjunto: _ZoneSet, lat: np.ndarray, lng: np.ndarray) -> np.ndarray:
+        """Matriz booleana puntos x zonas. Mismo ray casting que CompiledZone.contiene."""
+        contenido = np.zeros((len(lat), len(conjunto.zonas)), dtype=bool)
+        if not len(lat) or not len(conjunto.zonas):
+            return contenido
+
+        cajas = conjunto.cajas
+        en_caja = (
+            (lat[:, None] >= cajas[:, 0]) & (lat[:, None] <= cajas[:, 1])
+            & (lng[:, None] >= cajas[:, 2]) & (lng[:, None] <= cajas[:, 3])
+        )
+        # Por zona: solo los puntos dentro de su caja contra todas sus aristas a la vez
+        for k in np.flatnonzero(en_caja.any(axis=0)):
+            lat1, lng1, min_lat, max_lat, max_lng, dlng, dlat = conjunto.aristas[conjunto.limites[k]:conjunto.limites[k + 1]].T
+            if not len(lat1):
+                continue
+            indices = np.flatnonzero(en_caja[:, k])
+            bloque = max(1, ZONES_CHECK_MAX_CELLS // len(lat1))
+            for desde in range(0, len(indices), bloque):
+                seleccion = indices[desde:desde + bloque]
+                la = lat[seleccion, None]
+                ln = lng[seleccion, None]
+                cruza = (min_lat < la) & (la <= max_lat) & (ln <= max_lng)
+                cruza &= (dlng == 0) | (ln <= (la - lat1) * dlng / dlat + lng1)
+                contenido[seleccion, k] = np.count_nonzero(cruza, axis=1) % 2 == 1
+        return contenido
+
+    def stats(self) -> dict:
+        return {**self._stats, "active_zones": len(self.zonas), "version": self.version, "resync_seconds": ZONES_INDEX_RESYNC_SECONDS}
+
+
+zonas_restringidas = ZoneIndex()
+
+
+if __name__ == "__main__":
+    # Benchmark: verificación por lotes vectorizada frente a is_point_in_polygon en un bucle
+    # (uso: python zone_index.py [zonas] [vertices] [puntos])
+    import math
+    import random
+    import sys
+
+    n_zonas, n_vertices, n_puntos = (int(a) for a in (sys.argv[1:] + ["50", "60", "2000"][len(sys.argv) - 1:])[:3])
+    random.seed(7)
+    filas = []
+    for k in range(n_zonas):
+        centro_lat, centro_lng = random.uniform(10.35, 10.60), random.uniform(-67.05, -66.75)
+        radios = [random.uniform(0.005, 0.03) for _ in range(n_vertices)]
+        coords = [
+            [centro_lng + r * math.cos(2 * math.pi * i / n_vertices), centro_lat + r * math.sin(2 * math.pi * i / n_vertices)]
+            for i, r in enumerate(radios)
+        ]
+        filas.append({"id": k + 1, "name": f"zona {k + 1}", "polygon_coords": coords, "restricted_from": None, "restricted_to": None})
+    puntos = [(random.uniform(10.33, 10.62), random.uniform(-67.08, -66.72)) for _ in range(n_puntos)]
+
+    indice = ZoneIndex()
+    indice.cargar(filas)
+
+    inicio = time.perf_counter()
+    esperado = [next((f["id"] for f in filas if is_point_in_polygon(lat, lng, f["polygon_coords"])), None) for lat, lng in puntos]
+    t_escalar = time.perf_counter() - inicio
+
+    inicio = time.perf_counter()
+    _, resultados = indice.verificar_puntos([p[0] for p in puntos], [p[1] for p in puntos], dtime(12, 0))
+    t_vectorizado = time.perf_counter() - inicio
+
+    obtenido = [zona.id if zona else None for zona, _ in resultados]
+    print(f"{n_zonas} zonas x {n_vertices} vértices, {n_puntos} puntos")
+    print(f"is_point_in_polygon (bucle): {t_escalar * 1000:9.1f} ms")
+    print(f"verificar_puntos (NumPy):    {t_vectorizado * 1000:9.1f} ms  ({t_escalar / t_vectorizado:.1f}x)")
+    print(f"resultados idénticos: {obtenido == esperado} ({sum(e is not None for e in esperado)} puntos dentro de alguna zona)")
+    assert obtenido == esperado, "verificar_puntos difiere de is_point_in_polygon"